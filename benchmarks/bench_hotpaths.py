@@ -0,0 +1,234 @@
+"""
+Offline micro-benchmarks for the scoring and clustering hot paths.
+Uses a tiny randomly initialised BERT (see tiny_model.py), so no downloads are needed, and writes
+timings to a JSON file that can be compared between commits.
+
+Example:
+    python benchmarks/bench_hotpaths.py --output bench_results.json --sizes 4x16 8x32 --repeats 3
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from tiny_model import REPO_DIR, build_tiny_model, make_corpus
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_call(func, repeats, setup=None):
+    """
+    Times func() repeats times, calling setup() (untimed) before each run.
+    Output printed by the benchmarked code is discarded.
+    :return:    List with wall time of each run, in seconds
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(name, params, times):
+    return {'name': name,
+            'params': params,
+            'repeats': len(times),
+            'times': times,
+            'min': min(times),
+            'median': float(np.median(times)),
+            'mean': float(np.mean(times))}
+
+
+def random_unit_rows(num_rows, num_cols, rng):
+    rows = np.abs(rng.standard_normal((num_rows, num_cols)))
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def bench_sentence_prob(lang_mod, lengths, repeats):
+    results = []
+    words = make_corpus(1, max(lengths), min_len=max(lengths), max_len=max(lengths))[0].split()
+    for sent_len in lengths:
+        tokens = lang_mod.tokenize_sent(" ".join(words[:sent_len]))
+        times = time_call(lambda: lang_mod.get_sentence_prob_directional(tokens), repeats)
+        results.append(summarize('BertLM.get_sentence_prob_directional', {'tokens': len(tokens)}, times))
+    return results
+
+
+def bench_calculate_matrix(model_dir, sizes, repeats, work_dir):
+    from BertModel import BertLM
+    from word_senser import WordSenseModel
+
+    results = []
+    lang_mod = BertLM(model_dir, use_cuda=False)
+    for num_sents, vocab_size in sizes:
+        corpus_file = os.path.join(work_dir, f"corpus_{num_sents}x{vocab_size}.txt")
+        with open(corpus_file, 'w') as fc:
+            fc.write("\n".join(make_corpus(num_sents, vocab_size)) + "\n")
+
+        wsd = WordSenseModel(model_dir, use_cuda=False)
+        wsd.lang_mod = lang_mod
+        with contextlib.redirect_stdout(io.StringIO()):
+            wsd.get_vocabulary(corpus_file)
+
+        def reset():
+            wsd.matrix = []
+
+        times = time_call(wsd.calculate_matrix, repeats, setup=reset)
+        params = {'sentences': num_sents, 'vocab': len(wsd.vocab_map),
+                  'instances': sum(len(inst) for inst in wsd.vocab_map.values())}
+        results.append(summarize('WordSenseModel.calculate_matrix', params, times))
+    return results
+
+
+def synthetic_wsd(num_sents, vocab_size, rng):
+    """
+    Builds sentences, vocab_map and a random unit-row matrix with the layout stored by WordSenseModel
+    """
+    sentences = [sent.split() for sent in make_corpus(num_sents, vocab_size)]
+    vocab_map = {}
+    instance_nbr = 0
+    for sent_nbr, words in enumerate(sentences):
+        for word_pos, word in enumerate(words):
+            vocab_map.setdefault(word, []).append((sent_nbr, word_pos, instance_nbr))
+            instance_nbr += 1
+    matrix = list(random_unit_rows(instance_nbr, len(vocab_map), rng))
+    return sentences, vocab_map, matrix
+
+
+def bench_disambiguate(sizes, repeats, work_dir, clust_method, k):
+    from word_senser import WordSenseModel
+
+    results = []
+    rng = np.random.default_rng(0)
+    for num_sents, vocab_size in sizes:
+        wsd = WordSenseModel('', use_cuda=False, freq_threshold=k)
+        wsd.sentences, wsd.vocab_map, wsd.matrix = synthetic_wsd(num_sents, vocab_size, rng)
+        with contextlib.redirect_stdout(io.StringIO()):
+            wsd.init_estimator(os.path.join(work_dir, 'wsd'), clust_method=clust_method, k=k)
+        pickle_cent = os.path.join(work_dir, 'cent.pickle')
+        times = time_call(lambda: wsd.disambiguate(pickle_cent=pickle_cent), repeats)
+        params = {'sentences': num_sents, 'vocab': len(wsd.vocab_map), 'instances': len(wsd.matrix),
+                  'clustering': clust_method, 'k': k}
+        results.append(summarize('WordSenseModel.disambiguate', params, times))
+    return results
+
+
+def synthetic_categorizer(num_sents, vocab_size, rng, senses=2):
+    from word_categorizer import WordCategorizer
+
+    wc = WordCategorizer()
+    wc.sentences, wc.vocab_map, wc.matrix = synthetic_wsd(num_sents, vocab_size, rng)
+    num_cols = len(wc.vocab_map)
+    # Make every other word ambiguous, with random sense centroids
+    wc.wsd_centroids = {word: (list(random_unit_rows(senses, num_cols, rng)) if i % 2 else [0])
+                        for i, word in enumerate(wc.vocab_map)}
+    return wc
+
+
+def bench_restructure_matrix(sizes, repeats):
+    results = []
+    rng = np.random.default_rng(0)
+    for num_sents, vocab_size in sizes:
+        wc = synthetic_categorizer(num_sents, vocab_size, rng)
+
+        def reset():
+            wc.disamb_vocab = []
+
+        times = time_call(wc.restructure_matrix, repeats, setup=reset)
+        params = {'sentences': num_sents, 'vocab': len(wc.vocab_map), 'instances': len(wc.matrix)}
+        results.append(summarize('WordCategorizer.restructure_matrix', params, times))
+    return results
+
+
+def bench_cluster_words(sizes, repeats, clust_method, k):
+    results = []
+    rng = np.random.default_rng(0)
+    for num_sents, vocab_size in sizes:
+        wc = synthetic_categorizer(num_sents, vocab_size, rng)
+        with contextlib.redirect_stdout(io.StringIO()):
+            wc.restructure_matrix()
+        times = time_call(lambda: wc.cluster_words(clust_method=clust_method, k=k), repeats)
+        params = {'sentences': num_sents, 'senses': wc.wsd_matrix.shape[1], 'instances': wc.wsd_matrix.shape[0],
+                  'clustering': clust_method, 'k': k}
+        results.append(summarize('WordCategorizer.cluster_words', params, times))
+    return results
+
+
+def parse_size(size):
+    num_sents, vocab_size = size.lower().split('x')
+    return int(num_sents), int(vocab_size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline micro-benchmarks for wordcat-transformer hot paths')
+    parser.add_argument('--output', type=str, default='bench_results.json', help='JSON file to write results to')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per benchmark')
+    parser.add_argument('--sizes', type=str, nargs='+', default=['2x8', '4x16', '8x32'],
+                        help='Corpus sizes for matrix benchmarks, as <sentences>x<vocabulary>')
+    parser.add_argument('--cluster_sizes', type=str, nargs='+', default=['20x50', '50x100', '100x200'],
+                        help='Corpus sizes for (synthetic) clustering benchmarks, as <sentences>x<vocabulary>')
+    parser.add_argument('--sent_lengths', type=int, nargs='+', default=[8, 16, 32],
+                        help='Sentence lengths (in words) for the sentence probability benchmark')
+    parser.add_argument('--clustering', type=str, default='KMeans', help='Clustering method to benchmark')
+    parser.add_argument('--k', type=int, default=2, help='Number of clusters for the clustering benchmarks')
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                        help='Run only these benchmarks: sentence_prob, calculate_matrix, disambiguate, '
+                             'restructure_matrix, cluster_words')
+    args = parser.parse_args()
+
+    def selected(bench_name):
+        return args.only is None or bench_name in args.only
+
+    sizes = [parse_size(s) for s in args.sizes]
+    cluster_sizes = [parse_size(s) for s in args.cluster_sizes]
+    work_dir = tempfile.mkdtemp(prefix='wordcat_bench_')
+    model_dir = build_tiny_model(os.path.join(work_dir, 'tiny_bert'))
+
+    results = []
+    try:
+        if selected('sentence_prob'):
+            from BertModel import BertLM
+            results += bench_sentence_prob(BertLM(model_dir, use_cuda=False), args.sent_lengths, args.repeats)
+        if selected('calculate_matrix'):
+            results += bench_calculate_matrix(model_dir, sizes, args.repeats, work_dir)
+        if selected('disambiguate'):
+            results += bench_disambiguate(cluster_sizes, args.repeats, work_dir, args.clustering, args.k)
+        if selected('restructure_matrix'):
+            results += bench_restructure_matrix(cluster_sizes, args.repeats)
+        if selected('cluster_words'):
+            results += bench_cluster_words(cluster_sizes, args.repeats, args.clustering, args.k)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for res in results:
+        print(f"{res['name']:40s} {json.dumps(res['params']):90s} median {res['median']:.4f}s")
+
+    import torch
+    report = {'meta': {'commit': git_commit(),
+                       'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'torch': torch.__version__,
+                       'repeats': args.repeats},
+              'results': results}
+    with open(args.output, 'w') as fo:
+        json.dump(report, fo, indent=2)
+    print(f"Benchmark results written to {args.output}")
@@ -0,0 +1,103 @@
+"""
+Memory benchmark for worker processes sharing the model weights (BertLM mmap_path).
+Starts several worker processes that each load BertLM, either with from_pretrained (private copy of the
+weights) or memory-mapped from one state-dict file, and score a few sentences. Each worker reports its
+load time and its resident, proportional (pss) and private memory.
+Uses the tiny local BERT by default; pass --pretrained to measure a real model.
+Results are written to a JSON file, like bench_hotpaths.py.
+
+Example:
+    python benchmarks/bench_mmap.py --output mmap.json --workers 4 --pretrained bert-large-uncased
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+
+from bench_hotpaths import git_commit
+from tiny_model import SRC_DIR, build_tiny_model, make_corpus
+
+
+def worker(pretrained_model, mmap_path, sentences, barrier, results):
+    import sys
+    sys.path.insert(0, SRC_DIR)
+    from BertModel import BertLM
+    from instrumentation import memory_mb
+
+    start = time.perf_counter()
+    lang_mod = BertLM(pretrained_model, use_cuda=False, mmap_path=mmap_path)
+    load_time = time.perf_counter() - start
+    for sent in sentences:
+        lang_mod.get_sentence_prob_directional(lang_mod.tokenize_sent(sent))
+    barrier.wait()  # Measure while all workers hold their model
+    results.put({'pid': os.getpid(), 'load_time': load_time, 'memory_mb': memory_mb()})
+    barrier.wait()
+
+
+def run_workers(pretrained_model, mmap_path, num_workers, sentences, start_method):
+    ctx = multiprocessing.get_context(start_method)
+    barrier = ctx.Barrier(num_workers)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(pretrained_model, mmap_path, sentences, barrier, results))
+             for _ in range(num_workers)]
+    for proc in procs:
+        proc.start()
+    reports = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    return reports
+
+
+def summarize(name, reports):
+    mem = {key: [r['memory_mb'].get(key, float('nan')) for r in reports] for key in ('rss', 'pss', 'private')}
+    summary = {'name': name,
+               'workers': reports,
+               'mean_load_time': float(np.mean([r['load_time'] for r in reports])),
+               'mean_rss_mb': float(np.mean(mem['rss'])),
+               'mean_pss_mb': float(np.mean(mem['pss'])),
+               'mean_private_mb': float(np.mean(mem['private'])),
+               'total_pss_mb': float(np.sum(mem['pss']))}
+    print(f"{name:12s} load {summary['mean_load_time']:.2f}s, per worker: rss {summary['mean_rss_mb']:.0f} MB, "
+          f"pss {summary['mean_pss_mb']:.0f} MB, private {summary['mean_private_mb']:.0f} MB; "
+          f"total pss {summary['total_pss_mb']:.0f} MB")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory benchmark for workers sharing memory-mapped weights')
+    parser.add_argument('--output', type=str, default='mmap_results.json', help='JSON file to write results to')
+    parser.add_argument('--pretrained', type=str, default=None, help='Model to load (default: tiny local BERT)')
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes')
+    parser.add_argument('--start_method', type=str, default='spawn', help='Multiprocessing start method')
+    parser.add_argument('--sentences', type=int, default=4, help='Sentences scored by each worker')
+    args = parser.parse_args()
+
+    pretrained_model = args.pretrained or build_tiny_model()
+    mmap_path = os.path.join(tempfile.mkdtemp(prefix='bench_mmap_'), 'weights.pt')
+    sentences = make_corpus(args.sentences, vocab_size=50)
+
+    # Save the weights file once, so workers only map it
+    import sys
+    sys.path.insert(0, SRC_DIR)
+    from BertModel import BertLM
+    BertLM.load_mmap(pretrained_model, mmap_path)
+
+    results = [summarize('private', run_workers(pretrained_model, None, args.workers, sentences, args.start_method)),
+               summarize('mmap', run_workers(pretrained_model, mmap_path, args.workers, sentences,
+                                             args.start_method))]
+
+    report = {'meta': {'commit': git_commit(),
+                       'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'pretrained': args.pretrained or 'tiny',
+                       'weights_file_mb': os.path.getsize(mmap_path) / 2**20,
+                       'start_method': args.start_method},
+              'results': results}
+    with open(args.output, 'w') as fo:
+        json.dump(report, fo, indent=2)
+    print(f"Mmap results written to {args.output}")
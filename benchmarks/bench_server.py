@@ -0,0 +1,128 @@
+"""
+Offline check and benchmark of the scoring server (src/score_server.py), using the tiny local BERT.
+Starts a server in this process, then:
+  - checks that the scores served match the in-process BertLM, and that WordSenseModel gets the same
+    matrix through a ScoreClient,
+  - sends the same corpus from several concurrent clients, to measure throughput, micro-batch sizes and
+    shared-cache hits.
+Results are written to a JSON file, like bench_hotpaths.py.
+
+Example:
+    python benchmarks/bench_server.py --output server.json --clients 1 4 8
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from bench_hotpaths import git_commit
+from tiny_model import build_tiny_model, make_corpus
+
+
+def run_clients(url, corpus, num_clients):
+    """
+    Each client scores its own share of the corpus, one sentence per request, concurrently
+    """
+    from score_server import ScoreClient
+
+    clients = [ScoreClient(url) for _ in range(num_clients)]
+    errors = []
+
+    def client_loop(client, sentences):
+        try:
+            for sent in sentences:
+                client.score_sentences([sent])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=client_loop, args=(client, corpus[i::num_clients]))
+               for i, client in enumerate(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline check and benchmark of the scoring server')
+    parser.add_argument('--output', type=str, default='server_results.json', help='JSON file to write results to')
+    parser.add_argument('--sentences', type=int, default=64, help='Sentences in the synthetic corpus')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 8], help='Concurrent clients to try')
+    parser.add_argument('--max_latency', type=float, default=0.01, help='Micro-batching deadline, in seconds')
+    args = parser.parse_args()
+
+    from BertModel import BertLM
+    from score_server import ScoreServer, ScoreClient, make_server
+    from word_senser import WordSenseModel
+
+    model_dir = build_tiny_model()
+    lang_mod = BertLM(model_dir, use_cuda=False)
+    corpus = make_corpus(args.sentences, vocab_size=50)
+    results = {}
+
+    # Served scores against the in-process model
+    scorer = ScoreServer(lang_mod, max_latency=args.max_latency)
+    httpd = make_server(scorer, port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    client = ScoreClient(url)
+    served = client.score_sentences(corpus[:8])
+    local = np.array([np.log10(lang_mod.get_sentence_prob_directional(lang_mod.tokenize_sent(sent)))
+                      for sent in corpus[:8]])
+    results['max_abs_score_diff'] = float(np.max(np.abs(served - local)))
+
+    # WordSenseModel matrix through the client, against the in-process model
+    with tempfile.NamedTemporaryFile('w', suffix='.txt') as fc, contextlib.redirect_stdout(io.StringIO()):
+        fc.write("\n".join(corpus[:8]) + "\n")
+        fc.flush()
+        matrices = []
+        for model in (lang_mod, client):
+            wsd = WordSenseModel(model_dir, use_cuda=False)
+            wsd.lang_mod = model
+            wsd.get_vocabulary(fc.name)
+            wsd.calculate_matrix()
+            matrices.append(np.array(wsd.matrix))
+    results['max_abs_matrix_diff'] = float(np.max(np.abs(matrices[0] - matrices[1])))
+    httpd.shutdown()
+
+    # Throughput with concurrent clients, each on a fresh server (empty cache)
+    results['concurrency'] = []
+    for num_clients in args.clients:
+        scorer = ScoreServer(lang_mod, max_latency=args.max_latency)
+        httpd = make_server(scorer, port=0)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{httpd.server_address[1]}"
+        cold = run_clients(url, corpus, num_clients)
+        warm = run_clients(url, corpus, num_clients)  # Same sentences again: served from the shared cache
+        stats = scorer.stats()
+        httpd.shutdown()
+        results['concurrency'].append({'clients': num_clients,
+                                       'cold_sents_per_s': len(corpus) / cold,
+                                       'warm_sents_per_s': len(corpus) / warm,
+                                       'mean_requests_per_batch': stats['mean_requests_per_batch'],
+                                       'micro_batches': stats['micro_batches']})
+        print(f"{num_clients} clients: cold {len(corpus) / cold:.1f} sents/s, warm {len(corpus) / warm:.1f} "
+              f"sents/s, {stats['mean_requests_per_batch']:.1f} requests per micro-batch")
+
+    print(f"Max score diff against in-process model: {results['max_abs_score_diff']:.2e}, "
+          f"max matrix diff: {results['max_abs_matrix_diff']:.2e}")
+    report = {'meta': {'commit': git_commit(),
+                       'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'sentences': args.sentences,
+                       'max_latency': args.max_latency},
+              'results': results}
+    with open(args.output, 'w') as fo:
+        json.dump(report, fo, indent=2)
+    print(f"Server results written to {args.output}")
@@ -0,0 +1,69 @@
+"""
+Startup-time benchmark for the pipeline scripts: measures how long a fresh interpreter takes to import
+word_senser.py and word_categorizer.py, and which heavy libraries each import pulls in.
+Results are written to a JSON file, like bench_hotpaths.py.
+
+Example:
+    python benchmarks/bench_startup.py --output startup.json --repeats 5
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from bench_hotpaths import git_commit
+from tiny_model import SRC_DIR
+
+HEAVY_MODULES = ['torch', 'transformers', 'sklearn.cluster', 'sklearn.manifold', 'spherecluster',
+                 'matplotlib.pyplot']
+
+# Each snippet is run in a fresh interpreter, which prints the heavy modules it ended up loading
+SNIPPETS = {
+    'import word_senser': "import word_senser",
+    'import word_categorizer': "import word_categorizer",
+    'categorizer KMeans estimator': "import word_categorizer\n"
+                                    "wc = word_categorizer.WordCategorizer()\n"
+                                    "from sklearn.cluster import KMeans",
+}
+
+
+def run_snippet(code):
+    report = (f"\nimport sys, json\n"
+              f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+    start = time.perf_counter()
+    out = subprocess.check_output([sys.executable, '-c', code + report], cwd=SRC_DIR, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(out.decode().strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup-time benchmark for the pipeline scripts')
+    parser.add_argument('--output', type=str, default='startup_results.json', help='JSON file to write results to')
+    parser.add_argument('--repeats', type=int, default=5, help='Fresh interpreters started per snippet')
+    args = parser.parse_args()
+
+    results = []
+    baseline = [run_snippet("pass")[0] for _ in range(args.repeats)]
+    results.append({'name': 'python startup', 'times': baseline, 'median': float(np.median(baseline)),
+                    'heavy_modules': []})
+    for name, code in SNIPPETS.items():
+        runs = [run_snippet(code) for _ in range(args.repeats)]
+        times = [elapsed for elapsed, _ in runs]
+        results.append({'name': name, 'times': times, 'median': float(np.median(times)),
+                        'heavy_modules': runs[-1][1]})
+
+    for res in results:
+        print(f"{res['name']:35s} median {res['median']:.3f}s   loads: {', '.join(res['heavy_modules']) or '-'}")
+
+    report = {'meta': {'commit': git_commit(),
+                       'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'repeats': args.repeats},
+              'results': results}
+    with open(args.output, 'w') as fo:
+        json.dump(report, fo, indent=2)
+    print(f"Startup results written to {args.output}")
@@ -0,0 +1,73 @@
+"""
+Helpers to build a tiny, randomly initialised BERT masked LM from the local config and vocabulary
+in benchmarks/tiny_bert, so that benchmarks can run fully offline (no model downloads).
+"""
+import os
+import random as rand
+import shutil
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+TINY_BERT_DIR = os.path.join(BENCH_DIR, 'tiny_bert')
+
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+def build_tiny_model(dest_dir=None, config_dir=TINY_BERT_DIR, seed=42):
+    """
+    Saves a randomly initialised BertForMaskedLM and its BertTokenizer to dest_dir, in the layout expected
+    by from_pretrained(), so it can be passed as `pretrained_model` to BertLM/BertTok.
+    :param dest_dir:        Directory to write the model to. A temporary directory is created if None
+    :param config_dir:      Directory with config.json and vocab.txt
+    :param seed:            Torch seed for the random weights
+    :return:                Path to the saved model directory
+    """
+    import torch
+    from transformers import BertConfig, BertForMaskedLM
+
+    if dest_dir is None:
+        dest_dir = tempfile.mkdtemp(prefix='tiny_bert_')
+    os.makedirs(dest_dir, exist_ok=True)
+
+    torch.manual_seed(seed)
+    config = BertConfig.from_json_file(os.path.join(config_dir, 'config.json'))
+    model = BertForMaskedLM(config)
+    model.save_pretrained(dest_dir)
+    shutil.copy(os.path.join(config_dir, 'vocab.txt'), os.path.join(dest_dir, 'vocab.txt'))
+
+    return dest_dir
+
+
+def load_vocab_words(config_dir=TINY_BERT_DIR):
+    """
+    Returns the whole words (no special tokens, punctuation or sub-word pieces) in the tiny vocabulary
+    """
+    with open(os.path.join(config_dir, 'vocab.txt'), 'r') as fv:
+        tokens = [line.strip() for line in fv]
+    return [tok for tok in tokens if tok.isalpha() and len(tok) > 1]
+
+
+def make_corpus(num_sents, vocab_size, min_len=5, max_len=10, seed=0):
+    """
+    Builds a synthetic corpus of num_sents sentences, using (at most) vocab_size different words
+    from the tiny vocabulary.
+    :return:    List of sentences, as strings
+    """
+    rng = rand.Random(seed)
+    words = load_vocab_words()
+    rng.shuffle(words)
+    words = words[:vocab_size]
+    sentences = []
+    word_idx = 0
+    for _ in range(num_sents):
+        sent_len = rng.randint(min_len, max_len)
+        sent = []
+        for _ in range(sent_len):
+            sent.append(words[word_idx % len(words)])  # Cycle over vocabulary to use all words
+            word_idx += rng.randint(1, 3)
+        sentences.append(" ".join(sent) + " .")
+    return sentences
@@ -1,13 +1,32 @@
+import os
 import torch
 import numpy as np
 import pickle
-from transformers import BertTokenizer, BertModel, BertForMaskedLM
+import random as rand
+from transformers import BertConfig, BertTokenizer, BertModel, BertForMaskedLM
+
+from instrumentation import metrics
 
 BOS_TOKEN = '[CLS]'
 EOS_TOKEN = '[SEP]'
 MASK_TOKEN = '[MASK]'
 
 
+def save_atomic(obj, path):
+    """
+    torch.save() to a temporary file next to path, moved into place once complete, so that other processes
+    never load a partly written file
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"  # Same directory (and file system) as path, so os.replace is atomic
+    try:
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 class BertTok:
     def __init__(self, pretrained_model='bert-large-uncased'):
         self.tokenizer = BertTokenizer.from_pretrained(pretrained_model)
@@ -22,40 +41,180 @@ class BertTok:
 
 
 class BertLM:
-    def __init__(self, pretrained_model='bert-large-uncased', device_number='cuda:2', use_cuda=False):
+    def __init__(self, pretrained_model='bert-large-uncased', device_number='cuda:2', use_cuda=False,
+                 quantize=None, bf16=False, quantized_path=None, mmap_path=None):
+        """
+        :param quantize:        'int8' applies dynamic int8 quantization to the linear layers (CPU only)
+        :param bf16:            Run forward passes under bfloat16 autocast
+        :param quantized_path:  File to reload the quantized model from, or to save it to if not present
+        :param mmap_path:       File to memory-map the weights from (saved there first if not present), so that
+                                processes loading the same file share one physical copy of the weights
+        """
         self.device_number = device_number
         self.use_cuda = use_cuda
+        self.bf16 = bf16
 
         self.tokenizer = BertTokenizer.from_pretrained(pretrained_model)
-        self.model = BertForMaskedLM.from_pretrained(pretrained_model)  # Overwrite model
+        if quantize == 'int8':
+            if use_cuda or bf16:
+                print("Dynamic int8 quantization is only available for fp32 CPU inference")
+                exit(1)
+            if mmap_path:
+                print("Memory-mapped weights can't be used with int8 quantization")
+                exit(1)
+            self.model = self.load_quantized(pretrained_model, quantized_path)
+        elif quantize in (None, 'none'):
+            if mmap_path:
+                self.model = self.load_mmap(pretrained_model, mmap_path)
+            else:
+                self.model = BertForMaskedLM.from_pretrained(pretrained_model)  # Overwrite model
+        else:
+            print("Quantization modes implemented are: none, int8")
+            exit(1)
         with torch.no_grad():
             self.model.eval()
         if use_cuda:
             self.model.to(device_number)
 
         self.norm_dict = {}
+        self.norm_counts = {}  # Nbr of sentences used to estimate each normalization score
         self.sm = torch.nn.Softmax(dim=0)
 
-    def load_norm_scores(self, pickle_norm, norm_file):
+    @staticmethod
+    def load_quantized(pretrained_model, quantized_path=None):
+        """
+        Returns BertForMaskedLM with its linear layers dynamically quantized to int8.
+        If quantized_path exists, the quantized model is reloaded from it (it has to be saved with the same
+        torch and transformers versions); otherwise it is quantized from the fp32 weights and saved there.
+        """
+        if quantized_path and os.path.exists(quantized_path):
+            print(f"Loading quantized model from {quantized_path}")
+            return torch.load(quantized_path, weights_only=False)
+
+        model = BertForMaskedLM.from_pretrained(pretrained_model)
+        model.eval()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        if quantized_path:
+            save_atomic(model, quantized_path)
+            print(f"Quantized model stored in {quantized_path}")
+        return model
+
+    @staticmethod
+    def load_mmap(pretrained_model, mmap_path):
+        """
+        Returns BertForMaskedLM with its weights memory-mapped from mmap_path, instead of copied into
+        process memory. The model skeleton is built on the meta device, and the mapped tensors are assigned
+        to it, so pages are only read from disk when used and are shared by all processes mapping the file.
+        If mmap_path doesn't exist, the weights of pretrained_model (incl. non-persistent buffers) are saved
+        there first, atomically: processes starting at the same time each save their own copy, and only map a
+        complete file.
+        """
+        if not os.path.exists(mmap_path):
+            model = BertForMaskedLM.from_pretrained(pretrained_model)
+            state = model.state_dict()
+            state.update(model.named_buffers())
+            save_atomic(state, mmap_path)
+            print(f"Model weights stored in {mmap_path}")
+            del model, state
+
+        state = torch.load(mmap_path, mmap=True, weights_only=True)
+        with torch.device('meta'):
+            model = BertForMaskedLM(BertConfig.from_pretrained(pretrained_model))
+        model.load_state_dict(state, strict=False, assign=True)
+        for name, buffer in list(model.named_buffers()):
+            if buffer.is_meta:  # Non-persistent buffers are not restored by load_state_dict
+                module_name, _, buffer_name = name.rpartition('.')
+                model.get_submodule(module_name)._buffers[buffer_name] = state[name]
+        model.tie_weights()
+        return model
+
+    def run_model(self, masked_input, rows=None, positions=None):
+        """
+        Forward pass of a batch of token ids through the transformer, without gradients.
+        If positions are given, the MLM head (transform + vocabulary decoder) is only applied to the hidden
+        states of those positions, instead of to every token of every sequence.
+        :param masked_input:    Tensor with token ids, of shape (batch, sequence length)
+        :param rows:            Sequence (row of masked_input) of each queried position. Defaults to row 0
+        :param positions:       Positions whose logits are needed
+        :return:                Float32 logits, of shape (batch, sequence length, vocabulary); or of shape
+                                (len(positions), vocabulary) if positions are given
+        """
+        metrics.count('forward_passes', masked_input.shape[0])
+        metrics.count('tokens_processed', masked_input.numel())
+        device_type = 'cuda' if self.use_cuda else 'cpu'
+        with torch.no_grad(), torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.bf16):
+            if positions is None:
+                predictions = self.model(masked_input)[0]
+            else:
+                if rows is None:
+                    rows = [0] * len(positions)
+                hidden_states = self.model.bert(masked_input)[0]
+                device = hidden_states.device
+                hidden_states = hidden_states[torch.tensor(list(rows), device=device),
+                                              torch.tensor(list(positions), device=device)]
+                predictions = self.model.cls(hidden_states)
+                metrics.count('head_positions', len(positions))
+        return predictions.float()
+
+    def get_hidden_embeddings(self, sentences_ids, num_layers=4):
+        """
+        Contextual token embeddings from a single forward pass of a (padded) batch of sentences: the hidden
+        states of the last num_layers encoder layers, concatenated (as in BERT_Model.get_bert_embeddings).
+        The MLM head is not applied.
+        :param sentences_ids:   List of token-id sentences (incl. boundary tokens), of any length
+        :param num_layers:      Nbr of last layers to concatenate
+        :return:                List with a float32 array of shape (sentence length, num_layers * hidden size)
+                                for each sentence
+        """
+        lengths = [len(ids) for ids in sentences_ids]
+        input_ids = torch.full((len(sentences_ids), max(lengths)), self.tokenizer.pad_token_id)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(sentences_ids):
+            input_ids[row, :len(ids)] = torch.as_tensor(ids)
+            attention_mask[row, :len(ids)] = 1
+        if self.use_cuda:
+            input_ids, attention_mask = input_ids.to(self.device_number), attention_mask.to(self.device_number)
+
+        metrics.count('forward_passes', len(sentences_ids))
+        metrics.count('tokens_processed', sum(lengths))
+        device_type = 'cuda' if self.use_cuda else 'cpu'
+        with torch.no_grad(), torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.bf16):
+            hidden_states = self.model.bert(input_ids, attention_mask=attention_mask,
+                                            output_hidden_states=True).hidden_states
+            embeddings = torch.cat(hidden_states[-num_layers:], dim=-1).float().cpu().numpy()
+
+        return [embeddings[row, :length] for row, length in enumerate(lengths)]
+
+    def load_norm_scores(self, pickle_norm, norm_file, batch_size=64, tol=None, max_samples=None):
         """
         If pickle normalization file is present, load scores; else, calculate them.
+        Remaining parameters are passed to calculate_norm_dict().
         """
         try:
             with open(pickle_norm, 'rb') as h:
-                self.norm_dict = pickle.load(h)
+                _data = pickle.load(h)
+                if 'norm_scores' in _data:
+                    self.norm_dict = _data['norm_scores']
+                    self.norm_counts = _data['sample_counts']
+                else:  # Older pickles only stored the scores
+                    self.norm_dict = _data
 
                 print("NORMALIZATION SCORES FOUND!")
+                metrics.count('cache_hits.norm_pickle')
 
         except:
             print("NORMALIZATION SCORES File Not Found!! \n")
             print("Performing calculation...")
 
             if norm_file != '':
-                self.calculate_norm_dict(norm_file)
+                self.calculate_norm_dict(norm_file, batch_size=batch_size, tol=tol, max_samples=max_samples)
                 print("Normalization scores:")
                 print(self.norm_dict)
+                print("Sample counts:")
+                print(self.norm_counts)
                 with open(pickle_norm, 'wb') as h:
-                    pickle.dump(self.norm_dict, h)
+                    _data = {'norm_scores': self.norm_dict, 'sample_counts': self.norm_counts}
+                    pickle.dump(_data, h)
                 print("Data stored in " + pickle_norm)
             else:
                 print("Calculations without normalization scores:")
@@ -94,19 +253,21 @@ class BertLM:
         else:
             print("Direction can only be 'forward' or 'backwards'")
             exit()
-        predictions = self.get_predictions(current_tokens, verbose=verbose)
-        probs = self.sm(predictions[0, i])  # Softmax to get probabilities for token i
+        predictions = self.get_predictions(current_tokens, positions=[i], verbose=verbose)
+        probs = self.sm(predictions[0, 0])  # Softmax to get probabilities for token i
         if verbose:
             self.print_top_predictions(probs)
 
         return probs
 
-    def get_predictions(self, current_tokens, verbose=False):
+    def get_predictions(self, current_tokens, positions=None, verbose=False):
         """
         Directly processes current_tokens to be sent to transformer, and returns its predictions (logits)
         :param current_tokens:  Tokens to be sent to transformer model
+        :param positions:       If given, only compute the logits for these positions (negative ones allowed)
         :param verbose:
-        :return:                Logit predictions for all tokens in current_tokens
+        :return:                Logit predictions for all tokens in current_tokens, of shape (1, len, vocabulary);
+                                or only for the given positions, of shape (1, len(positions), vocabulary)
         """
         if verbose:
             print(f"\n{current_tokens}")
@@ -115,32 +276,120 @@ class BertLM:
             masked_input = torch.tensor([self.tokenizer.convert_tokens_to_ids(current_tokens)]).to(self.device_number)
         else:
             masked_input = torch.tensor([self.tokenizer.convert_tokens_to_ids(current_tokens)])
-            
-        predictions = self.model(masked_input)
-        return predictions[0]
 
-    def calculate_norm_dict(self, sentences_file):
+        if positions is None:
+            return self.run_model(masked_input)
+        positions = [pos % len(current_tokens) for pos in positions]
+        return self.run_model(masked_input, positions=positions).unsqueeze(0)
+
+    def get_batch_log_probs(self, ids_batch, positions, target_ids, rows=None):
+        """
+        Runs a batch of equal-length token-id sequences through the transformer in a single forward pass,
+        and returns the log10 probability of each query's target token at its position.
+        :param ids_batch:   List of token-id sequences, all of the same length (or a tensor of them)
+        :param positions:   Position to predict, for each query
+        :param target_ids:  Token id whose probability is needed, for each query
+        :param rows:        Sequence (index in ids_batch) of each query. Defaults to one query per sequence
+        :return:            Numpy array with the log10 probability of each query
+        """
+        if rows is None:
+            rows = range(len(ids_batch))
+        masked_input = torch.as_tensor(ids_batch)
+        if self.use_cuda:
+            masked_input = masked_input.to(self.device_number)
+
+        logits = self.run_model(masked_input, rows, positions)
+        with torch.no_grad():
+            device = logits.device
+            log_probs = torch.log_softmax(logits, dim=-1)
+            log_probs = log_probs[torch.arange(len(logits), device=device), torch.tensor(list(target_ids), device=device)]
+
+        return log_probs.cpu().numpy() / np.log(10)
+
+    def get_directional_ids(self, ids_input, i, direction):
+        """
+        Token ids of the masked sequence used by get_directional_prob() to predict position i
+        """
+        current_ids = list(ids_input)
+        if direction == 'backwards':
+            current_ids[1:i + 1] = [self.tokenizer.mask_token_id] * i
+        else:
+            current_ids[i:-1] = [self.tokenizer.mask_token_id] * (len(ids_input) - 1 - i)
+        return current_ids
+
+    def get_sentences_log_probs(self, sentences_ids, batch_size=64):
+        """
+        Batched equivalent of log10(get_sentence_prob_directional()) for several sentences of the same length.
+        All forward and backwards masked variants of the sentences are scored in batches of batch_size.
+        :param sentences_ids:   List of token-id sentences (incl. boundary tokens), all of the same length
+        :param batch_size:      Max nbr of masked sequences per forward pass
+        :return:                Numpy array with log10 of the directional probability of each sentence
+        """
+        ids_batch, positions, target_ids, owners = [], [], [], []
+        for sent_nbr, ids_input in enumerate(sentences_ids):
+            for i in range(1, len(ids_input) - 1):  # Don't loop first and last tokens
+                for direction in ('forward', 'backwards'):
+                    ids_batch.append(self.get_directional_ids(ids_input, i, direction))
+                    positions.append(i)
+                    target_ids.append(ids_input[i])
+                    owners.append(sent_nbr)
+
+        log_probs = np.zeros(len(ids_batch))
+        for start in range(0, len(ids_batch), batch_size):
+            end = start + batch_size
+            log_probs[start:end] = self.get_batch_log_probs(ids_batch[start:end], positions[start:end],
+                                                            target_ids[start:end])
+
+        # Geometric average of forward and backward probs
+        return 0.5 * np.bincount(owners, weights=log_probs, minlength=len(sentences_ids))
+
+    def calculate_norm_dict(self, sentences_file, batch_size=64, tol=None, max_samples=None, min_samples=5):
         """
         Determines the normalization score for each sentence length. Sentences_file should
         include grammatical samples of sentences of different length.
+        Sentences are bucketed by token length and scored in batches. If tol is given, scoring of a bucket
+        stops early once the standard error of its mean log-probability is below tol.
         :param sentences_file:  File with sentences to use for normalization scores
+        :param batch_size:      Max nbr of masked sequences per forward pass
+        :param tol:             Convergence tolerance for the mean log10-probability of each length bucket
+        :param max_samples:     Max nbr of sentences to score for each length bucket
+        :param min_samples:     Min nbr of sentences to score before checking convergence
         :return:                Dictionary with normalization scores for each sent length
         """
-        counts_probs = {}  # Stores counts and sum of probs for sentences of given length
+        if max_samples is not None and max_samples < 1:
+            print(f"ERROR: Max normalization sentences per length must be at least 1, got {max_samples}")
+            exit(1)
+        buckets = {}  # Token ids of the sentences of each length
         with open(sentences_file, 'r') as fs:
             for sent in fs:
+                if sent.strip() == '':
+                    continue
                 tok_sent = self.tokenize_sent(sent)
-                tok_len = len(tok_sent)
-                if tok_len not in counts_probs:
-                    counts_probs[tok_len] = [0, 0]
-                counts_probs[tok_len][0] += 1
-                # counts_probs[tok_len][1] += self.get_sentence_prob_directional(tok_sent)
-                # TRY WITH geometric average instead
-                counts_probs[tok_len][1] += np.log10(self.get_sentence_prob_directional(tok_sent))
-
-        print(f"Calculated normalization values for lengths: {counts_probs.keys()}")
-        # self.norm_dict = {k: v[1] / v[0] for k, v in counts_probs.items()}
-        self.norm_dict = {k: np.power(10, v[1] / v[0]) for k, v in counts_probs.items()}
+                buckets.setdefault(len(tok_sent), []).append(self.tokenizer.convert_tokens_to_ids(tok_sent))
+
+        self.norm_dict = {}
+        self.norm_counts = {}
+        for tok_len, bucket in sorted(buckets.items()):
+            rand.Random(tok_len).shuffle(bucket)  # Random order, so that early stopping sees a fair sample
+            if max_samples is not None:
+                bucket = bucket[:max_samples]
+            if not bucket:  # No score: lengths without one are normalized as in normalize_score()
+                continue
+            sents_per_batch = max(1, batch_size // (2 * max(1, tok_len - 2)))
+            sent_log_probs = []
+            for start in range(0, len(bucket), sents_per_batch):
+                sent_log_probs.extend(self.get_sentences_log_probs(bucket[start:start + sents_per_batch], batch_size))
+                count = len(sent_log_probs)
+                if tol is not None and count >= min_samples:
+                    std_error = np.std(sent_log_probs, ddof=1) / np.sqrt(count)
+                    if std_error < tol:
+                        break
+
+            # Geometric average of sentence probs
+            self.norm_dict[tok_len] = np.power(10, np.mean(sent_log_probs))
+            self.norm_counts[tok_len] = len(sent_log_probs)
+
+        print(f"Calculated normalization values for lengths: {self.norm_dict.keys()}")
 
     def normalize_score(self, sent_len, score):
         """
@@ -275,8 +524,8 @@ class BertLM:
                 masked_input = torch.tensor([self.tokenizer.convert_tokens_to_ids(current_tokenized)]).to(self.device_number)
             else:
                 masked_input = torch.tensor([self.tokenizer.convert_tokens_to_ids(current_tokenized)])
-            predictions = self.model(masked_input)[0]
-            current_probs = self.sm(predictions[0, i])  # Softmax to get probabilities
+            predictions = self.run_model(masked_input, positions=[i])
+            current_probs = self.sm(predictions[0])  # Softmax to get probabilities
             current_prob = current_probs[ids_input[i]]  # Prediction for masked word
 
             sum_lp += np.log(current_prob.detach().cpu().numpy())
@@ -0,0 +1,97 @@
+"""
+Assigns word senses to the categories of a previous word_categorizer.py run (--save_centroids), without
+clustering all senses again: each sense vector goes to the closest category centroid, one matrix product per
+batch of senses. By default, the senses of words the categories were not fitted on are assigned, e.g. words
+added by word_senser.py --update:
+    python src/category_assign.py --categories test_cat/KMeans_10.0.categories.pickle --pickle_emb test.pickle \
+           --pickle_WSD test_cent.pickle --margin 0.05 --output new_senses.tsv
+Assignments whose closest category is not ahead of the second one by --margin are uncertain; when more than
+--refit_fraction of them are, the categories should be fitted again with word_categorizer.py.
+"""
+import argparse
+import json
+
+import numpy as np
+
+import instrumentation
+from instrumentation import metrics
+from word_categorizer import WordCategorizer
+
+
+def sense_numbers(vocab):
+    """
+    Position of each sense among the senses of its word, for a list with one word per sense
+    """
+    seen = {}
+    numbers = []
+    for word in vocab:
+        numbers.append(seen.get(word, 0))
+        seen[word] = numbers[-1] + 1
+    return numbers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Assign word senses to existing word categories')
+    parser.add_argument('--categories', type=str, required=True, help='Category centroids saved by '
+                                                                      'word_categorizer.py --save_centroids')
+    parser.add_argument('--pickle_emb', type=str, required=True, help='Pickle file with embeddings matrix')
+    parser.add_argument('--pickle_WSD', type=str, default=None, help='Pickle file WSD info')
+    parser.add_argument('--words', type=str, nargs='+', default=None, help='Words whose senses to assign '
+                                                                           '(default: words not categorized yet)')
+    parser.add_argument('--margin', type=float, default=0.05, help='Min score margin over the second closest '
+                                                                   'category for a certain assignment')
+    parser.add_argument('--refit_fraction', type=float, default=0.2, help='Fraction of uncertain assignments '
+                                                                          'above which to recommend a refit')
+    parser.add_argument('--batch_size', type=int, default=1024, help='Senses per matrix product')
+    parser.add_argument('--output', type=str, default='assigned_senses.tsv', help='File to write assignments to')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.setup(args.log_level, args.log_interval, args.metrics_file, args.profile_dir)
+
+    wc = WordCategorizer()
+    wc.load_categories(args.categories)
+    with metrics.stage('load_matrix'):
+        wc.load_matrix(args.pickle_emb)
+    if args.pickle_WSD:
+        wc.load_centroids(args.pickle_WSD)
+        # Words added to the matrix since the senses were computed (word_senser.py --update) have a single sense
+        for word in wc.vocab_map:
+            wc.wsd_centroids.setdefault(word, [0])
+        with metrics.stage('restructure_matrix'):
+            wc.restructure_matrix()
+    else:
+        wc.wsd_matrix = wc.weight_rows(wc.matrix)
+        wc.disamb_vocab = list(wc.vocab_map)
+
+    if args.words:
+        missing = [word for word in args.words if word not in wc.vocab_map]
+        if missing:
+            print(f"ERROR: Words not in {args.pickle_emb}: {' '.join(missing)}")
+            exit(1)
+        words = set(args.words)
+    else:
+        words = set(wc.disamb_vocab) - set(wc.categories['senses'])
+    indices = [i for i, word in enumerate(wc.disamb_vocab) if word in words]
+    if not indices:
+        print("No senses to assign")
+        exit(0)
+
+    with metrics.stage('assign_categories'):
+        labels, scores, margins, certain = wc.assign_categories(wc.sense_vectors(indices), args.margin,
+                                                                args.batch_size)
+    numbers = sense_numbers(wc.disamb_vocab)
+    with open(args.output, 'w') as fo:
+        fo.write("word\tsense\tcategory\tscore\tmargin\tcertain\n")
+        for i, index in enumerate(indices):
+            fo.write(f"{wc.disamb_vocab[index]}\t{numbers[index]}\t{labels[i]}\t{scores[i]:.6f}\t"
+                     f"{margins[i]:.6f}\t{int(certain[i])}\n")
+
+    uncertain = float(np.mean(~certain))
+    summary = {'senses': len(indices), 'uncertain': int(np.sum(~certain)), 'uncertain_fraction': uncertain,
+               'margin': args.margin, 'refit': uncertain > args.refit_fraction}
+    metrics.info['category_assign'] = summary
+    print(json.dumps(summary))
+    print(f"{len(indices)} senses assigned to categories in {args.output}")
+    if summary['refit']:
+        print(f"Refit recommended: {uncertain:.1%} of the assignments are uncertain (more than "
+              f"{args.refit_fraction:.0%}); run word_categorizer.py again")
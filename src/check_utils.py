@@ -0,0 +1,50 @@
+"""
+Shared harness of the accuracy checks (quantization_check.py, log_space_check.py, reduction_check.py): word-sense
+clusters with a fixed seed, their agreement with reference clusters, and the JSON report.
+"""
+import contextlib
+import io
+import json
+import time
+
+import numpy as np
+
+
+def sense_labels(wsd, save_to, k, random_state=0):
+    """
+    Disambiguates the words of a WordSenseModel with KMeans, with the same initialization for every run
+    :param wsd:             WordSenseModel, with its matrix computed or loaded
+    :param save_to:         Prefix for the disambiguation outputs
+    :param k:               Nbr of KMeans clusters
+    :return:                Sense labels of each word, and the disambiguation time in seconds
+    """
+    wsd.init_estimator(save_to, clust_method='KMeans', k=k)
+    wsd.estimator.set_params(random_state=random_state)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        wsd.disambiguate(pickle_cent=save_to + '_cent.pickle')
+    return wsd.sense_labels, time.perf_counter() - start
+
+
+def compare_labels(ref_labels, test_labels):
+    """
+    Adjusted Rand index between the reference and test sense labels of each word
+    """
+    from sklearn.metrics import adjusted_rand_score
+
+    return {word: adjusted_rand_score(labels, test_labels[word]) for word, labels in ref_labels.items()}
+
+
+def summarize_ari(word_ari):
+    return {'mean_sense_ari': float(np.mean(list(word_ari.values()))) if word_ari else None,
+            'words_with_changed_senses': sorted(w for w, ari in word_ari.items() if ari < 1)}
+
+
+def write_report(report, output=None):
+    """
+    Prints the report, and writes it to output if given
+    """
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, 'w') as fo:
+            json.dump(report, fo, indent=2)
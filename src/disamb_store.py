@@ -0,0 +1,149 @@
+"""
+Single-file output of word_senser.py disambiguation (--output_format store), instead of one .disamb file per
+word. Each word is stored as a JSON line with its clusters (instance coordinates and sample sentences),
+followed by its sense centroids as raw float32 values, and an index file maps each word to the offset of its
+record. Records are written by a background thread, so clustering doesn't wait for the disk.
+The reader renders the same text as the .disamb files, for some or all words:
+    python src/disamb_store.py test_KMeans_k5/disamb.store --words bank fat
+    python src/disamb_store.py test_KMeans_k5/disamb.store --output_dir test_KMeans_k5
+"""
+import argparse
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+def render_disamb(clusters):
+    """
+    Text of a word's .disamb file
+    :param clusters:    List of (label, members, samples) for clusters -1 (noise) to the last one, where members
+                        are the (sentence nbr, word position, matrix row) of its instances, and samples are
+                        sentences with the instance in CAPS
+    """
+    text = []
+    for label, members, samples in clusters:
+        text.append(f"Cluster #{label}")
+        if len(members) > 0:  # Handle empty clusters
+            text.append(": \n[" + "".join(f"({sent}, {pos}, {row}), " for sent, pos, row in members) + "]\n")
+            text.append('Samples:\n' + "".join(sample + '\n' for sample in samples))
+        else:
+            text.append(" is empty\n\n")
+    return "".join(text)
+
+
+def index_file(store_file):
+    return store_file + '.index.json'
+
+
+class DisambWriter:
+    def __init__(self, store_file, queue_size=64):
+        """
+        Writes word records to store_file from a background thread, and the index when closed
+        :param queue_size:      Max records waiting to be written
+        """
+        self.store_file = store_file
+        self.index = {}  # Word -> [offset, nbr of bytes] of its record
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.fo = open(store_file, 'wb')
+        self.thread = threading.Thread(target=self.write_loop, name='disamb-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, word, clusters, centroids):
+        """
+        Queues the record of a word (see render_disamb() for clusters; centroids are its sense centroids)
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((word, clusters, centroids))
+
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # Drain the queue, the error is raised by write() or close()
+            try:
+                self.write_record(*item)
+            except Exception as e:
+                self.error = e
+
+    def write_record(self, word, clusters, centroids):
+        centroids = np.asarray(centroids, dtype=np.float32)
+        header = {'word': word,
+                  'clusters': [{'label': int(label), 'members': [[int(c) for c in member] for member in members],
+                                'samples': samples} for label, members, samples in clusters],
+                  'centroids_shape': list(centroids.shape)}
+        offset = self.fo.tell()
+        self.fo.write(json.dumps(header).encode('utf-8') + b'\n')
+        self.fo.write(centroids.tobytes())
+        self.index[word] = [offset, self.fo.tell() - offset]
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.fo.close()
+        if self.error is not None:
+            raise self.error
+        with open(index_file(self.store_file), 'w') as fi:
+            json.dump(self.index, fi)
+
+
+class DisambReader:
+    def __init__(self, store_file):
+        self.store_file = store_file
+        with open(index_file(store_file), 'r') as fi:
+            self.index = json.load(fi)
+
+    def words(self):
+        return list(self.index)
+
+    def read(self, word):
+        """
+        Record of a word: dict with its clusters, and its sense centroids as an array
+        """
+        offset, _ = self.index[word]
+        with open(self.store_file, 'rb') as fs:
+            fs.seek(offset)
+            record = json.loads(fs.readline())
+            shape = record.pop('centroids_shape')
+            record['centroids'] = np.frombuffer(fs.read(4 * int(np.prod(shape))), dtype=np.float32).reshape(shape)
+        return record
+
+    def render(self, word):
+        """
+        Text of the word's .disamb file
+        """
+        return render_disamb([(cluster['label'], cluster['members'], cluster['samples'])
+                              for cluster in self.read(word)['clusters']])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render .disamb files from a disambiguation store')
+    parser.add_argument('store', type=str, help='disamb.store file written by word_senser.py --output_format store')
+    parser.add_argument('--words', type=str, nargs='+', default=None, help='Words to render (default: all)')
+    parser.add_argument('--output_dir', type=str, default=None, help='Write <word>.disamb files here, instead of '
+                                                                     'printing them')
+    args = parser.parse_args()
+
+    reader = DisambReader(args.store)
+    words = args.words or reader.words()
+    missing = [word for word in words if word not in reader.index]
+    if missing:
+        print(f"ERROR: Words not in {args.store}: {' '.join(missing)}")
+        exit(1)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for word in words:
+        if args.output_dir:
+            with open(os.path.join(args.output_dir, word + '.disamb'), 'w') as fo:
+                fo.write(reader.render(word))
+        else:
+            print(f"# {word}")
+            print(reader.render(word))
+    if args.output_dir:
+        print(f"{len(words)} .disamb files written to {args.output_dir}")
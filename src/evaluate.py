@@ -0,0 +1,204 @@
+"""
+Scores word-sense (disamb.pred) and word-category (.wordcat) outputs against gold ones, e.g. the fixtures in
+tests/smallWSD_KMeans_k2 and tests/smallWSD_cat, with clustering metrics: adjusted Rand index, V-measure,
+F-score (as in the SemEval word sense induction tasks) and purity.
+All outputs of a sweep are scored at once: labels are loaded into integer arrays, and the metrics of every
+output (and, for senses, every word) are computed from a single stack of contingency tables.
+Example:
+    python src/evaluate.py --gold tests/smallWSD_KMeans_k2/disamb.pred --pred test_KMeans_k*/disamb.pred
+    python src/evaluate.py --gold tests/smallWSD_cat/KMeans_k_10.wordcat --pred test_cat/*.wordcat
+"""
+import argparse
+import json
+import re
+
+import numpy as np
+
+METRICS = ('ari', 'v_measure', 'f_score', 'purity')
+
+
+def read_pred(pred_file):
+    """
+    Instances and their sense labels in a disamb.pred file (<word> <instance nbr> <label> lines)
+    :return:    Lists of words and instance nbrs (as strings, only compared), and int array of labels,
+                in file order
+    """
+    with open(pred_file, 'r') as fp:
+        fields = fp.read().split()
+    return fields[0::3], fields[1::3], np.fromiter(map(int, fields[2::3]), dtype=int)
+
+
+def read_wordcat(wordcat_file):
+    """
+    Category of each single-sense word in a .wordcat file. Clusters only list words, so the senses of a word
+    with several can't be matched to those of another file: they are left out.
+    :return:    Dict word -> category label, and set of the words with several senses
+    """
+    categories = {}
+    ambiguous = set()
+    with open(wordcat_file, 'r') as fc:
+        text = fc.read()
+    for label, members in re.findall(r"Cluster #(-?\d+): \n\[(.*?)\]\n", text):
+        for word in members.split(", ")[:-1]:  # List ends with ", "
+            if word in categories:
+                ambiguous.add(word)
+            categories[word] = int(label)
+    for word in ambiguous:
+        del categories[word]
+    return categories, ambiguous
+
+
+def contingency(gold, pred, groups, num_groups):
+    """
+    Contingency table of each group of labels, as an array of shape (num_groups, pred labels, gold labels).
+    Labels are non-negative ints.
+    """
+    num_gold, num_pred = gold.max() + 1, pred.max() + 1
+    counts = np.bincount((groups * num_pred + pred) * num_gold + gold, minlength=num_groups * num_pred * num_gold)
+    return counts.reshape(num_groups, num_pred, num_gold).astype(np.float64)
+
+
+def entropy(counts, totals):
+    """
+    Entropy of the distribution of each row of counts (totals are the row sums)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probs = counts / totals[:, np.newaxis]
+        return -np.sum(np.where(counts > 0, probs * np.log(probs), 0), axis=1)
+
+
+def cluster_metrics(tables):
+    """
+    Clustering metrics of each contingency table (see contingency()), vectorized over tables
+    :return:    Dict metric -> array with the value for each table
+    """
+    num = tables.sum(axis=(1, 2))
+    pred_sizes, gold_sizes = tables.sum(axis=2), tables.sum(axis=1)
+
+    def pairs(x):
+        return x * (x - 1) / 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Adjusted Rand index; 1 when it is undefined (e.g. both labelings have a single cluster)
+        index = pairs(tables).sum(axis=(1, 2))
+        pred_pairs, gold_pairs = pairs(pred_sizes).sum(axis=1), pairs(gold_sizes).sum(axis=1)
+        expected = np.where(num > 1, pred_pairs * gold_pairs / pairs(num), 0)
+        max_index = (pred_pairs + gold_pairs) / 2
+        ari = np.where(max_index == expected, 1.0, (index - expected) / (max_index - expected))
+
+        # V-measure: harmonic mean of homogeneity and completeness
+        gold_entropy, pred_entropy = entropy(gold_sizes, num), entropy(pred_sizes, num)
+        joint = entropy(tables.reshape(len(tables), -1), num)
+        homogeneity = np.where(gold_entropy > 0, 1 - (joint - pred_entropy) / gold_entropy, 1.0)
+        completeness = np.where(pred_entropy > 0, 1 - (joint - gold_entropy) / pred_entropy, 1.0)
+        v_measure = np.where(homogeneity + completeness > 0,
+                             2 * homogeneity * completeness / (homogeneity + completeness), 0.0)
+
+        # F-score: best F1 of each gold class with any cluster, weighted by class size
+        f1 = np.nan_to_num(2 * tables / (pred_sizes[:, :, np.newaxis] + gold_sizes[:, np.newaxis, :]))
+        f_score = np.sum(gold_sizes * f1.max(axis=1), axis=1) / num
+
+        purity = tables.max(axis=2).sum(axis=1) / num
+    return {'ari': ari, 'v_measure': v_measure, 'f_score': f_score, 'purity': purity}
+
+
+def encode(labels):
+    """
+    Labels as consecutive non-negative ints (noise label -1 is a cluster of its own)
+    """
+    return np.unique(labels, return_inverse=True)[1].ravel()
+
+
+def evaluate_senses(gold_file, pred_files):
+    """
+    Scores disamb.pred files against a gold one, over the instances present in both. Metrics are computed for
+    each word, and averaged over words (as in SemEval word sense induction).
+    Outputs listing the instances in the same order as the gold file (e.g. the same corpus and threshold)
+    are aligned without any lookup.
+    """
+    gold_words, gold_instances, gold_labels = read_pred(gold_file)
+    gold_word_ids = encode(np.array(gold_words))
+    gold_index = None  # Position of each (word, instance) in the gold file, built if needed
+    results = []
+    for pred_file in pred_files:
+        words, instances, labels = read_pred(pred_file)
+        if words == gold_words and instances == gold_instances:
+            positions = np.arange(len(gold_labels))
+        else:
+            if gold_index is None:
+                gold_index = {key: i for i, key in enumerate(zip(gold_words, gold_instances))}
+            positions = np.array([gold_index.get(key, -1) for key in zip(words, instances)], dtype=int)
+            labels = labels[positions >= 0]
+            positions = positions[positions >= 0]
+        if len(positions) == 0:
+            results.append({'output': pred_file, 'items': 0})
+            continue
+        groups = encode(gold_word_ids[positions])  # One contingency table per word
+        num_words = groups.max() + 1
+        scores = cluster_metrics(contingency(encode(gold_labels[positions]), encode(labels), groups, num_words))
+        results.append({'output': pred_file, 'items': int(num_words),
+                        **{metric: float(np.mean(scores[metric])) for metric in METRICS}})
+    return results
+
+
+def evaluate_categories(gold_file, pred_files):
+    """
+    Scores .wordcat files against a gold one, over the words present in both with a single sense in each
+    (see read_wordcat()); words with several senses in either file are counted as skipped. All files are
+    scored together, as one contingency table per file.
+    """
+    gold, gold_ambiguous = read_wordcat(gold_file)
+    gold_words = gold.keys() | gold_ambiguous
+    all_gold, all_pred, groups, num_items, num_skipped = [], [], [], [], []
+    for group, pred_file in enumerate(pred_files):
+        pred, pred_ambiguous = read_wordcat(pred_file)
+        words = [word for word in gold if word in pred]
+        all_gold.extend(gold[word] for word in words)
+        all_pred.extend(pred[word] for word in words)
+        groups.extend([group] * len(words))
+        num_items.append(len(words))
+        shared_words = gold_words & (pred.keys() | pred_ambiguous)
+        num_skipped.append(len(shared_words & (gold_ambiguous | pred_ambiguous)))
+    if not groups:
+        return [{'output': pred_file, 'items': 0, 'skipped': num_skipped[i]}
+                for i, pred_file in enumerate(pred_files)]
+    scores = cluster_metrics(contingency(encode(all_gold), encode(all_pred), np.array(groups), len(pred_files)))
+    return [{'output': pred_file, 'items': num_items[i], 'skipped': num_skipped[i],
+             **({metric: float(scores[metric][i]) for metric in METRICS} if num_items[i] else {})}
+            for i, pred_file in enumerate(pred_files)]
+
+
+def print_table(results, sort_by=None):
+    if sort_by:
+        results = sorted(results, key=lambda r: r.get(sort_by, float('-inf')), reverse=True)
+    width = max(len('output'), *(len(r['output']) for r in results))
+    skipped = 'skipped' in results[0]  # Word categories: words left out for having several senses
+    print(f"{'output':{width}s}  {'items':>6s}  " + (f"{'skipped':>7s}  " if skipped else "") +
+          "  ".join(f"{metric:>9s}" for metric in METRICS))
+    for r in results:
+        print(f"{r['output']:{width}s}  {r['items']:6d}  " + (f"{r['skipped']:7d}  " if skipped else "") +
+              "  ".join(f"{r[metric]:9.4f}" if metric in r else f"{'-':>9s}" for metric in METRICS))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score disamb.pred or .wordcat outputs against gold ones')
+    parser.add_argument('--gold', type=str, required=True, help='Gold disamb.pred or .wordcat file')
+    parser.add_argument('--pred', type=str, nargs='+', required=True, help='Predicted files, of the same type')
+    parser.add_argument('--sort_by', type=str, default=None, help=f"Sort the table by: {', '.join(METRICS)}")
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the scores to')
+    args = parser.parse_args()
+
+    if args.sort_by not in (None,) + METRICS:
+        print(f"Metrics implemented are: {', '.join(METRICS)}")
+        exit(1)
+    if args.gold.endswith('.wordcat'):
+        scores = evaluate_categories(args.gold, args.pred)
+    else:
+        scores = evaluate_senses(args.gold, args.pred)
+    print_table(scores, args.sort_by)
+    if any(r.get('skipped') for r in scores):
+        print("Only words with a single sense in both files are scored; 'skipped' counts the words left out "
+              "for having several senses in either file")
+    if args.output:
+        with open(args.output, 'w') as fo:
+            json.dump({'gold': args.gold, 'results': scores}, fo, indent=2)
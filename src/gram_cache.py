@@ -0,0 +1,62 @@
+"""
+Cosine-distance matrices of each word's instances, for density-based clustering with metric='precomputed'
+(word_senser.py --precompute_distances). Sweeps over OPTICS/DBSCAN parameters cluster the same instances
+again and again, so the distances of each word are computed once, with one matrix product per block of
+rows, and kept in a least-recently-used cache bounded in memory.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import metrics
+from minibatch_spherical import unit_rows
+
+
+def cosine_distances(embeddings, block_size=2048):
+    """
+    Float32 matrix of cosine distances between all rows, computed block_size rows at a time so that frequent
+    words only need one block of temporary products on top of the result
+    """
+    embeddings = unit_rows(embeddings, dense=False)  # Sparse rows stay sparse
+    num_rows = embeddings.shape[0]
+    distances = np.empty((num_rows, num_rows), dtype=np.float32)
+    for start in range(0, num_rows, block_size):
+        gram = embeddings[start:start + block_size] @ embeddings.T
+        gram = gram.toarray() if hasattr(gram, 'toarray') else gram
+        distances[start:start + block_size] = 1 - gram
+    np.clip(distances, 0, 2, out=distances)  # Rounding errors
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+class GramCache:
+    def __init__(self, max_mb=1024, block_size=2048):
+        """
+        :param max_mb:      Memory bound of the cached matrices; least recently used ones are dropped first
+        :param block_size:  Rows per matrix product
+        """
+        self.max_bytes = max_mb * 2**20
+        self.block_size = block_size
+        self.matrices = OrderedDict()
+        self.nbytes = 0
+
+    def distances(self, key, get_embeddings):
+        """
+        Cosine distances between the embeddings identified by key
+        :param key:             Key of the embeddings, e.g. the word and its rows
+        :param get_embeddings:  Function returning the embeddings, if they are not cached
+        """
+        if key in self.matrices:
+            self.matrices.move_to_end(key)
+            metrics.count('cache_hits.gram_matrix')
+            return self.matrices[key]
+
+        metrics.count('cache_misses.gram_matrix')
+        distances = cosine_distances(get_embeddings(), self.block_size)
+        if distances.nbytes <= self.max_bytes:  # Larger ones are used once, and not cached
+            self.matrices[key] = distances
+            self.nbytes += distances.nbytes
+            while self.nbytes > self.max_bytes:
+                _, dropped = self.matrices.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+        return distances
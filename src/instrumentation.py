@@ -0,0 +1,201 @@
+"""
+Light-weight instrumentation for the pipeline scripts: counters (forward passes, tokens processed,
+cache hits), per-stage wall time and peak memory, levelled rate-limited logging, and an optional
+cProfile hook around each stage. Metrics are written to a JSON file at exit.
+"""
+import atexit
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+LOGGER_NAME = 'wordcat'
+
+
+def get_logger(name):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most one record every `interval` seconds for each message template,
+    so that logging calls inside hot loops don't flood the output.
+    Warnings and errors are never suppressed.
+    """
+    def __init__(self, interval=1.0):
+        super().__init__()
+        self.interval = interval
+        self.last_emitted = {}
+        self.suppressed = defaultdict(int)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.interval <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        last = self.last_emitted.get(key)
+        if last is not None and now - last < self.interval:
+            self.suppressed[key] += 1
+            return False
+        self.last_emitted[key] = now
+        return True
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # Reported in bytes on macOS, KB on Linux
+        peak /= 1024
+    return peak / 1024
+
+
+def memory_mb():
+    """
+    Current memory of this process, in MB: resident (rss), proportional share of pages shared with other
+    processes (pss), and pages private to it (private). Empty if /proc/self/smaps_rollup is not available.
+    """
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as fs:
+            fields = {line.split(':')[0]: int(line.split()[1]) for line in fs if line.rstrip().endswith('kB')}
+    except OSError:
+        return {}
+    return {'rss': fields['Rss'] / 1024,
+            'pss': fields['Pss'] / 1024,
+            'private': (fields['Private_Clean'] + fields['Private_Dirty']) / 1024}
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(int)  # Event counters, e.g. forward passes or cache hits
+        self.stages = {}  # Wall time and peak memory for each pipeline stage
+        self.profile_dir = None  # If set, each stage is run under cProfile and dumped here
+        self.info = {}  # Other run information, e.g. pipeline statistics
+        self.start_time = time.time()
+        self.lock = threading.Lock()  # Counters are updated by pipeline and server threads
+        self.cuda_peaks = []  # Peak CUDA memory of each open stage, before the resets of its nested stages
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def snapshot(self):
+        """
+        Copy of the counters, consistent while other threads count
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    @staticmethod
+    def _cuda():
+        """
+        Returns torch.cuda if torch is already loaded and CUDA is available. Never imports torch itself.
+        """
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            return torch.cuda
+        return None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager recording wall time and peak memory of a pipeline stage.
+        Repeated stages with the same name are accumulated. Nested stages reset the CUDA peak memory counter,
+        so the peak of the enclosing stages so far is carried over, and added back once the nested stage ends.
+        """
+        stats = self.stages.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'peak_rss_mb': 0.0, 'counters': {}})
+        counters_before = self.snapshot()
+        cuda = self._cuda()
+        if cuda is not None:
+            if self.cuda_peaks:
+                self.cuda_peaks[-1] = max(self.cuda_peaks[-1], cuda.max_memory_allocated())
+            cuda.reset_peak_memory_stats()
+            self.cuda_peaks.append(0)
+        profiler = cProfile.Profile() if self.profile_dir else None
+        get_logger('stages').debug("Entering stage '%s' (pid %d)", name, os.getpid())
+
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stats
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.{stats['calls']}.prof"))
+            stats['calls'] += 1
+            stats['wall_time'] += time.perf_counter() - start
+            stats['peak_rss_mb'] = max(stats['peak_rss_mb'], peak_rss_mb())
+            for counter, value in self.snapshot().items():  # Events that happened during this stage
+                delta = value - counters_before.get(counter, 0)
+                if delta:
+                    stats['counters'][counter] = stats['counters'].get(counter, 0) + delta
+            if cuda is not None:
+                peak = max(self.cuda_peaks.pop(), cuda.max_memory_allocated())
+                if self.cuda_peaks:  # The enclosing stage's peak includes this one
+                    self.cuda_peaks[-1] = max(self.cuda_peaks[-1], peak)
+                stats['peak_cuda_mb'] = max(stats.get('peak_cuda_mb', 0.0), peak / 2**20)
+            get_logger('stages').info("Stage '%s' finished in %.2fs (cumulative)", name, stats['wall_time'])
+
+    def to_dict(self):
+        stages = {}
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats)
+            if stats['wall_time'] > 0:  # Throughput of every counter active during the stage
+                stages[name]['rates_per_s'] = {k: v / stats['wall_time'] for k, v in stats['counters'].items()}
+        return {'pid': os.getpid(),
+                'argv': sys.argv,
+                'total_time': time.time() - self.start_time,
+                'peak_rss_mb': peak_rss_mb(),
+                'memory_mb': memory_mb(),
+                'counters': self.snapshot(),
+                'stages': stages,
+                'info': self.info}
+
+    def write(self, metrics_file):
+        with open(metrics_file, 'w') as fm:
+            json.dump(self.to_dict(), fm, indent=2)
+        print(f"Metrics written to {metrics_file}")
+
+
+metrics = Metrics()  # Process-wide metrics registry
+
+
+def setup(log_level='INFO', log_interval=1.0, metrics_file=None, profile_dir=None):
+    """
+    Configure logging and metrics export for a pipeline script.
+    :param log_level:       Logging level for the pipeline loggers
+    :param log_interval:    Min seconds between repeated INFO/DEBUG messages with the same template
+    :param metrics_file:    JSON file to write metrics to at exit (None to disable)
+    :param profile_dir:     Directory to dump one cProfile file per stage (None to disable)
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    handler.addFilter(RateLimitFilter(log_interval))
+    root = logging.getLogger(LOGGER_NAME)
+    root.handlers = [handler]
+    root.setLevel(log_level.upper())
+    root.propagate = False
+
+    metrics.profile_dir = profile_dir
+    if metrics_file:
+        atexit.register(metrics.write, metrics_file)
+
+
+def add_arguments(parser):
+    """
+    Add the instrumentation command-line options to an argparse parser
+    """
+    parser.add_argument('--log_level', type=str, default='INFO', help='Logging level: DEBUG, INFO, WARNING')
+    parser.add_argument('--log_interval', type=float, default=1.0,
+                        help='Min seconds between repeated progress messages (0 to log all)')
+    parser.add_argument('--metrics_file', type=str, default=None, help='JSON file to write run metrics to')
+    parser.add_argument('--profile_dir', type=str, default=None, help='Dump a cProfile file per stage here')
@@ -0,0 +1,39 @@
+"""
+Transforms for instance embeddings stored as log10 sentence probabilities (word_senser.py --log_space).
+Sentence probabilities of long sentences underflow when exponentiated, so such matrices keep the float32
+log-probabilities, and only turn them into unit vectors when they are clustered.
+"""
+import numpy as np
+
+TRANSFORMS = ('softmax', 'topk')
+
+
+def to_unit_vectors(log_probs, transform='softmax', temperature=1.0, top_k=None):
+    """
+    Turns log10-probability embeddings into unit vectors. Each row is exponentiated relative to its maximum,
+    so the largest entry is 1 and nothing underflows unless it is negligible next to it.
+    :param log_probs:       Array of shape (instances, dimensions), or a single embedding
+    :param transform:       'softmax': every entry, as exp(ln(10) * log_prob / temperature). With temperature 1
+                            this is the row of probabilities, up to scale, i.e. the same unit vector as the
+                            default probability embeddings (without their underflow)
+                            'topk': same, but only the top_k largest entries of each row are kept
+    :param temperature:     Values above 1 flatten the distribution, values below 1 sharpen it
+    :param top_k:           Nbr of entries kept by 'topk'
+    :return:                Float32 array of the same shape, with unit-norm rows
+    """
+    if transform not in TRANSFORMS:
+        raise ValueError(f"Unknown transform {transform}, use one of: {', '.join(TRANSFORMS)}")
+    if transform == 'topk' and not top_k:
+        raise ValueError("The topk transform needs top_k, the nbr of entries to keep per row")
+    log_probs = np.asarray(log_probs, dtype=np.float32)
+    single = log_probs.ndim == 1
+    log_probs = np.atleast_2d(log_probs)
+
+    scaled = log_probs * np.float32(np.log(10) / temperature)
+    embeddings = np.exp(scaled - scaled.max(axis=1, keepdims=True))
+    if transform == 'topk' and top_k < log_probs.shape[1]:
+        dropped = np.argpartition(-log_probs, top_k - 1, axis=1)[:, top_k:]
+        np.put_along_axis(embeddings, dropped, 0, axis=1)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    return embeddings[0] if single else embeddings
@@ -0,0 +1,109 @@
+"""
+Accuracy check for log-space embeddings (word_senser.py --log_space).
+Computes the instance log-probabilities of each corpus once, and stores them both as normalized float64
+probabilities (default) and as float32 log-probabilities. Reports the memory of both matrices, how many
+probability entries underflow, and how the word-sense clusters (KMeans, fixed seed) obtained with each
+log-space transform compare to those of the default matrix, and optionally to a reference disamb.pred.
+"""
+import argparse
+import contextlib
+import io
+import os
+
+import numpy as np
+
+from BertModel import BertLM
+from check_utils import compare_labels, sense_labels, summarize_ari, write_report
+from word_senser import WordSenseModel
+
+
+def read_predictions(pred_file):
+    """
+    Sense labels of each word, from a disamb.pred file
+    """
+    labels = {}
+    with open(pred_file, 'r') as fp:
+        for line in fp:
+            word, _, label = line.split()
+            labels.setdefault(word, []).append(int(label))
+    return labels
+
+
+def build_models(lang_mod, corpus_file, freq_threshold, batch_size=64):
+    """
+    WordSenseModels for corpus_file with the default and the log-space matrix, from a single computation
+    """
+    models = []
+    for log_space in (False, True):
+        wsd = WordSenseModel(lang_mod.tokenizer.name_or_path, use_cuda=lang_mod.use_cuda,
+                             freq_threshold=freq_threshold, batch_size=batch_size, log_space=log_space)
+        wsd.lang_mod = lang_mod
+        models.append(wsd)
+    probs_wsd, log_wsd = models
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        probs_wsd.get_vocabulary(corpus_file)
+    log_probs = probs_wsd.embed_instances([probs_wsd.sentences[i] for i in probs_wsd.unique_sents],
+                                          list(probs_wsd.vocab_map))
+    for wsd in models:
+        wsd.sentences, wsd.vocab_map, wsd.unique_sents = probs_wsd.sentences, probs_wsd.vocab_map, probs_wsd.unique_sents
+        wsd.matrix_info = {'log_space': wsd.log_space}
+        wsd.append_rows(log_probs)
+    return probs_wsd, log_wsd, np.array(log_probs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy of log-space embeddings against probability embeddings')
+    parser.add_argument('--pretrained', type=str, default='bert-large-uncased', help='Pretrained model to use')
+    parser.add_argument('--corpora', type=str, nargs='+', default=['sentences/smallWSD_corpus.txt'],
+                        help='Corpora to compare on')
+    parser.add_argument('--reference', type=str, default=None, help='Reference disamb.pred to compare to (e.g. '
+                                                                     'tests/smallWSD_KMeans_k2/disamb.pred)')
+    parser.add_argument('--temperatures', type=float, nargs='+', default=[1.0, 2.0], help='Softmax temperatures')
+    parser.add_argument('--top_ks', type=int, nargs='+', default=[10, 50], help='Entries kept by topk transforms')
+    parser.add_argument('--k', type=int, default=2, help='Number of KMeans clusters for the sense comparison')
+    parser.add_argument('--threshold', type=int, default=2, help='Min freq of word to be disambiguated')
+    parser.add_argument('--batch_size', type=int, default=64, help='Masked sentences per forward pass')
+    parser.add_argument('--save_to', type=str, default='log_check', help='Prefix for the disambiguation outputs')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the report to')
+    args = parser.parse_args()
+
+    lang_mod = BertLM(args.pretrained, use_cuda=False)
+    transforms = [('softmax', temp, None) for temp in args.temperatures]
+    transforms += [('topk', 1.0, top_k) for top_k in args.top_ks]
+    reference = read_predictions(args.reference) if args.reference else None
+
+    report = {'corpora': {}}
+    for corpus in args.corpora:
+        print(f"Comparing probability and log-space embeddings on {corpus}")
+        name = os.path.splitext(os.path.basename(corpus))[0]
+        probs_wsd, log_wsd, log_probs = build_models(lang_mod, corpus, args.threshold, args.batch_size)
+        probs_matrix = np.array(probs_wsd.matrix)
+        corpus_report = {'instances': len(probs_matrix),
+                         'dimensions': probs_matrix.shape[1],
+                         'probs_matrix_mb': sum(row.nbytes for row in probs_wsd.matrix) / 2**20,
+                         'log_matrix_mb': sum(row.nbytes for row in log_wsd.matrix) / 2**20,
+                         # Probabilities that are zero once exponentiated, and rows too small to be normalized
+                         'underflow_fraction_float64': float(np.mean(np.power(10., log_probs) == 0)),
+                         'underflow_fraction_float32': float(np.mean(np.power(np.float32(10), log_probs.astype(
+                             np.float32)) == 0)),
+                         'unnormalized_rows': int(np.sum(np.abs(np.linalg.norm(probs_matrix, axis=1) - 1) > 1e-6)),
+                         'transforms': {}}
+
+        ref_senses, _ = sense_labels(probs_wsd, f"{args.save_to}_{name}_probs", args.k)
+        if reference is not None:
+            common = {w: l for w, l in reference.items() if w in ref_senses and len(l) == len(ref_senses[w])}
+            corpus_report['probs_vs_reference'] = summarize_ari(compare_labels(common, ref_senses))
+
+        for transform, temperature, top_k in transforms:
+            label = f"{transform}_T{temperature}" + (f"_k{top_k}" if top_k else '')
+            log_wsd.transform, log_wsd.temperature, log_wsd.top_k = transform, temperature, top_k
+            test_senses, _ = sense_labels(log_wsd, f"{args.save_to}_{name}_{label}", args.k)
+            transform_report = summarize_ari(compare_labels(ref_senses, test_senses))
+            if reference is not None:
+                transform_report['vs_reference'] = summarize_ari(compare_labels(common, test_senses))
+            corpus_report['transforms'][label] = transform_report
+
+        report['corpora'][corpus] = corpus_report
+
+    write_report(report, args.output)
@@ -0,0 +1,135 @@
+"""
+Mini-batch spherical k-means (word_categorizer.py --clusterer MiniBatchSphericalKMeans).
+Clusters unit vectors by cosine similarity, reading the data in blocks of rows, so that it can cluster
+matrices larger than memory: memory-mapped arrays (see WordCategorizer.restructure_matrix) are only read one
+block at a time, and partial_fit() can be fed blocks from any other source.
+Each block moves the centroids towards the mean of the rows assigned to them, weighted by the nbr of rows
+each centroid has seen (online spherical k-means), and the centroids are re-normalized to unit length.
+"""
+import numpy as np
+
+
+def unit_rows(block, dense=True):
+    """
+    Float64 copy of a block of rows, normalized to unit length (zero rows are left as they are). Unlike
+    sklearn's normalize(), rows of tiny norm (e.g. of probability embeddings) are scaled too.
+    Shared by every module that needs unit rows (see also gram_cache.py).
+    :param dense:   Return sparse blocks as dense arrays; if False, as CSR matrices
+    """
+    if hasattr(block, 'toarray') and not dense:
+        block = block.tocsr().astype(np.float64)  # A copy
+        norms = np.sqrt(np.asarray(block.multiply(block).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        block.data /= np.repeat(norms, np.diff(block.indptr))
+        return block
+    block = block.toarray().astype(np.float64) if hasattr(block, 'toarray') else np.array(block, dtype=np.float64)
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return block / norms
+
+
+class MiniBatchSphericalKMeans:
+    def __init__(self, n_clusters=8, batch_size=1024, max_iter=10, tol=1e-4, reassignment_ratio=0.01,
+                 random_state=None):
+        """
+        :param n_clusters:      Nbr of clusters
+        :param batch_size:      Rows read and clustered at a time
+        :param max_iter:        Max passes over the data in fit()
+        :param tol:             fit() stops when no centroid moved more than this (1 - cosine) in a pass
+        :param reassignment_ratio:  Centroids that got fewer rows than this fraction of the largest count are
+                                    moved to the rows of the block farthest from their centroids (as in
+                                    sklearn's MiniBatchKMeans), so that clusters don't stay empty
+        :param random_state:    Seed for the initial centroids and the order of the blocks
+        """
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.tol = tol
+        self.reassignment_ratio = reassignment_ratio
+        self.random_state = random_state
+        self.rng = np.random.default_rng(random_state)
+        self.cluster_centers_ = None  # Unit-length centroids
+        self.counts_ = None  # Nbr of rows that updated each centroid
+        self.labels_ = None
+        self.n_iter_ = 0
+
+    def init_centroids(self, block):
+        """
+        k-means++ seeding on a block of unit rows, with cosine distances
+        """
+        num_rows = len(block)
+        if num_rows < self.n_clusters:
+            raise ValueError(f"Seeding block has {num_rows} rows, fewer than n_clusters={self.n_clusters}")
+        chosen = [self.rng.integers(num_rows)]
+        distances = 1 - block @ block[chosen[0]]
+        for _ in range(1, self.n_clusters):
+            weights = np.clip(distances, 0, None) ** 2
+            total = weights.sum()
+            new = self.rng.choice(num_rows, p=weights / total) if total > 0 else self.rng.integers(num_rows)
+            chosen.append(new)
+            distances = np.minimum(distances, 1 - block @ block[new])
+        self.cluster_centers_ = block[chosen].copy()
+        self.counts_ = np.zeros(self.n_clusters)
+
+    def partial_fit(self, X, sample_weight=None):
+        """
+        Updates the centroids with one block of rows
+        :param X:               Block of rows (array, memmap slice or sparse matrix)
+        :param sample_weight:   Optional weight of each row
+        """
+        block = unit_rows(X)
+        if self.cluster_centers_ is None:
+            self.init_centroids(block)
+        weights = np.ones(len(block)) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+        similarities = block @ self.cluster_centers_.T
+        labels = np.argmax(similarities, axis=1)
+
+        sums = np.zeros_like(self.cluster_centers_)
+        np.add.at(sums, labels, block * weights[:, np.newaxis])
+        block_counts = np.bincount(labels, weights=weights, minlength=self.n_clusters)
+        updated = block_counts > 0
+        # Weighted average of the current centroid (with the rows it has seen) and the new rows
+        centers = self.cluster_centers_[updated] * self.counts_[updated, np.newaxis] + sums[updated]
+        self.counts_ += block_counts
+        self.cluster_centers_[updated] = unit_rows(centers)
+
+        starved = np.flatnonzero(self.counts_ < self.reassignment_ratio * self.counts_.max())
+        if len(starved) > 0:
+            farthest = np.argsort(similarities[np.arange(len(block)), labels])[:len(starved)]
+            self.cluster_centers_[starved[:len(farthest)]] = block[farthest]
+            self.counts_[starved[:len(farthest)]] = np.min(self.counts_[self.counts_ > 0], initial=1)
+        return self
+
+    def blocks(self, num_rows, shuffle=False):
+        starts = np.arange(0, num_rows, self.batch_size)
+        if shuffle:
+            self.rng.shuffle(starts)
+        return [(start, min(start + self.batch_size, num_rows)) for start in starts]
+
+    def fit(self, X, sample_weight=None):
+        """
+        Clusters the rows of X, reading batch_size rows at a time, for up to max_iter passes (blocks in random
+        order) or until the centroids move less than tol. The centroids are seeded on batch_size rows sampled
+        from all of X, so that a short last block can't be the one seeded on.
+        """
+        num_rows = X.shape[0]
+        if self.cluster_centers_ is None:
+            sample = np.sort(self.rng.choice(num_rows, min(self.batch_size, num_rows), replace=False))
+            self.init_centroids(unit_rows(X[sample]))
+        for self.n_iter_ in range(1, self.max_iter + 1):
+            previous = None if self.cluster_centers_ is None else self.cluster_centers_.copy()
+            for start, end in self.blocks(num_rows, shuffle=True):
+                self.partial_fit(X[start:end], None if sample_weight is None else sample_weight[start:end])
+            if previous is not None and np.max(1 - np.sum(previous * self.cluster_centers_, axis=1)) < self.tol:
+                break
+        self.labels_ = self.predict(X)
+        return self
+
+    def predict(self, X):
+        """
+        Closest centroid (by cosine similarity) of each row of X, batch_size rows at a time
+        """
+        labels = np.empty(X.shape[0], dtype=int)
+        for start, end in self.blocks(X.shape[0]):
+            labels[start:end] = np.argmax(unit_rows(X[start:end]) @ self.cluster_centers_.T, axis=1)
+        return labels
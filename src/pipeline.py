@@ -0,0 +1,174 @@
+"""
+Producer/consumer executor overlapping batch construction, inference and post-processing.
+Three stages run in separate threads:
+  1. builder workers turn jobs (e.g. corpus sentences) into batches of token-id tensors,
+  2. the model thread runs the batches through the language model, as they fill a bounded queue,
+  3. a reducer thread collects each job's results and reduces them (e.g. into matrix rows), in job order.
+Torch releases the GIL during the forward pass, so building and reducing overlap with inference.
+"""
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from instrumentation import metrics
+
+
+class PipelinedExecutor:
+    def __init__(self, lang_mod, build_fn, reduce_fn, num_workers=2, queue_size=8):
+        """
+        :param lang_mod:    BertLM instance, used by the model thread
+        :param build_fn:    build_fn(job) -> (state, num_queries, batches), where batches is an iterable of
+                            (ids_batch, rows, positions, target_ids, query_idxs), as planned by QueryPlanner
+        :param reduce_fn:   reduce_fn(job_idx, state, log_probs), called in job order with the log10
+                            probability of each of the job's queries
+        :param num_workers: Nbr of builder threads
+        :param queue_size:  Max nbr of built batches waiting for the model
+        """
+        self.lang_mod = lang_mod
+        self.build_fn = build_fn
+        self.reduce_fn = reduce_fn
+        self.num_workers = max(1, num_workers)
+        self.queue_size = queue_size
+
+        self.busy_time = {'build': 0.0, 'model': 0.0, 'reduce': 0.0}  # Time each stage spent working
+        self.queue_depths = {'batches': [], 'results': []}  # Queue sizes sampled by their consumers
+        self.wall_time = 0.0
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add_busy(self, stage, seconds):
+        with self.lock:
+            self.busy_time[stage] += seconds
+
+    def fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+
+    def build_worker(self, jobs, batch_queue, result_queue):
+        try:
+            while self.error is None:
+                try:
+                    job_idx, job = jobs.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.perf_counter()
+                state, num_queries, batches = self.build_fn(job)
+                result_queue.put(('plan', job_idx, state, num_queries))
+                num_batches = 0
+                for ids_batch, rows, positions, target_ids, query_idxs in batches:
+                    built = (job_idx, torch.tensor(ids_batch), rows, positions, target_ids, query_idxs)
+                    self.add_busy('build', time.perf_counter() - start)
+                    batch_queue.put(built)  # Blocks while the model is behind
+                    num_batches += 1
+                    start = time.perf_counter()
+                result_queue.put(('built', job_idx, num_batches, None))
+                self.add_busy('build', time.perf_counter() - start)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            batch_queue.put(None)  # This worker is done
+
+    def model_worker(self, batch_queue, result_queue):
+        finished_workers = 0
+        while finished_workers < self.num_workers:
+            item = batch_queue.get()
+            self.queue_depths['batches'].append(batch_queue.qsize())
+            if item is None:
+                finished_workers += 1
+                continue
+            if self.error is not None:
+                continue  # Keep draining the queue, so that builders don't block
+            job_idx, ids_batch, rows, positions, target_ids, query_idxs = item
+            start = time.perf_counter()
+            try:
+                log_probs = self.lang_mod.get_batch_log_probs(ids_batch, positions, target_ids, rows=rows)
+                result_queue.put(('batch', job_idx, query_idxs, log_probs))
+            except Exception as e:
+                self.fail(e)
+            self.add_busy('model', time.perf_counter() - start)
+        result_queue.put(None)  # All batches processed
+
+    def reduce_worker(self, result_queue):
+        pending = {}  # job_idx -> [state, log_probs, nbr of batches built (once known), nbr of batch results]
+        next_job = 0
+        while True:
+            item = result_queue.get()
+            self.queue_depths['results'].append(result_queue.qsize())
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            start = time.perf_counter()
+            try:
+                kind, job_idx, data, extra = item
+                job = pending.setdefault(job_idx, [None, None, None, 0])
+                if kind == 'plan':
+                    job[0] = data
+                    job[1] = np.zeros(extra)
+                elif kind == 'built':
+                    job[2] = data
+                else:
+                    job[1][data] = extra
+                    job[3] += 1
+                # Reduce finished jobs, in order
+                while next_job in pending and pending[next_job][2] == pending[next_job][3]:
+                    state, log_probs, _, _ = pending.pop(next_job)
+                    self.reduce_fn(next_job, state, log_probs)
+                    next_job += 1
+            except Exception as e:
+                self.fail(e)
+            self.add_busy('reduce', time.perf_counter() - start)
+
+    def run(self, jobs):
+        """
+        Runs every job through the pipeline. Returns when all jobs have been reduced.
+        """
+        jobs = list(jobs)
+        job_queue = queue.Queue()
+        for job_idx, job in enumerate(jobs):
+            job_queue.put((job_idx, job))
+        batch_queue = queue.Queue(maxsize=self.queue_size)
+        result_queue = queue.Queue()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self.build_worker, args=(job_queue, batch_queue, result_queue),
+                                    name=f"builder-{i}", daemon=True) for i in range(self.num_workers)]
+        threads.append(threading.Thread(target=self.model_worker, args=(batch_queue, result_queue),
+                                        name='model', daemon=True))
+        reducer = threading.Thread(target=self.reduce_worker, args=(result_queue,), name='reducer', daemon=True)
+        for thread in threads + [reducer]:
+            thread.start()
+        for thread in threads + [reducer]:
+            thread.join()
+        self.wall_time += time.perf_counter() - start
+
+        if self.error is not None:
+            raise self.error
+        self.report()
+
+    def stats(self):
+        """
+        Stage utilization (fraction of the wall time each stage's threads were busy) and queue depths
+        """
+        wall_time = max(self.wall_time, 1e-9)
+        threads = {'build': self.num_workers, 'model': 1, 'reduce': 1}
+        return {'wall_time': self.wall_time,
+                'utilization': {stage: busy / (wall_time * threads[stage]) for stage, busy in self.busy_time.items()},
+                'queue_depth_mean': {name: float(np.mean(depths)) if depths else 0.0
+                                     for name, depths in self.queue_depths.items()},
+                'queue_depth_max': {name: int(np.max(depths)) if depths else 0
+                                    for name, depths in self.queue_depths.items()},
+                'batch_queue_size': self.queue_size,
+                'build_workers': self.num_workers}
+
+    def report(self):
+        stats = self.stats()
+        metrics.info['pipeline'] = stats
+        print("Pipeline stage utilization: " +
+              ", ".join(f"{stage} {util:.0%}" for stage, util in stats['utilization'].items()) +
+              f"; mean queue depth: batches {stats['queue_depth_mean']['batches']:.1f}/{self.queue_size}, "
+              f"results {stats['queue_depth_mean']['results']:.1f}")
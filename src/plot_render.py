@@ -0,0 +1,112 @@
+"""
+Background rendering of the word-instance plots of word_senser.py --plot. Disambiguation queues the
+embeddings and labels of each word, and returns at once; a render thread projects them to 2D (PCA, and t-SNE
+for small enough sets) and writes <plot_dir>/<word>.png with the Agg backend, so no display is needed.
+Large instance sets are subsampled before being queued. If the queue is full, the plot is dropped rather than
+making disambiguation wait.
+"""
+import os
+import queue
+import threading
+
+import numpy as np
+
+from instrumentation import metrics, get_logger
+
+logger = get_logger('plots')
+
+
+def subsample(embeddings, labels, max_points, seed=0):
+    """
+    At most max_points random rows of the embeddings (dense or sparse), in their original order, with their labels
+    """
+    num_rows = embeddings.shape[0]
+    if num_rows <= max_points:
+        return embeddings, np.asarray(labels)
+    keep = np.sort(np.random.default_rng(seed).choice(num_rows, max_points, replace=False))
+    return embeddings[keep], np.asarray(labels)[keep]
+
+
+class PlotRenderer:
+    def __init__(self, plot_dir, max_points=1000, tsne_max=500, queue_size=32):
+        """
+        :param plot_dir:    Directory to write the PNG files to
+        :param max_points:  Instances plotted per word, randomly sampled from larger sets
+        :param tsne_max:    Max instances for the t-SNE projection; larger sets only get the PCA one
+        :param queue_size:  Max plots waiting to be rendered; further plots are dropped
+        """
+        self.plot_dir = plot_dir
+        self.max_points = max_points
+        self.tsne_max = tsne_max
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        os.makedirs(plot_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.render_loop, name='plot-renderer', daemon=True)
+        self.thread.start()
+
+    def submit(self, word, embeddings, labels):
+        """
+        Queues the plot of a word's instances, without waiting
+        """
+        num_instances = embeddings.shape[0]
+        embeddings, labels = subsample(embeddings, labels, self.max_points)
+        if not hasattr(embeddings, 'toarray'):  # Halves the memory of queued plots; sparse rows are kept sparse
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+        try:
+            self.queue.put_nowait((word, embeddings, labels, num_instances))
+        except queue.Full:
+            self.dropped += 1
+            metrics.count('plots_dropped')
+            logger.debug("Plot queue full: dropped plot of \"%s\"", word)
+
+    def render_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.render(*item)
+                metrics.count('plots_rendered')
+            except Exception as e:  # Plots never stop disambiguation
+                logger.warning("Plot of \"%s\" failed: %s", item[0], e)
+
+    def render(self, word, embeddings, labels, num_instances):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        from sklearn.decomposition import PCA
+
+        if hasattr(embeddings, 'toarray'):
+            embeddings = embeddings.toarray()
+        embeddings = embeddings.astype(np.float64)  # Squares of probability embeddings underflow in float32
+        num_points = len(embeddings)
+        pca = PCA(n_components=min(2, num_points, embeddings.shape[1]))
+        pca_result = pca.fit_transform(embeddings)
+        if pca_result.shape[1] < 2:
+            pca_result = np.hstack([pca_result, np.zeros((num_points, 2 - pca_result.shape[1]))])
+        panels = [(f"PCA (explained variance {np.sum(pca.explained_variance_ratio_):.2f})", pca_result)]
+
+        if 3 < num_points <= self.tsne_max:
+            from sklearn.manifold import TSNE
+            iterations = 'max_iter' if 'max_iter' in TSNE().get_params() else 'n_iter'  # Renamed in sklearn 1.5
+            tsne = TSNE(n_components=2, perplexity=min(40, (num_points - 1) / 3), init='pca', random_state=0,
+                        **{iterations: 300})
+            panels.append(("t-SNE", tsne.fit_transform(embeddings)))
+
+        figure = Figure(figsize=(6, 5 * len(panels)))
+        FigureCanvasAgg(figure)
+        for i, (title, points) in enumerate(panels):
+            ax = figure.add_subplot(len(panels), 1, i + 1)
+            ax.scatter(points[:, 0], points[:, 1], c=labels, s=10)
+            ax.set_title(title)
+        sampled = f" ({num_points} of {num_instances} instances)" if num_points < num_instances else ""
+        figure.suptitle(word + sampled)
+        figure.savefig(os.path.join(self.plot_dir, word + '.png'))
+
+    def close(self):
+        """
+        Waits for the queued plots to be rendered
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped:
+            print(f"{self.dropped} plots were dropped (queue full); raise --plot_queue to keep them")
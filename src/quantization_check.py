@@ -0,0 +1,87 @@
+"""
+Accuracy check for reduced-precision inference (int8 dynamic quantization, bf16 autocast).
+Compares sentence log-probabilities and the resulting word-sense clusters (disamb.pred) of the reduced
+precision model against the fp32 model, on the given corpora.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from BertModel import BertLM
+from check_utils import compare_labels, sense_labels, summarize_ari, write_report
+from word_senser import WordSenseModel
+
+
+def sentence_log_probs(lang_mod, corpus_file, batch_size=64):
+    """
+    Log10 directional probability of every sentence in corpus_file
+    """
+    with open(corpus_file, 'r') as fc:
+        sentences = [lang_mod.tokenizer.convert_tokens_to_ids(lang_mod.tokenize_sent(sent))
+                     for sent in fc if sent.strip() != '']
+    log_probs = np.zeros(len(sentences))
+    buckets = {}
+    for sent_nbr, ids_input in enumerate(sentences):
+        buckets.setdefault(len(ids_input), []).append(sent_nbr)
+    for sent_nbrs in buckets.values():
+        log_probs[sent_nbrs] = lang_mod.get_sentences_log_probs([sentences[i] for i in sent_nbrs], batch_size)
+    return log_probs
+
+
+def build_model(lang_mod, corpus_file, freq_threshold):
+    """
+    WordSenseModel for corpus_file, with its matrix computed by lang_mod
+    """
+    wsd = WordSenseModel(lang_mod.tokenizer.name_or_path, use_cuda=lang_mod.use_cuda, freq_threshold=freq_threshold)
+    wsd.lang_mod = lang_mod
+    wsd.get_vocabulary(corpus_file)
+    wsd.calculate_matrix()
+    return wsd
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy drift of quantized/bf16 inference against fp32')
+    parser.add_argument('--pretrained', type=str, default='bert-large-uncased', help='Pretrained model to use')
+    parser.add_argument('--corpora', type=str, nargs='+', default=['sentences/smallWSD_corpus.txt'],
+                        help='Corpora to compare on')
+    parser.add_argument('--quantize', type=str, default='int8', help='Quantization mode to check: none, int8')
+    parser.add_argument('--quantized_path', type=str, default=None, help='File to save/reload the quantized model')
+    parser.add_argument('--bf16', action='store_true', help='Check bfloat16 autocast')
+    parser.add_argument('--skip_clusters', action='store_true', help='Only compare sentence log-probs')
+    parser.add_argument('--k', type=int, default=2, help='Number of KMeans clusters for the sense comparison')
+    parser.add_argument('--threshold', type=int, default=2, help='Min freq of word to be disambiguated')
+    parser.add_argument('--batch_size', type=int, default=64, help='Masked sentences per forward pass')
+    parser.add_argument('--save_to', type=str, default='quant_check', help='Prefix for the disambiguation outputs')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the report to')
+    args = parser.parse_args()
+
+    fp32_mod = BertLM(args.pretrained, use_cuda=False)
+    reduced_mod = BertLM(args.pretrained, use_cuda=False, quantize=args.quantize, bf16=args.bf16,
+                         quantized_path=args.quantized_path)
+    mode = f"{args.quantize}{'+bf16' if args.bf16 else ''}"
+
+    report = {'mode': mode, 'corpora': {}}
+    for corpus in args.corpora:
+        print(f"Comparing fp32 and {mode} on {corpus}")
+        ref_lp = sentence_log_probs(fp32_mod, corpus, args.batch_size)
+        test_lp = sentence_log_probs(reduced_mod, corpus, args.batch_size)
+        drift = np.abs(test_lp - ref_lp)
+        corpus_report = {'sentences': len(ref_lp),
+                         'log_prob_mean_abs_drift': float(np.mean(drift)),
+                         'log_prob_max_abs_drift': float(np.max(drift)),
+                         'log_prob_rel_drift': float(np.mean(drift / np.abs(ref_lp)))}
+
+        if not args.skip_clusters:
+            name = os.path.splitext(os.path.basename(corpus))[0]
+            ref_senses, _ = sense_labels(build_model(fp32_mod, corpus, args.threshold),
+                                         f"{args.save_to}_{name}_fp32", args.k)
+            test_senses, _ = sense_labels(build_model(reduced_mod, corpus, args.threshold),
+                                          f"{args.save_to}_{name}_{mode}", args.k)
+            word_ari = compare_labels(ref_senses, test_senses)
+            corpus_report['disambiguated_words'] = len(word_ari)
+            corpus_report.update(summarize_ari(word_ari))
+
+        report['corpora'][corpus] = corpus_report
+
+    write_report(report, args.output)
@@ -0,0 +1,100 @@
+"""
+Forward-pass planner for sentence probability estimation.
+A directional sentence probability (see BertLM.get_sentence_prob_directional) needs one masked prediction
+per token and direction. When many sentences share tokens, e.g. the same sentence with a blank filled by
+every vocabulary word, or with blanks at different positions, a lot of those masked sequences are
+identical: the fully masked sentence only depends on its length, forward prefixes with everything to their
+right masked don't depend on the blank filler, and so on.
+The planner first collects every (masked sequence, position, target) query, deduplicates the sequences,
+runs each unique sequence through the model once (reading all its queried positions), and then fans the
+log-probabilities back out to the sentences that requested them.
+"""
+import numpy as np
+
+from instrumentation import metrics
+
+
+class QueryPlanner:
+    def __init__(self, mask_id):
+        self.mask_id = mask_id
+        self.sequences = {}  # Unique masked sequences (tuples of token ids), mapped to their index
+        self.queries = {}  # Unique (sequence index, position, target id) queries, mapped to their index
+        self.requested = 0  # Nbr of queries requested, before deduplication
+
+    def add_query(self, masked_ids, position, target_id):
+        """
+        Registers the prediction of target_id at position of masked_ids.
+        :return:    Index of the query in the array returned by run()
+        """
+        self.requested += 1
+        seq_idx = self.sequences.setdefault(tuple(masked_ids), len(self.sequences))
+        return self.queries.setdefault((seq_idx, position, target_id), len(self.queries))
+
+    def add_sentence(self, ids_input):
+        """
+        Registers all forward and backwards queries needed for the directional probability of a sentence.
+        :param ids_input:   Token ids of the sentence, including boundary tokens
+        :return:            Array with the query indexes of the sentence. The log10 of its directional
+                            probability is 0.5 * sum(log_probs[indexes]), with log_probs returned by run()
+        """
+        query_ids = []
+        sent_len = len(ids_input)
+        for i in range(1, sent_len - 1):  # Don't loop first and last tokens
+            forward_ids = list(ids_input[:i]) + [self.mask_id] * (sent_len - 1 - i) + [ids_input[-1]]
+            query_ids.append(self.add_query(forward_ids, i, ids_input[i]))
+            backwards_ids = [ids_input[0]] + [self.mask_id] * i + list(ids_input[i + 1:])
+            query_ids.append(self.add_query(backwards_ids, i, ids_input[i]))
+        return np.array(query_ids, dtype=int)
+
+    @property
+    def dedupe_ratio(self):
+        """
+        Nbr of masked sequences requested per forward pass actually run
+        """
+        return self.requested / max(1, len(self.sequences))
+
+    def plan_batches(self, batch_size=64):
+        """
+        Groups the unique masked sequences into batches of equal-length sequences.
+        :param batch_size:  Max nbr of sequences per batch
+        :return:            Generator of (ids_batch, rows, positions, target_ids, query_idxs) tuples, with the
+                            arguments for BertLM.get_batch_log_probs() and the query index of each result
+        """
+        # Group the queries by sequence, and the sequences by length
+        seq_queries = [[] for _ in range(len(self.sequences))]
+        for (seq_idx, position, target_id), query_idx in self.queries.items():
+            seq_queries[seq_idx].append((position, target_id, query_idx))
+        by_length = {}
+        for masked_ids, seq_idx in self.sequences.items():
+            by_length.setdefault(len(masked_ids), []).append((masked_ids, seq_idx))
+
+        for length_seqs in by_length.values():
+            for start in range(0, len(length_seqs), batch_size):
+                ids_batch, rows, positions, target_ids, query_idxs = [], [], [], [], []
+                for row, (masked_ids, seq_idx) in enumerate(length_seqs[start:start + batch_size]):
+                    ids_batch.append(masked_ids)
+                    for position, target_id, query_idx in seq_queries[seq_idx]:
+                        rows.append(row)
+                        positions.append(position)
+                        target_ids.append(target_id)
+                        query_idxs.append(query_idx)
+                yield ids_batch, rows, positions, target_ids, query_idxs
+
+    def run(self, lang_mod, batch_size=64):
+        """
+        Runs each unique masked sequence through lang_mod once, in batches of equal-length sequences.
+        :param lang_mod:    BertLM instance
+        :param batch_size:  Max nbr of sequences per forward pass
+        :return:            Numpy array with the log10 probability of each query
+        """
+        log_probs = np.zeros(len(self.queries))
+        for ids_batch, rows, positions, target_ids, query_idxs in self.plan_batches(batch_size):
+            log_probs[query_idxs] = lang_mod.get_batch_log_probs(ids_batch, positions, target_ids, rows=rows)
+        return log_probs
+
+    def count_metrics(self):
+        """
+        Adds the planned queries and unique sequences to the run metrics
+        """
+        metrics.count('planned_queries', self.requested)
+        metrics.count('unique_sequences', len(self.sequences))
@@ -0,0 +1,139 @@
+"""
+Dimensionality reduction of the vectors to cluster (word_senser.py and word_categorizer.py --reduce).
+Both pipelines cluster vectors with one dimension per vocabulary word (instances) or per instance (word
+senses), so distance computations dominate clustering. The projection is fitted and applied in chunks of
+rows, so the dense matrix is never built, and the projected matrix can be cached on disk to be reused by
+parameter sweeps.
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+REDUCERS = ('pca', 'random_projection')
+
+
+def row_chunks(num_rows, chunk_size, min_size=1):
+    """
+    (start, end) of consecutive chunks of rows; a last chunk smaller than min_size is merged into the previous
+    """
+    bounds = list(range(0, num_rows, chunk_size)) + [num_rows]
+    if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_size:
+        del bounds[-2]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def dense(chunk):
+    return chunk.toarray() if hasattr(chunk, 'toarray') else np.asarray(chunk)
+
+
+def total_variance(chunks):
+    """
+    Sum of the variances of all columns, from the row chunks of a matrix
+    """
+    num_rows, sq_sum, col_sum = 0, 0., 0.
+    for chunk in chunks:
+        chunk = dense(chunk)
+        num_rows += len(chunk)
+        sq_sum += float(np.sum(np.square(chunk, dtype=np.float64)))
+        col_sum = col_sum + chunk.sum(axis=0, dtype=np.float64)
+    return sq_sum / num_rows - float(np.sum(np.square(col_sum / num_rows)))
+
+
+def matrix_digest(get_rows, num_rows, chunk_size):
+    """
+    SHA-1 digest of all the rows of a matrix (values, dtype and sparse structure), read by chunks
+    """
+    digest = hashlib.sha1()
+    for start, end in row_chunks(num_rows, chunk_size):
+        rows = get_rows(start, end)
+        if hasattr(rows, 'tocsr'):
+            rows = rows.tocsr()
+            parts = (rows.data, rows.indices, rows.indptr)
+        else:
+            parts = (np.asarray(rows),)
+        for part in parts:
+            digest.update(str(part.dtype).encode())
+            digest.update(np.ascontiguousarray(part).data)
+    return digest.hexdigest()
+
+
+def load_cache(cache_file, key):
+    """
+    Projected matrix and its report from cache_file, if it was computed with the same key
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return None, None
+    with np.load(cache_file) as data:
+        info = json.loads(str(data['info']))
+        if info.get('key') != key:
+            print(f"Reduction cache {cache_file} is for a different matrix or setting; recomputing it")
+            return None, None
+        return data['reduced'], info
+
+
+def reduce_rows(get_rows, num_rows, method='pca', n_components=100, chunk_size=1000, cache_file=None,
+                random_state=0):
+    """
+    Projects the rows of a matrix to n_components dimensions, fitting and transforming them by chunks.
+    :param get_rows:        Function (start, end) -> rows of the matrix, dense or sparse
+    :param num_rows:        Nbr of rows in the matrix
+    :param method:          'pca': IncrementalPCA, fitted with partial_fit on each chunk
+                            'random_projection': SparseRandomProjection, fitted on the nbr of columns only
+    :param n_components:    Dimensions to keep (at most the nbr of rows or columns)
+    :param chunk_size:      Rows per chunk
+    :param cache_file:      .npz file to reuse the projected matrix from, or save it to
+    :param random_state:    Seed of the random projection
+    :return:                Array of shape (num_rows, n_components), and a report with the variance
+                            explained by the projection and the time taken
+    """
+    if method not in REDUCERS:
+        raise ValueError(f"Unknown reduction {method}, use one of: {', '.join(REDUCERS)}")
+    if cache_file and not cache_file.endswith('.npz'):
+        cache_file += '.npz'  # As saved by np.savez
+    first_rows = get_rows(0, min(num_rows, chunk_size))
+    num_columns = first_rows.shape[1]
+    n_components = min(n_components, num_rows, num_columns)
+    key = {'method': method, 'n_components': n_components, 'shape': [num_rows, num_columns],
+           'random_state': random_state}
+    if cache_file:  # Identifies the matrix by the digest of all its rows, so that any change is detected
+        key['digest'] = matrix_digest(get_rows, num_rows, chunk_size)
+    reduced, info = load_cache(cache_file, key)
+    if reduced is not None:
+        print(f"Projected matrix loaded from {cache_file}")
+        return reduced, info
+
+    start_time = time.perf_counter()
+    chunks = row_chunks(num_rows, max(chunk_size, n_components), min_size=n_components)  # As IncrementalPCA needs
+    if method == 'pca':
+        from sklearn.decomposition import IncrementalPCA
+        projection = IncrementalPCA(n_components=n_components)
+        for start, end in chunks:
+            projection.partial_fit(dense(get_rows(start, end)))
+    else:
+        from sklearn.random_projection import SparseRandomProjection
+        projection = SparseRandomProjection(n_components=n_components, dense_output=True,
+                                            random_state=random_state)
+        projection.fit(first_rows)  # Only depends on the nbr of columns
+
+    # Same precision as the rows: components of float64 rows can differ by less than float32 resolution
+    reduced = np.empty((num_rows, n_components), dtype=np.result_type(first_rows.dtype, np.float32))
+    for start, end in chunks:
+        rows = get_rows(start, end)
+        reduced[start:end] = projection.transform(rows if method == 'random_projection' else dense(rows))
+
+    if method == 'pca':
+        explained = float(np.sum(projection.explained_variance_ratio_))
+    else:  # Variance kept by the projection, relative to that of the original columns
+        explained = total_variance([reduced]) / total_variance(get_rows(start, end) for start, end in chunks)
+    info = {'key': key, 'method': method, 'n_components': n_components, 'original_dims': num_columns,
+            'explained_variance': explained, 'fit_time': time.perf_counter() - start_time}
+    print(f"Reduced {num_rows} rows from {num_columns} to {n_components} dimensions with {method} "
+          f"(explained variance {explained:.3f}) in {info['fit_time']:.2f}s")
+
+    if cache_file:
+        np.savez(cache_file, reduced=reduced, info=json.dumps(info))
+        print(f"Projected matrix stored in {cache_file}")
+    return reduced, info
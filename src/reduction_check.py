@@ -0,0 +1,82 @@
+"""
+Effect of the dimensionality reduction (--reduce) on clustering, from a stored matrix (word_senser.py
+--pickle_emb) and optionally its sense centroids (--pickle_cent), without running the language model.
+For each reduction method and nbr of dimensions, reports the explained variance, the clustering time, and
+how the KMeans clusters (fixed seed) of the projected vectors agree with those of the original vectors:
+word senses (mean adjusted Rand index over disambiguated words), and word categories.
+"""
+import argparse
+import contextlib
+import io
+import os
+import time
+
+from sklearn.metrics import adjusted_rand_score
+
+from check_utils import compare_labels, sense_labels, summarize_ari, write_report
+from instrumentation import metrics
+from word_categorizer import WordCategorizer
+from word_senser import WordSenseModel
+
+
+def category_labels(wc, k):
+    start = time.perf_counter()
+    wc.cluster_words(clust_method='KMeans', k=k, random_state=0)  # Same initialization for every projection
+    return wc.estimator.labels_, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Effect of dimensionality reduction on word sense and word '
+                                                 'category clusters')
+    parser.add_argument('--pickle_emb', type=str, required=True, help='Pickle file with the embeddings matrix')
+    parser.add_argument('--pickle_cent', type=str, default=None, help='Sense centroids, to check word categories '
+                                                                      'of the restructured matrix')
+    parser.add_argument('--methods', type=str, nargs='+', default=['pca', 'random_projection'],
+                        help='Reduction methods to check')
+    parser.add_argument('--dims', type=int, nargs='+', default=[10, 50, 100], help='Dimensions to keep')
+    parser.add_argument('--k', type=int, default=2, help='Number of KMeans clusters for word senses')
+    parser.add_argument('--cat_k', type=int, default=10, help='Number of KMeans clusters for word categories')
+    parser.add_argument('--threshold', type=int, default=2, help='Min freq of word to be disambiguated')
+    parser.add_argument('--save_to', type=str, default='reduce_check', help='Prefix for the disambiguation outputs')
+    parser.add_argument('--output', type=str, default=None, help='JSON file to write the report to')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.pickle_emb):
+        print(f"ERROR: Matrix {args.pickle_emb} not found; compute it with word_senser.py first")
+        exit(1)
+    wsd = WordSenseModel(None, use_cuda=False, freq_threshold=args.threshold)
+    wsd.load_matrix(args.pickle_emb, None)
+    ref_senses, ref_time = sense_labels(wsd, f"{args.save_to}_none", args.k)
+
+    wc = WordCategorizer()
+    with contextlib.redirect_stdout(io.StringIO()):
+        wc.load_matrix(args.pickle_emb)
+        if args.pickle_cent:
+            wc.load_centroids(args.pickle_cent)
+            wc.restructure_matrix()
+        else:
+            wc.wsd_matrix = wc.weight_rows(wc.matrix)
+    ref_categories, ref_cat_time = category_labels(wc, args.cat_k)
+
+    report = {'matrix': args.pickle_emb, 'senses': {'none': {'cluster_time': ref_time}},
+              'categories': {'none': {'cluster_time': ref_cat_time}}}
+    for method in args.methods:
+        for dims in args.dims:
+            label = f"{method}_{dims}"
+            print(f"Checking {label}")
+            wsd.reduce, wsd.reduce_dims, wsd.reduced = method, dims, None
+            test_senses, test_time = sense_labels(wsd, f"{args.save_to}_{label}", args.k)
+            sense_report = summarize_ari(compare_labels(ref_senses, test_senses))
+            # The cluster time includes fitting the projection
+            sense_report.update(cluster_time=test_time, reduction=dict(metrics.info['reduction']))
+            report['senses'][label] = sense_report
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                wc.reduce_senses(method, dims)
+            cat_report = dict(metrics.info['reduction'])
+            test_categories, test_cat_time = category_labels(wc, args.cat_k)
+            cat_report.update(cluster_time=test_cat_time, ari=adjusted_rand_score(ref_categories, test_categories))
+            report['categories'][label] = cat_report
+            wc.reduced = None
+
+    write_report(report, args.output)
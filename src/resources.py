@@ -0,0 +1,156 @@
+"""
+Thread budget of a pipeline process, so that several processes can share a node without oversubscribing its
+cores. The budget comes from --threads, else the WORDCAT_THREADS environment variable, else the CPUs this
+process may run on, and sets consistently:
+  - torch intra-op threads (the budget, minus the pipeline builder workers) and inter-op threads (1: inference
+    runs one op at a time), once a language model is loaded (see setup_torch()), so that runs without one
+    don't import torch,
+  - the BLAS and OpenMP thread pools of numpy, scipy and sklearn (through threadpoolctl, if installed), and the
+    environment variables read by the pools of child processes (e.g. joblib workers): the budget split among
+    the n_jobs workers, so that workers x pool threads stay within the budget,
+  - the n_jobs of the clustering estimators.
+Worker pools take their size from the same budget (see ThreadBudget.workers()). The effective settings are
+reported at startup, and stored in the run metrics.
+"""
+import os
+
+from instrumentation import metrics, get_logger
+
+ENV_VAR = 'WORDCAT_THREADS'
+POOL_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+logger = get_logger('resources')
+
+
+def available_cpus():
+    """
+    Nbr of CPUs this process may run on (its affinity mask, e.g. as set by taskset or a batch scheduler)
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on macOS
+        return os.cpu_count() or 1
+
+
+class ThreadBudget:
+    def __init__(self, threads=None):
+        """
+        :param threads:     Max threads of the process (None: WORDCAT_THREADS, else all available CPUs)
+        """
+        self.threads, self.source = None, None
+        self.reserved = 0  # Threads of worker pools, taken out of the torch intra-op threads
+        self.torch_applied = False  # Torch threads are set once, by the first language model loaded
+        self.set(threads)
+
+    def set(self, threads=None):
+        self.threads, self.source = self.resolve(threads)
+        self.reserved = 0
+        self.torch_applied = False
+
+    @staticmethod
+    def resolve(threads):
+        if threads is not None:
+            source = '--threads'
+        elif os.environ.get(ENV_VAR):
+            threads, source = os.environ[ENV_VAR], ENV_VAR
+        else:
+            threads, source = available_cpus(), 'available CPUs'
+        try:
+            value = int(threads)
+        except ValueError:
+            value = 0
+        if value < 1:
+            print(f"ERROR: Thread budget from {source} must be a positive integer, got {threads}")
+            exit(1)
+        return value, source
+
+    @property
+    def n_jobs(self):
+        """
+        n_jobs of the clustering estimators
+        """
+        return self.threads
+
+    @property
+    def pool_threads(self):
+        """
+        BLAS/OpenMP threads of each child process of the estimators (e.g. joblib workers)
+        """
+        return max(1, self.threads // self.n_jobs)
+
+    def workers(self, requested=-1, max_workers=4):
+        """
+        Size of a worker pool, reserved from the budget. A negative request derives it from the budget: a quarter
+        of the threads, at most max_workers and at least 1; other requests are kept as they are.
+        """
+        if requested < 0:
+            requested = max(1, min(max_workers, self.threads // 4))
+        self.reserved += requested
+        return requested
+
+    @property
+    def torch_threads(self):
+        return max(1, self.threads - self.reserved)
+
+
+budget = ThreadBudget()  # Process-wide budget, configured by setup()
+
+
+def setup(threads=None, pipeline_workers=0):
+    """
+    Applies the thread budget to this process and its future child processes, and reports it. Torch threads
+    are only set when a language model is loaded (see setup_torch()).
+    :param threads:             --threads value (None: WORDCAT_THREADS, else all available CPUs)
+    :param pipeline_workers:    Builder workers of the matrix pipeline (negative: derived from the budget)
+    :return:                    Nbr of pipeline workers
+    """
+    budget.set(threads)
+    pipeline_workers = budget.workers(pipeline_workers) if pipeline_workers != 0 else 0
+
+    for var in POOL_ENV_VARS:  # Pools of child processes (e.g. joblib workers) are created with these
+        os.environ[var] = str(budget.pool_threads)
+    report = {'threads': budget.threads, 'source': budget.source, 'n_jobs': budget.n_jobs,
+              'child_pool_threads': budget.pool_threads, 'pipeline_workers': pipeline_workers}
+
+    try:
+        from threadpoolctl import threadpool_info, threadpool_limits
+    except ImportError:
+        logger.warning("threadpoolctl is not installed: BLAS thread pools of this process keep their defaults")
+    else:
+        threadpool_limits(limits=budget.threads)
+        report['thread_pools'] = [f"{pool['internal_api']}:{pool['num_threads']}" for pool in threadpool_info()]
+
+    metrics.info['resources'] = report
+    print(f"Thread budget: {budget.threads} ({budget.source})" +
+          (f", pipeline workers {pipeline_workers}" if pipeline_workers else "") +
+          f", n_jobs {budget.n_jobs}, child process pools {budget.pool_threads}" +
+          (f", pools {' '.join(report['thread_pools'])}" if report.get('thread_pools') else ""))
+    return pipeline_workers
+
+
+def setup_torch():
+    """
+    Sets the torch threads of the budget, once per process. Called when a language model is loaded.
+    """
+    if budget.torch_applied:
+        return
+    import torch
+    torch.set_num_threads(budget.torch_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:  # Only possible before torch runs any parallel work
+        logger.warning("Torch inter-op threads were already set")
+    budget.torch_applied = True
+    report = {'torch_threads': torch.get_num_threads(), 'torch_interop_threads': torch.get_num_interop_threads()}
+    metrics.info.setdefault('resources', {}).update(report)
+    print(f"Torch threads: {report['torch_threads']} intra-op / {report['torch_interop_threads']} inter-op")
+
+
+def add_arguments(parser):
+    """
+    Add the thread budget option to an argparse parser
+    """
+    parser.add_argument('--threads', type=int, default=None, help=f"Max threads of the process: torch, BLAS and "
+                                                                  f"clustering (default: ${ENV_VAR}, else all "
+                                                                  f"available CPUs)")
@@ -0,0 +1,372 @@
+"""
+Local sentence-probability scoring server.
+Holds a single BertLM in memory, so that several tools can share one copy of the model, and serves
+directional sentence log10-probabilities (see BertLM.get_sentence_prob_directional) over HTTP on localhost.
+Concurrent requests are merged into micro-batches: the first waiting request opens a batch, which is run
+once it holds max_batch sentences or max_latency seconds have passed. The sentences of a micro-batch are
+planned together by a QueryPlanner, so masked sequences shared between requests only run once (the planner
+is run and emptied every max_plan_queries queries, to bound its memory), and scores are kept in a cache
+shared by all clients.
+
+Endpoints (JSON bodies):
+    GET  /info      Model served, and micro-batching settings
+    GET  /stats     Request, micro-batch and cache counters
+    POST /score     {"sentences": [text, ...]} or {"ids": [[token ids], ...]}  ->  {"log_probs": [...]}
+    POST /fill      {"sentence": "the ___ sat", "fillers": [text, ...], "blank": "___"}  ->  {"log_probs": [...]}
+                    {"blanks": [[left ids, right ids], ...], "filler_ids": [[ids], ...]}
+                        ->  {"log_probs": [[per filler] per blank]}
+
+ScoreClient wraps the endpoints, and can replace the in-process language model of WordSenseModel.
+
+Example:
+    python src/score_server.py --pretrained bert-large-uncased --port 8765
+    python src/word_senser.py --corpus sentences/smallWSD_corpus.txt --score_server http://127.0.0.1:8765
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import instrumentation
+import resources
+from instrumentation import metrics, get_logger
+from query_planner import QueryPlanner
+
+logger = get_logger('server')
+
+
+class ScoreRequest:
+    """
+    Sentences (as token ids) waiting to be scored, and the event their handler thread waits on
+    """
+    def __init__(self, sentences_ids):
+        self.sentences_ids = [tuple(ids) for ids in sentences_ids]
+        self.log_probs = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ScoreServer:
+    def __init__(self, lang_mod, batch_size=64, max_batch=256, max_latency=0.01, cache_size=100000,
+                 max_plan_queries=200000):
+        """
+        :param lang_mod:        BertLM instance to serve
+        :param batch_size:      Max masked sequences per forward pass
+        :param max_plan_queries:    Max queries planned at a time; larger micro-batches are run in parts
+        :param max_batch:       Max sentences merged into one micro-batch
+        :param max_latency:     Max seconds a request waits for other requests to join its micro-batch
+        :param cache_size:      Max sentence scores kept in the shared cache (least recently used are dropped)
+        """
+        self.lang_mod = lang_mod
+        self.batch_size = batch_size
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.cache_size = cache_size
+        self.max_plan_queries = max_plan_queries
+
+        self.cache = OrderedDict()  # Sentence token ids -> log10 directional probability
+        self.requests = queue.Queue()
+        self.batch_sizes = []  # Nbr of requests merged into each micro-batch
+        self.counts = {'sentences_scored': 0, 'cache_hits': 0}
+        self.batcher = threading.Thread(target=self.batch_loop, name='batcher', daemon=True)
+        self.batcher.start()
+
+    def score(self, sentences_ids):
+        """
+        Log10 directional probability of each sentence. Blocks until its micro-batch has run.
+        Safe to call from several threads.
+        """
+        request = ScoreRequest(sentences_ids)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.log_probs
+
+    def fill(self, blanks, fillers_ids):
+        """
+        Log10 probability of each sentence obtained by filling each blank with each filler.
+        :param blanks:          List of (left ids, right ids) pairs, incl. boundary tokens
+        :param fillers_ids:     Token ids of each filler
+        :return:                Numpy array of shape (len(blanks), len(fillers_ids))
+        """
+        sentences_ids = [list(left) + list(filler) + list(right) for left, right in blanks for filler in fillers_ids]
+        return self.score(sentences_ids).reshape(len(blanks), len(fillers_ids))
+
+    def collect_batch(self):
+        """
+        Waits for a request, then merges the requests arriving before the latency deadline into a micro-batch
+        """
+        batch = [self.requests.get()]
+        num_sents = len(batch[0].sentences_ids)
+        deadline = time.monotonic() + self.max_latency
+        while num_sents < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_sents += len(request.sentences_ids)
+        return batch
+
+    def run_batch(self, batch):
+        """
+        Scores the sentences of a micro-batch that are not cached yet, and answers its requests.
+        Missing sentences are planned until self.max_plan_queries queries are pending, then run.
+        """
+        scores = {}  # Sentence ids -> log10 probability, for every sentence of the micro-batch
+        planned = {}  # Sentence ids -> its query indexes, for the sentences planned but not run yet
+        planner = QueryPlanner(self.lang_mod.tokenizer.mask_token_id)
+        num_scored = 0
+        for request in batch:
+            for ids in request.sentences_ids:
+                if ids in scores or ids in planned:
+                    continue
+                if ids in self.cache:
+                    self.cache.move_to_end(ids)
+                    scores[ids] = self.cache[ids]
+                    metrics.count('cache_hits.score_cache')
+                    self.counts['cache_hits'] += 1
+                    continue
+                planned[ids] = planner.add_sentence(ids)
+                if len(planner.queries) >= self.max_plan_queries:
+                    num_scored += self.run_planned(planner, planned, scores)
+                    planner = QueryPlanner(self.lang_mod.tokenizer.mask_token_id)
+                    planned = {}
+        if planned:
+            num_scored += self.run_planned(planner, planned, scores)
+        metrics.count('server.sentences_scored', num_scored)
+        self.counts['sentences_scored'] += num_scored
+
+        for request in batch:
+            request.log_probs = np.array([scores[ids] for ids in request.sentences_ids])
+            request.done.set()
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def run_planned(self, planner, planned, scores):
+        """
+        Runs the planned sentences, and stores their scores in scores and in the cache
+        :return:    Nbr of sentences scored
+        """
+        log_probs = planner.run(self.lang_mod, self.batch_size)
+        planner.count_metrics()
+        for ids, query_ids in planned.items():
+            scores[ids] = self.cache[ids] = 0.5 * np.sum(log_probs[query_ids])
+        return len(planned)
+
+    def batch_loop(self):
+        while True:
+            batch = self.collect_batch()
+            self.batch_sizes.append(len(batch))
+            metrics.count('server.micro_batches')
+            metrics.count('server.requests', len(batch))
+            logger.info("Micro-batch of %d requests, %d cached scores", len(batch), len(self.cache))
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.done.is_set():
+                        request.error = e
+                        request.done.set()
+
+    def info(self):
+        return {'pretrained_model': self.lang_mod.tokenizer.name_or_path,
+                'batch_size': self.batch_size,
+                'max_batch': self.max_batch,
+                'max_latency': self.max_latency,
+                'cache_size': self.cache_size}
+
+    def stats(self):
+        return {'requests': int(np.sum(self.batch_sizes)),
+                'micro_batches': len(self.batch_sizes),
+                'mean_requests_per_batch': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                'sentences_scored': self.counts['sentences_scored'],
+                'cache_hits': self.counts['cache_hits'],
+                'cached_scores': len(self.cache)}
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        scorer = self.server.scorer
+        if self.path == '/info':
+            self.send_json(scorer.info())
+        elif self.path == '/stats':
+            self.send_json(scorer.stats())
+        else:
+            self.send_json({'error': f"Unknown endpoint {self.path}"}, status=404)
+
+    def do_POST(self):
+        scorer = self.server.scorer
+        lang_mod = scorer.lang_mod
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path == '/score':
+                if 'ids' in request:
+                    sentences_ids = request['ids']
+                else:
+                    sentences_ids = [lang_mod.tokenizer.convert_tokens_to_ids(lang_mod.tokenize_sent(sent))
+                                     for sent in request['sentences']]
+                self.send_json({'log_probs': scorer.score(sentences_ids).tolist()})
+            elif self.path == '/fill':
+                if 'blanks' in request:
+                    log_probs = scorer.fill(request['blanks'], request['filler_ids'])
+                    self.send_json({'log_probs': log_probs.tolist()})
+                else:
+                    left, right = request['sentence'].split(request.get('blank', '___'), 1)
+                    tokenizer = lang_mod.tokenizer
+                    left_ids = [tokenizer.cls_token_id] + tokenizer.convert_tokens_to_ids(tokenizer.tokenize(left))
+                    right_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(right)) + [tokenizer.sep_token_id]
+                    fillers_ids = [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(filler))
+                                   for filler in request['fillers']]
+                    log_probs = scorer.fill([(left_ids, right_ids)], fillers_ids)
+                    self.send_json({'log_probs': log_probs[0].tolist()})
+            else:
+                self.send_json({'error': f"Unknown endpoint {self.path}"}, status=404)
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json({'error': f"Bad request: {e!r}"}, status=400)
+        except Exception as e:
+            logger.warning("Scoring failed: %r", e)
+            self.send_json({'error': repr(e)}, status=500)
+
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.address_string(), *args)
+
+
+class ScoreHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Many clients may connect at once
+
+
+def make_server(scorer, host='127.0.0.1', port=8765):
+    """
+    HTTP server answering each connection in its own thread. Use port=0 to pick a free port.
+    """
+    httpd = ScoreHTTPServer((host, port), ScoreHandler)
+    httpd.scorer = scorer
+    return httpd
+
+
+class ScoreClient:
+    """
+    Thin client for a running ScoreServer. Provides the parts of the BertLM interface used by
+    WordSenseModel (tokenizer, tokenize_sent, get_sentences_log_probs), so it can stand in for an
+    in-process model. Only the tokenizer is loaded locally.
+    """
+    remote = True
+    use_cuda = False
+
+    def __init__(self, url='http://127.0.0.1:8765', timeout=600):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.server_info = self.get('/info')
+
+        from BertModel import BertTok
+        self.bert_tok = BertTok(self.server_info['pretrained_model'])
+        self.tokenizer = self.bert_tok.tokenizer
+
+    def get(self, endpoint):
+        with urllib.request.urlopen(self.url + endpoint, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def post(self, endpoint, data):
+        request = urllib.request.Request(self.url + endpoint, data=json.dumps(data).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def tokenize_sent(self, sentence):
+        return self.bert_tok.tokenize_sent(sentence)
+
+    def stats(self):
+        return self.get('/stats')
+
+    def score_sentences(self, sentences):
+        """
+        Log10 directional probability of each text sentence
+        """
+        return np.array(self.post('/score', {'sentences': list(sentences)})['log_probs'])
+
+    def get_sentences_log_probs(self, sentences_ids, batch_size=None):
+        """
+        Same as BertLM.get_sentences_log_probs(). Batching is decided by the server, so batch_size is ignored.
+        """
+        ids = [[int(tok) for tok in sent_ids] for sent_ids in sentences_ids]
+        return np.array(self.post('/score', {'ids': ids})['log_probs'])
+
+    def fill_blanks(self, blanks, fillers_ids):
+        """
+        Log10 probability of each sentence obtained by filling each blank with each filler.
+        :param blanks:          List of (left ids, right ids) pairs, incl. boundary tokens
+        :param fillers_ids:     Token ids of each filler
+        :return:                Numpy array of shape (len(blanks), len(fillers_ids))
+        """
+        data = {'blanks': [[[int(tok) for tok in left], [int(tok) for tok in right]] for left, right in blanks],
+                'filler_ids': [[int(tok) for tok in filler] for filler in fillers_ids]}
+        return np.array(self.post('/fill', data)['log_probs']).reshape(len(blanks), len(fillers_ids))
+
+    def load_norm_scores(self, pickle_norm, norm_file, **kwargs):
+        print("Using a scoring server: normalization scores are not loaded by the client")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local sentence-probability scoring server')
+    parser.add_argument('--pretrained', type=str, default='bert-large-uncased', help='Pretrained model to serve')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--use_cuda', action='store_true', help='Use GPU?')
+    parser.add_argument('--device', type=str, default='cuda:2', help='GPU Device to Use?')
+    parser.add_argument('--quantize', type=str, default='none', help='Quantize model for CPU inference: none, int8')
+    parser.add_argument('--quantized_path', type=str, default=None, help='File to save/reload the quantized model')
+    parser.add_argument('--bf16', action='store_true', help='Run the language model under bfloat16 autocast')
+    parser.add_argument('--mmap_path', type=str, default=None, help='Memory-map the model weights from this file '
+                                                                    '(created if not present)')
+    parser.add_argument('--batch_size', type=int, default=64, help='Max masked sentences per forward pass')
+    parser.add_argument('--max_batch', type=int, default=256, help='Max sentences merged into one micro-batch')
+    parser.add_argument('--max_latency', type=float, default=0.01, help='Max seconds a request waits for others '
+                                                                        'to join its micro-batch')
+    parser.add_argument('--cache_size', type=int, default=100000, help='Max sentence scores kept in the cache')
+    parser.add_argument('--max_plan_queries', type=int, default=200000, help='Max masked predictions planned at '
+                                                                             'a time; larger micro-batches are '
+                                                                             'run in parts')
+    instrumentation.add_arguments(parser)
+    resources.add_arguments(parser)
+
+    args = parser.parse_args()
+    instrumentation.setup(args.log_level, args.log_interval, args.metrics_file, args.profile_dir)
+    resources.setup(args.threads)
+
+    resources.setup_torch()
+    from BertModel import BertLM
+    print("Loading Bert MLM...")
+    with metrics.stage('load_model'):
+        lang_mod = BertLM(args.pretrained, args.device, args.use_cuda, quantize=args.quantize, bf16=args.bf16,
+                          quantized_path=args.quantized_path, mmap_path=args.mmap_path)
+    scorer = ScoreServer(lang_mod, batch_size=args.batch_size, max_batch=args.max_batch,
+                         max_latency=args.max_latency, cache_size=args.cache_size,
+                         max_plan_queries=args.max_plan_queries)
+    httpd = make_server(scorer, args.host, args.port)
+    print(f"Serving {args.pretrained} on http://{args.host}:{httpd.server_address[1]}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down")
+    finally:
+        httpd.server_close()
@@ -3,11 +3,12 @@ import os
 import pickle
 
 import numpy as np
-from sklearn.cluster import KMeans, DBSCAN, OPTICS
-from sklearn.preprocessing import normalize
-from spherecluster import SphericalKMeans, VonMisesFisherMixture
 from tqdm import tqdm
 
+import instrumentation
+import resources
+from instrumentation import metrics
+
 
 class WordCategorizer:
     def __init__(self):
@@ -18,6 +19,9 @@ class WordCategorizer:
         self.wsd_centroids = None  # Stores centroids for disambiguated senses
         self.estimator = None  # Clustering method
         self.disamb_vocab = []
+        self.row_counts = None  # Nbr of word instances sharing each matrix row (repeated sentences)
+        self.reduced = None  # Projection of the word-sense vectors to cluster, if reduce_senses() was called
+        self.categories = None  # Category centroids and the senses they were fitted on (see category_centroids())
 
     def load_centroids(self, pickle_senses):
         """
@@ -33,11 +37,14 @@ class WordCategorizer:
             print("ERROR: Loading WSD data failed!!\n")
             exit(1)
 
-    def load_matrix(self, pickle_emb, verbose=False):
+    def load_matrix(self, pickle_emb, verbose=False, transform='softmax', temperature=1.0, top_k=None):
         """
         If pickle file is present, load data; else, calculate it.
         :param pickle_emb:          File to load embeddings
         :param verbose:
+        :param transform:           Transform to unit vectors, for log-space matrices (see log_space.py)
+        :param temperature:         Softmax temperature of the transform
+        :param top_k:               Entries kept per row by the 'topk' transform
         :return:
         """
         try:
@@ -46,6 +53,7 @@ class WordCategorizer:
                 self.sentences = _data[0]
                 self.vocab_map = _data[1]
                 self.matrix = _data[2]
+                matrix_info = _data[3] if len(_data) > 3 else {}
 
             print("MATRIX FOUND!")
 
@@ -53,56 +61,194 @@ class WordCategorizer:
             print("MATRIX File Not Found!! \n")
             exit(1)
 
-    def restructure_matrix(self):
+        from scipy import sparse
+        if sparse.issparse(self.matrix):
+            print(f"Sparse matrix: {self.matrix.nnz} non-zeros for {self.matrix.shape[0]} instances")
+            num_rows, num_columns = self.matrix.shape
+        else:
+            num_rows, num_columns = len(self.matrix), len(self.matrix[0]) if len(self.matrix) > 0 else 0
+        if num_rows > 0 and num_columns != len(self.vocab_map):
+            print("ERROR: Matrix columns don't match the vocabulary. Word categories need the sentence-probability "
+                  "matrix (word_senser.py --embedding probs)")
+            exit(1)
+        if matrix_info.get('log_space'):
+            from log_space import to_unit_vectors
+            print(f"Transforming log-space matrix to unit vectors ({transform})")
+            self.matrix = to_unit_vectors(self.matrix, transform, temperature, top_k)
+        self.row_counts = np.bincount([row for instances in self.vocab_map.values() for _, _, row in instances],
+                                      minlength=num_rows)
+
+    def weight_rows(self, matrix):
+        """
+        Scales each row by the square root of the nbr of instances sharing it, so that dot products between
+        word columns are the same as if repeated sentences had their own (identical) rows
+        """
+        from scipy import sparse
+
+        if self.row_counts is None or np.all(self.row_counts <= 1):
+            return matrix
+        if sparse.issparse(matrix):
+            return sparse.diags(np.sqrt(self.row_counts)) @ matrix
+        return np.asarray(matrix) * np.sqrt(self.row_counts)[:, np.newaxis]
+
+    def restructure_matrix(self, memmap_path=None):
         """
         For each sentence, sentence probability scores are assigned to the correct word sense if word
         is ambiguous according to WSD data.
         Each instance only contributes to the embedding vector of the closest sense.
+        :param memmap_path:     .npy file to build a dense wsd_matrix in, memory-mapped (see store_senses())
         """
+        from scipy import sparse
+        from sklearn.preprocessing import normalize
+
         # Store nbr senses per word
         sense_counts = []
         for word, sense_centroids in self.wsd_centroids.items():
             sense_counts.append(len(sense_centroids))
             self.disamb_vocab.extend([word] * len(sense_centroids))
         # sense_counts = [len(sense_centroids) for sense_centroids in self.wsd_centroids.values()]
+        sense_offsets = np.cumsum([0] + sense_counts[:-1])  # First wsd_matrix column of each word
         total_senses = sum(sense_counts)
-        total_instances = len(self.matrix)
-        self.wsd_matrix = np.zeros([total_instances, total_senses])  # Init wsd matrix with zeros
-        for row_id, embedding in enumerate(self.matrix):
-            for column_id, centroids in enumerate(self.wsd_centroids.values()):
-                if centroids == [0]:  # If word is not ambiguous
-                    closest_sense = 0
-                else:
-                    # Estimate closest sense if word is ambiguous
-                    closest_sense = np.argmax(np.dot(embedding, np.transpose(centroids)))
-                wsd_column_id = sum(sense_counts[:column_id]) + closest_sense
-                self.wsd_matrix[row_id, wsd_column_id] = self.matrix[row_id][column_id]  # Assign to closest sense
 
+        # Instances with a non-zero entry in each column, so sparse matrices only compare those to the centroids
+        matrix = self.matrix if sparse.issparse(self.matrix) else np.asarray(self.matrix)
+        columns = sparse.csc_matrix(matrix) if sparse.issparse(matrix) else None
+        rows, wsd_columns, values = [], [], []  # Sparse matrices: entries of the CSR wsd_matrix
+        if columns is not None:
+            if memmap_path:
+                print("Sparse word-sense matrix is kept in memory")
+        elif memmap_path:  # Dense matrices are filled one column at a time; memory-mapped, one row per sense
+            from numpy.lib.format import open_memmap
+            senses = open_memmap(memmap_path, mode='w+', dtype=np.float32, shape=(total_senses, matrix.shape[0]))
+        else:
+            self.wsd_matrix = np.zeros([matrix.shape[0], total_senses])  # Init wsd matrix with zeros
+        for column_id, centroids in enumerate(self.wsd_centroids.values()):
+            if columns is not None:
+                col_rows = columns.indices[columns.indptr[column_id]:columns.indptr[column_id + 1]]
+                col_values = columns.data[columns.indptr[column_id]:columns.indptr[column_id + 1]]
+                embeddings = matrix[col_rows]
+            else:
+                col_rows = np.arange(matrix.shape[0])
+                col_values = matrix[:, column_id]
+                embeddings = matrix
+            if len(centroids) == 1:  # If word is not ambiguous (or has a single sense)
+                closest_sense = np.zeros(len(col_rows), dtype=int)
+            else:
+                # Estimate closest sense if word is ambiguous
+                closest_sense = np.asarray(embeddings @ np.transpose(centroids)).argmax(axis=1)
+            wsd_column_ids = sense_offsets[column_id] + closest_sense  # Assign to closest sense
+            if columns is not None:
+                rows.append(col_rows)
+                wsd_columns.append(wsd_column_ids)
+                values.append(col_values)
+            elif memmap_path:
+                senses[wsd_column_ids, col_rows] = col_values
+            else:
+                self.wsd_matrix[col_rows, wsd_column_ids] = col_values
+
+        if columns is not None:
+            rows, wsd_columns, values = np.concatenate(rows), np.concatenate(wsd_columns), np.concatenate(values)
+            self.wsd_matrix = sparse.csr_matrix((values, (rows, wsd_columns)), shape=(matrix.shape[0], total_senses))
+        elif memmap_path:
+            self.wsd_matrix = np.transpose(senses)
+            self.normalize_senses()
+            print("Matrix restructured with WSD data!")
+            return
+
+        self.wsd_matrix = self.weight_rows(self.wsd_matrix)
         self.wsd_matrix = normalize(self.wsd_matrix, axis=0)  # Normalize restructured word-sense embeddings
         print("Matrix restructured with WSD data!")
 
+    def store_senses(self, memmap_path, block_size=1024):
+        """
+        Moves a dense wsd_matrix to a memory-mapped .npy file, stored transposed (one row per word sense) so that
+        blocks of senses are contiguous on disk. wsd_matrix becomes a transposed view of the file.
+        """
+        from numpy.lib.format import open_memmap
+
+        if hasattr(self.wsd_matrix, 'tocsr'):
+            print("Sparse word-sense matrix is kept in memory")
+            return
+        matrix = np.asarray(self.wsd_matrix)
+        senses = open_memmap(memmap_path, mode='w+', dtype=np.float32, shape=matrix.shape[::-1])
+        for start in range(0, len(senses), block_size):
+            senses[start:start + block_size] = np.transpose(matrix[:, start:start + block_size])
+        senses.flush()
+        self.wsd_matrix = np.transpose(senses)
+        print(f"Word-sense matrix stored in {memmap_path}")
+
+    def normalize_senses(self, block_size=1024):
+        """
+        weight_rows() and normalize(axis=0) for a memory-mapped wsd_matrix, one block of senses at a time.
+        As in normalize(), senses with a norm too close to zero are left unscaled.
+        """
+        senses = np.transpose(self.wsd_matrix)
+        weights = None if self.row_counts is None else np.sqrt(self.row_counts).astype(np.float32)
+        for start in range(0, len(senses), block_size):
+            block = senses[start:start + block_size].astype(np.float64)
+            if weights is not None:
+                block *= weights
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            norms[norms < 10 * np.finfo(np.float64).eps] = 1
+            senses[start:start + block_size] = block / norms
+        senses.flush()
+
+    def reduce_senses(self, method='pca', n_components=100, chunk_size=1000, cache_file=None):
+        """
+        Projects the word-sense vectors (columns of wsd_matrix, one dimension per instance) to n_components
+        dimensions, fitted in chunks of senses (see reduction.py). cluster_words() then clusters the projection.
+        """
+        from reduction import reduce_rows
+
+        senses = np.transpose(self.wsd_matrix)
+        if hasattr(senses, 'tocsr'):  # Sparse matrix: slice rows of a CSR copy
+            senses = senses.tocsr()
+        with metrics.stage('reduce'):
+            self.reduced, metrics.info['reduction'] = reduce_rows(lambda start, end: senses[start:end],
+                                                                  senses.shape[0], method, n_components,
+                                                                  chunk_size, cache_file)
+
     def cluster_words(self, clust_method='SphericalKMeans', **kwargs):
         min_samples = int(kwargs.get('min_samples', 3))
         eps = kwargs.get('eps', 0.3)
         k = int(kwargs.get('k', 5))  # 5 is default value, if no kwargs were passed
+        random_state = kwargs.get('random_state')  # Seed of the k-means and mixture initializations
+        n_jobs = resources.budget.n_jobs  # From the process thread budget
         # Init clustering object
         if clust_method == 'OPTICS':
-            self.estimator = OPTICS(min_samples=min_samples, metric='cosine', n_jobs=4)
+            from sklearn.cluster import OPTICS
+            self.estimator = OPTICS(min_samples=min_samples, metric='cosine', n_jobs=n_jobs)
         elif clust_method == 'DBSCAN':
-            self.estimator = DBSCAN(min_samples=min_samples, metric='cosine', eps=eps, n_jobs=4)
+            from sklearn.cluster import DBSCAN
+            self.estimator = DBSCAN(min_samples=min_samples, metric='cosine', eps=eps, n_jobs=n_jobs)
         elif clust_method == 'KMeans':
-            self.estimator = KMeans(init="k-means++", n_clusters=k, n_jobs=4)
+            from sklearn.cluster import KMeans
+            self.estimator = KMeans(init="k-means++", n_clusters=k, n_jobs=n_jobs, random_state=random_state)
         elif clust_method == 'SphericalKMeans':
-            self.estimator = SphericalKMeans(n_clusters=k, n_jobs=4)
+            from spherecluster import SphericalKMeans
+            self.estimator = SphericalKMeans(n_clusters=k, n_jobs=n_jobs, random_state=random_state)
         elif clust_method == 'movMF-soft':
-            self.estimator = VonMisesFisherMixture(n_clusters=k, posterior_type="soft")
+            from spherecluster import VonMisesFisherMixture
+            self.estimator = VonMisesFisherMixture(n_clusters=k, posterior_type="soft",
+                                                   random_state=random_state)
         elif clust_method == 'movMF-hard':
-            self.estimator = VonMisesFisherMixture(n_clusters=k, posterior_type="hard")
+            from spherecluster import VonMisesFisherMixture
+            self.estimator = VonMisesFisherMixture(n_clusters=k, posterior_type="hard",
+                                                   random_state=random_state)
+        elif clust_method == 'MiniBatchSphericalKMeans':
+            from minibatch_spherical import MiniBatchSphericalKMeans
+            self.estimator = MiniBatchSphericalKMeans(n_clusters=k, batch_size=int(kwargs.get('batch_size', 1024)),
+                                                      max_iter=int(kwargs.get('max_iter', 10)),
+                                                      random_state=random_state)
         else:
-            print("Clustering methods implemented are: OPTICS, DBSCAN, KMeans, SphericalKMeans, movMF-soft, movMF-hard")
+            print("Clustering methods implemented are: OPTICS, DBSCAN, KMeans, SphericalKMeans, movMF-soft, "
+                  "movMF-hard, MiniBatchSphericalKMeans")
             exit(1)
 
-        self.estimator.fit(np.transpose(self.wsd_matrix))  # Cluster word-senses into categories
+        senses = np.transpose(self.wsd_matrix) if self.reduced is None else self.reduced
+        if clust_method == 'MiniBatchSphericalKMeans' and hasattr(senses, 'tocsr'):
+            senses = senses.tocsr()  # Read by blocks of rows
+        self.estimator.fit(senses)  # Cluster word-senses into categories
 
     def write_clusters(self, method, save_to, clust_param):
         """
@@ -126,6 +272,113 @@ class WordCategorizer:
                 else:
                     fo.write(" is empty\n\n")
 
+    def sense_vectors(self, indices=None):
+        """
+        Word-sense vectors (columns of wsd_matrix, one dimension per matrix row) as rows: all of them, or those at
+        the given positions of disamb_vocab
+        """
+        senses = np.transpose(self.wsd_matrix)
+        if hasattr(senses, 'tocsr'):
+            senses = senses.tocsr()
+        return senses if indices is None else senses[np.asarray(indices)]
+
+    def category_centroids(self, metric='cosine', block_size=1024):
+        """
+        Centroid of each category found by cluster_words(), computed from the word-sense vectors even if a
+        projection was clustered, so that new senses can be assigned without it. Senses left unclustered
+        (label -1) don't contribute.
+        :param metric:      'cosine': unit-length mean of the unit sense vectors (spherical and density-based
+                            methods); 'euclidean': mean of the sense vectors (KMeans)
+        """
+        from minibatch_spherical import unit_rows
+        from scipy import sparse
+
+        labels = np.asarray(self.estimator.labels_)
+        senses = self.sense_vectors()
+        num_clusters = max(labels.max() + 1, 0)
+        sums = np.zeros((num_clusters, senses.shape[1]))
+        for start in range(0, senses.shape[0], block_size):
+            block_labels = labels[start:start + block_size]
+            members = np.flatnonzero(block_labels >= 0)
+            indicator = sparse.csr_matrix((np.ones(len(members)), (block_labels[members], members)),
+                                          shape=(num_clusters, len(block_labels)))
+            block = senses[start:start + block_size]
+            block = unit_rows(block) if metric == 'cosine' else (block.toarray() if hasattr(block, 'toarray')
+                                                                  else np.asarray(block, dtype=np.float64))
+            sums += indicator @ block
+        if metric == 'cosine':
+            centroids = unit_rows(sums)
+        else:
+            centroids = sums / np.maximum(np.bincount(labels[labels >= 0], minlength=num_clusters), 1)[:, np.newaxis]
+        self.categories = {'centroids': centroids.astype(np.float32), 'metric': metric,
+                           'senses': list(self.disamb_vocab), 'labels': labels, 'num_rows': senses.shape[1]}
+        return self.categories['centroids']
+
+    def save_categories(self, method, save_to, clust_param):
+        """
+        Pickles the category centroids next to the .wordcat file of write_clusters()
+        """
+        self.category_centroids(metric='euclidean' if method == 'KMeans' else 'cosine')
+        categories_file = save_to + "/" + method + "_" + str(clust_param) + '.categories.pickle'
+        with open(categories_file, 'wb') as fc:
+            pickle.dump({**self.categories, 'method': method, 'param': clust_param}, fc)
+        print(f"Category centroids saved to {categories_file}")
+
+    def load_categories(self, pickle_categories):
+        try:
+            with open(pickle_categories, 'rb') as fc:
+                self.categories = pickle.load(fc)
+        except FileNotFoundError:
+            print(f"ERROR: Category centroids {pickle_categories} not found; save them with word_categorizer.py "
+                  f"--save_centroids")
+            exit(1)
+
+    def assign_categories(self, senses, margin=0.0, batch_size=1024):
+        """
+        Closest stored category of each new word-sense vector, with one matrix product per batch of senses,
+        instead of clustering all senses again. Categories with the 'cosine' metric are scored by cosine
+        similarity; 'euclidean' ones (KMeans) by minus the distance to the centroid, relative to the length of the
+        sense vector, so that margins don't depend on the scale of the vectors.
+        Matrices updated with new sentences (word_senser.py --update) have more rows than the centroids were
+        fitted on; the centroids are zero there, as those instances didn't exist.
+        :param senses:      Word-sense vectors as rows (see sense_vectors())
+        :param margin:      Assignments whose score for the closest category exceeds that of the second one by
+                            less than this are flagged as uncertain
+        :return:            Arrays with the category, the score of it, the margin over the second closest,
+                            and whether the assignment is certain, for each sense
+        """
+        from minibatch_spherical import unit_rows
+
+        def scores_of(block):
+            if self.categories.get('metric', 'cosine') == 'cosine':
+                return unit_rows(block) @ centroids.T
+            block = block.toarray() if hasattr(block, 'toarray') else np.asarray(block, dtype=np.float64)
+            squared_norms = np.sum(block ** 2, axis=1, keepdims=True)
+            distances = squared_norms - 2 * block @ centroids.T + np.sum(centroids ** 2, axis=1)
+            lengths = np.sqrt(squared_norms)
+            lengths[lengths == 0] = 1
+            return -np.sqrt(np.clip(distances, 0, None)) / lengths
+
+        centroids = self.categories['centroids'].astype(np.float64)
+        if senses.shape[1] < centroids.shape[1]:
+            print(f"ERROR: Sense vectors have {senses.shape[1]} dimensions, fewer than the {centroids.shape[1]} "
+                  f"matrix rows the categories were fitted on")
+            exit(1)
+        centroids = np.pad(centroids, ((0, 0), (0, senses.shape[1] - centroids.shape[1])))
+        num_senses = senses.shape[0]
+        labels = np.empty(num_senses, dtype=int)
+        best, margins = np.empty(num_senses), np.empty(num_senses)
+        for start in range(0, num_senses, batch_size):
+            scores = scores_of(senses[start:start + batch_size])
+            if scores.shape[1] > 1:
+                top_two = -np.partition(-scores, 1, axis=1)[:, :2]
+            else:  # A single category is never uncertain
+                top_two = np.hstack([scores, np.full_like(scores, -np.inf)])
+            labels[start:start + batch_size] = np.argmax(scores, axis=1)
+            best[start:start + batch_size] = top_two[:, 0]
+            margins[start:start + batch_size] = top_two[:, 0] - top_two[:, 1]
+        return labels, best, margins, margins >= margin
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Word categorization using BERT')
@@ -137,21 +390,60 @@ if __name__ == '__main__':
     parser.add_argument('--verbose', action='store_true', help='Print processing details')
     parser.add_argument('--pickle_WSD', type=str, required=False, help='Pickle file WSD info')
     parser.add_argument('--pickle_emb', type=str, default='test.pickle', help='Pickle file with embeddings matrix')
+    parser.add_argument('--senses_memmap', type=str, default=None, help='.npy file to keep the (dense) word-sense '
+                                                                        'matrix in, memory-mapped')
+    parser.add_argument('--batch_size', type=int, default=1024, help='Senses per block for '
+                                                                     'MiniBatchSphericalKMeans')
+    parser.add_argument('--max_iter', type=int, default=10, help='Max passes over the senses for '
+                                                                 'MiniBatchSphericalKMeans')
+    parser.add_argument('--random_state', type=int, default=None, help='Seed of the clustering initialization, '
+                                                                       'for reproducible runs')
+    parser.add_argument('--reduce', type=str, default='none', help='Project word senses before clustering: none, '
+                                                                   'pca, random_projection')
+    parser.add_argument('--reduce_dims', type=int, default=100, help='Dimensions kept by --reduce')
+    parser.add_argument('--reduce_cache', type=str, default=None, help='.npz file to reuse the projected matrix '
+                                                                       'from (created if not present)')
+    parser.add_argument('--reduce_chunk', type=int, default=1000, help='Senses per chunk when fitting --reduce')
+    parser.add_argument('--save_centroids', action='store_true', help='Also save the category centroids, to '
+                                                                      'assign new senses (see category_assign.py)')
+    parser.add_argument('--transform', type=str, default='softmax', help='Transform of log-space matrices: '
+                                                                         'softmax, topk')
+    parser.add_argument('--temperature', type=float, default=1.0, help='Softmax temperature of the transform')
+    parser.add_argument('--top_k', type=int, default=None, help='Entries kept per row by the topk transform')
+    instrumentation.add_arguments(parser)
+    resources.add_arguments(parser)
     args = parser.parse_args()
+    instrumentation.setup(args.log_level, args.log_interval, args.metrics_file, args.profile_dir)
+    resources.setup(args.threads)
+    if args.transform == 'topk' and not args.top_k:
+        print("The topk transform needs --top_k, the nbr of entries to keep per row")
+        exit(1)
 
     wc = WordCategorizer()
 
     # Load probability matrix for sentence-word pairs
-    wc.load_matrix(args.pickle_emb, verbose=args.verbose)
+    with metrics.stage('load_matrix'):
+        wc.load_matrix(args.pickle_emb, verbose=args.verbose, transform=args.transform, temperature=args.temperature,
+                       top_k=args.top_k)
 
     # Load WSD data
     if args.pickle_WSD:
         print("Word senses file found")
         wc.load_centroids(args.pickle_WSD)
         # Restructure matrix with WSD info
-        wc.restructure_matrix()
+        with metrics.stage('restructure_matrix'):
+            wc.restructure_matrix(memmap_path=args.senses_memmap)
     else:
-        wc.wsd_matrix = wc.matrix  # point to same matrix if no WSD data
+        wc.wsd_matrix = wc.weight_rows(wc.matrix)  # point to same matrix if no WSD data (or repeated sentences)
+        wc.disamb_vocab = list(wc.vocab_map)
+        if args.senses_memmap:
+            wc.store_senses(args.senses_memmap)
+
+    if args.reduce not in ('none', 'pca', 'random_projection'):
+        print("Reduction methods implemented are: none, pca, random_projection")
+        exit(1)
+    if args.reduce != 'none':
+        wc.reduce_senses(args.reduce, args.reduce_dims, args.reduce_chunk, args.reduce_cache)
 
     print("Start clustering...")
     if not os.path.exists(args.save_to):
@@ -159,5 +451,11 @@ if __name__ == '__main__':
     with open(args.save_to + '/results.log', 'w') as fl:
         for curr_k in tqdm(np.linspace(args.start_k, args.end_k, args.steps_k)):
             print(f"Clustering with k={curr_k}")
-            wc.cluster_words(clust_method=args.clusterer, k=curr_k)
-            wc.write_clusters(args.clusterer, args.save_to, curr_k)
+            with metrics.stage('cluster_words'):
+                wc.cluster_words(clust_method=args.clusterer, k=curr_k, batch_size=args.batch_size,
+                                 max_iter=args.max_iter, random_state=args.random_state)
+            with metrics.stage('write_clusters'):
+                wc.write_clusters(args.clusterer, args.save_to, curr_k)
+            if args.save_centroids:
+                with metrics.stage('save_categories'):
+                    wc.save_categories(args.clusterer, args.save_to, curr_k)
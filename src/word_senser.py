@@ -4,53 +4,136 @@
 # Similar code that works with xml file sentences is tried in word_senser_XML.py
 
 import os
+import json
 import pickle
+import inspect
 import argparse
 import numpy as np
 import random as rand
 
-from sklearn.cluster import KMeans, DBSCAN, OPTICS
-from sklearn.preprocessing import normalize
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
-from spherecluster import SphericalKMeans, VonMisesFisherMixture
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 import warnings
 
-from BertModel import BertLM, BertTok
+# Clustering, plotting and transformer libraries are imported where needed, to keep startup fast
+import instrumentation
+import resources
+from instrumentation import metrics, get_logger
+from query_planner import QueryPlanner
 
 warnings.filterwarnings('ignore')
-
-MASK = '[MASK]'
+logger = get_logger('senser')
 
 
 class WordSenseModel:
-    def __init__(self, pretrained_model, device_number='cuda:1', use_cuda=True, freq_threshold=5):
+    def __init__(self, pretrained_model, device_number='cuda:1', use_cuda=True, freq_threshold=5, quantize=None,
+                 bf16=False, quantized_path=None, batch_size=64, max_plan_queries=200000, pipeline_workers=0,
+                 pipeline_queue=8,
+                 score_server=None, mmap_path=None, embedding='probs', sample_weights=False, log_space=False,
+                 transform='softmax', temperature=1.0, top_k=None, sparse_top_k=None, sparse_threshold=None,
+                 reduce=None, reduce_dims=100, reduce_cache=None, reduce_chunk=1000, precompute_distances=False,
+                 gram_cache_mb=1024, gram_block=2048, output_format='files', plot_max_points=1000, plot_tsne_max=500,
+                 plot_queue=32, targets=None, func_frac=0.05):
         self.sentences = []  # List of corpus textual sentences
         self.vocab_map = dict()  # Dictionary with counts and coordinates of every occurrence of each word
         self.function_words = dict()  # List with function words (most frequent)
         self.cluster_centroids = dict()  # Dictionary with cluster centroid embeddings for word senses
+        self.sense_labels = dict()  # Dictionary with the sense label of each instance of disambiguated words
+        self.sense_counts = dict()  # Nbr of instances of each sense of disambiguated words, stored with centroids
+        self.first_new_sent = None  # Nbr of the first sentence added by update_matrix()
         self.matrix = []  # sentence-word matrix, containing instance vectors to cluster
+        self.matrix_info = dict()  # Stored with the matrix: row norms before normalization, embedding mode
+        self.context_rows = dict()  # First matrix row of each distinct sentence (tuple of words)
+        self.unique_sents = []  # Nbr of the sentences whose instances have their own matrix rows, in row order
+        self.targets = targets  # Only instances of these words get matrix rows (see select_targets())
+        self.func_frac = func_frac  # Top fraction of words considered functional, skipped as targets
+        self.target_sents = None  # Distinct sentences with target instances, and the positions of those
+        self.sample_weights = sample_weights  # Cluster repeated rows once, weighted by their nbr of instances
+        self.log_space = log_space  # Store float32 log10 probabilities, instead of normalized probabilities
+        self.transform = transform  # Transform of log-space rows to unit vectors, at clustering time (see log_space)
+        self.temperature = temperature
+        self.top_k = top_k
+        if transform not in ('softmax', 'topk'):
+            print("Log-space transforms implemented are: softmax, topk")
+            exit(1)
+        if transform == 'topk' and not top_k:
+            print("The topk transform needs --top_k, the nbr of entries to keep per row")
+            exit(1)
+        if log_space and embedding != 'probs':
+            print("Log-space embeddings are only available for --embedding probs")
+            exit(1)
+        self.sparse_top_k = sparse_top_k  # Entries kept per row in sparse (CSR) matrices (see sparsify)
+        self.sparse_threshold = sparse_threshold  # Min entry kept in sparse matrices, as a fraction of the row max
+        if (sparse_top_k or sparse_threshold) and (log_space or embedding != 'probs'):
+            print("Sparse embeddings are only available for --embedding probs, without --log_space")
+            exit(1)
+        self.reduce = reduce  # Projection of the instance embeddings before clustering (see reduction.py)
+        self.reduce_dims = reduce_dims
+        self.reduce_cache = reduce_cache  # File to reuse the projected matrix from
+        self.reduce_chunk = reduce_chunk  # Rows per chunk when fitting the projection
+        self.reduced = None  # Projected matrix, computed on first use
+        if reduce not in (None, 'none', 'pca', 'random_projection'):
+            print("Reduction methods implemented are: none, pca, random_projection")
+            exit(1)
+        # Cosine distances of each word's instances, reused by OPTICS/DBSCAN sweeps (see gram_cache.py)
+        self.gram_cache = None
+        if precompute_distances:
+            from gram_cache import GramCache
+            self.gram_cache = GramCache(gram_cache_mb, gram_block)
+        self.output_format = output_format  # 'files': one .disamb file per word, 'store': one disamb.store file
+        self.plot_params = {'max_points': plot_max_points, 'tsne_max': plot_tsne_max, 'queue_size': plot_queue}
+        self.store = None  # DisambWriter, while disambiguating with output_format 'store'
+        if output_format not in ('files', 'store'):
+            print("Output formats implemented are: files, store")
+            exit(1)
         self.pretrained_model = pretrained_model
         self.device_number = device_number
         self.use_cuda = use_cuda
+        self.quantize = quantize  # Quantization mode for the language model (see BertLM)
+        self.bf16 = bf16
+        self.quantized_path = quantized_path
+        self.mmap_path = mmap_path  # File to memory-map the model weights from (see BertLM)
+        self.embedding = embedding  # Instance embeddings: 'probs' (blank filling) or 'hidden' (hidden states)
+        if embedding not in ('probs', 'hidden'):
+            print("Embedding modes implemented are: probs, hidden")
+            exit(1)
+        if embedding == 'hidden' and score_server:
+            print("Hidden-state embeddings need the model in-process; they can't use a scoring server")
+            exit(1)
+        self.batch_size = batch_size  # Max masked sentences per forward pass
+        self.max_plan_queries = max_plan_queries  # Max queries planned at a time (see plan_chunks())
+        self.pipeline_workers = pipeline_workers  # Threads building batches for the model; 0 runs serially
+        self.pipeline_queue = pipeline_queue  # Max built batches waiting for the model
+        self.dedupe_counts = [0, 0]
+        self.score_server = score_server  # URL of a scoring server to use instead of loading the model
 
         self.lang_mod = None
         self.estimator = None  # Clustering object
         self.save_dir = None  # Directory to save disambiguated senses
         self.freq_threshold = freq_threshold
 
+    def load_tokenizer(self):
+        """
+        Loads the BERT tokenizer on first use, if no language model was loaded
+        """
+        if self.lang_mod is None:
+            from BertModel import BertTok
+            self.lang_mod = BertTok(self.pretrained_model)
+        return self.lang_mod
+
     def apply_bert_tokenizer(self, word):
-        return self.lang_mod.tokenizer.tokenize(word)
+        return self.load_tokenizer().tokenizer.tokenize(word)
 
-    def load_matrix(self, pickle_filename, corpus_file, verbose=False, norm_pickle=None, norm_file=''):
+    def load_matrix(self, pickle_filename, corpus_file, verbose=False, norm_pickle=None, norm_file='',
+                    norm_batch_size=64, norm_tol=None, norm_max_samples=None):
         """
         First pass on the corpus sentences. If pickle file is present, load data; else, calculate it.
         This method:
           a) Stores sentences as an array.
           b) Creates dictionary where each vocabulary word is mapped to its occurrences in corpus.
           c) Calculates instance-word matrix, for instances and vocab words in corpus.
+        :param norm_max_samples:    Max sentences scored per length when calculating normalization scores
+        :param norm_tol:            Convergence tolerance for normalization scores (see BertLM.calculate_norm_dict)
+        :param norm_batch_size:     Masked sequences per forward pass when calculating normalization scores
         :param norm_file:
         :param norm_pickle:
         :param verbose:
@@ -63,32 +146,113 @@ class WordSenseModel:
                 self.sentences = _data[0]
                 self.vocab_map = _data[1]
                 self.matrix = _data[2]
+                self.matrix_info = _data[3] if len(_data) > 3 else {}  # Not stored by older versions
 
                 print("MATRIX FOUND!")
-
-            # Load tokenizer, needed by export_clusters method
-            self.lang_mod = BertTok(self.pretrained_model)
+                metrics.count('cache_hits.matrix_pickle')
 
         except:
             print("MATRIX File Not Found!! \n")
 
-            print("Loading Bert MLM...")
-            self.lang_mod = BertLM(self.pretrained_model, self.device_number, self.use_cuda)
-
-            # Calculate normalization scores
-            self.lang_mod.load_norm_scores(norm_pickle, norm_file)
+            self.load_lang_mod(norm_pickle, norm_file, norm_batch_size, norm_tol, norm_max_samples)
 
             print("Loading vocabulary")
-            self.get_vocabulary(corpus_file, verbose=verbose)
+            with metrics.stage('vocabulary'):
+                self.get_vocabulary(corpus_file, verbose=verbose)
+            if self.targets is not None:
+                self.select_targets()
 
             print("Calculate matrix...")
-            self.calculate_matrix(verbose=verbose)
+            with metrics.stage('calculate_matrix'):
+                self.calculate_matrix(verbose=verbose)
 
-            with open(pickle_filename, 'wb') as h:
-                _data = (self.sentences, self.vocab_map, self.matrix)
-                pickle.dump(_data, h)
+            self.save_matrix(pickle_filename)
 
-            print("Data stored in " + pickle_filename)
+    def update_matrix(self, pickle_filename, corpus_file, verbose=False, norm_pickle=None, norm_file='',
+                      norm_batch_size=64, norm_tol=None, norm_max_samples=None):
+        """
+        Adds the sentences in corpus_file to the matrix stored in pickle_filename, without recomputing it:
+          a) Vocabulary words that are new get new columns, computed only for the existing instances.
+          b) The new instances get new rows, for the whole vocabulary.
+        Rows are re-normalized to unit vectors with the norms stored alongside the matrix.
+        The parameters are the same as for load_matrix().
+        """
+        with open(pickle_filename, 'rb') as h:
+            _data = pickle.load(h)
+        self.sentences, self.vocab_map, self.matrix = _data[:3]
+        self.matrix_info = _data[3] if len(_data) > 3 else {}
+        if 'row_norms' not in self.matrix_info:
+            print("ERROR: Matrix was stored without its row norms; it has to be rebuilt once to be updated")
+            exit(1)
+        if self.matrix_info.get('embedding', 'probs') != self.embedding:
+            print(f"ERROR: Matrix was built with --embedding {self.matrix_info.get('embedding', 'probs')}")
+            exit(1)
+        if self.matrix_info.get('log_space', False) != self.log_space:
+            print(f"ERROR: Matrix was built {'with' if self.matrix_info.get('log_space') else 'without'} --log_space")
+            exit(1)
+        if self.matrix_info.get('targets') is not None:
+            print("ERROR: Matrix was built with --targets, without rows for the other words; it can't be updated")
+            exit(1)
+        if self.matrix_info.get('sparse'):  # New rows are sparsified like the stored ones
+            self.sparse_top_k, self.sparse_threshold = self.matrix_info['sparse']
+
+        self.load_lang_mod(norm_pickle, norm_file, norm_batch_size, norm_tol, norm_max_samples)
+        self.index_contexts()
+        num_sents = len(self.sentences)
+        self.first_new_sent = num_sents
+        num_unique = len(self.unique_sents)
+        old_vocab = set(self.vocab_map)
+        with metrics.stage('vocabulary'):
+            self.get_vocabulary(corpus_file, verbose=verbose)
+        new_words = [word for word in self.vocab_map if word not in old_vocab]  # Appended columns, in order
+        print(f"Adding {len(self.sentences) - num_sents} sentences and {len(new_words)} vocabulary words")
+
+        with metrics.stage('calculate_matrix'):
+            if new_words and self.embedding == 'probs':
+                print("Calculate new columns...")
+                old_sents = [self.sentences[sent_nbr] for sent_nbr in self.unique_sents[:num_unique]]
+                self.extend_rows(self.embed_instances(old_sents, new_words))
+            print("Calculate new rows...")
+            new_sents = [self.sentences[sent_nbr] for sent_nbr in self.unique_sents[num_unique:]]
+            self.append_rows(self.embed_instances(new_sents, list(self.vocab_map)), verbose=verbose)
+
+        self.stack_rows()
+        self.save_matrix(pickle_filename)
+
+    def load_lang_mod(self, norm_pickle=None, norm_file='', norm_batch_size=64, norm_tol=None,
+                      norm_max_samples=None):
+        """
+        Loads the language model (or connects to the scoring server), and its normalization scores
+        """
+        with metrics.stage('load_model'):
+            if self.score_server:
+                print(f"Connecting to scoring server {self.score_server}...")
+                from score_server import ScoreClient
+                self.lang_mod = ScoreClient(self.score_server)
+            else:
+                print("Loading Bert MLM...")
+                resources.setup_torch()
+                from BertModel import BertLM
+                self.lang_mod = BertLM(self.pretrained_model, self.device_number, self.use_cuda,
+                                       quantize=self.quantize, bf16=self.bf16,
+                                       quantized_path=self.quantized_path, mmap_path=self.mmap_path)
+
+        # Calculate normalization scores
+        if self.embedding == 'probs':
+            with metrics.stage('norm_scores'):
+                self.lang_mod.load_norm_scores(norm_pickle, norm_file, batch_size=norm_batch_size, tol=norm_tol,
+                                               max_samples=norm_max_samples)
+
+    def save_matrix(self, pickle_filename):
+        """
+        Stores sentences, vocab_map and matrix, followed by the information needed to update them later
+        """
+        self.matrix_info['embedding'] = self.embedding
+        with open(pickle_filename, 'wb') as h:
+            _data = (self.sentences, self.vocab_map, self.matrix, self.matrix_info)
+            pickle.dump(_data, h)
+
+        print("Data stored in " + pickle_filename)
 
     def get_words(self, tokenized_sent):
         """
@@ -96,7 +260,7 @@ class WordSenseModel:
         :param tokenized_sent:
         :return:
         """
-        sentence = self.lang_mod.tokenizer.convert_tokens_to_string(tokenized_sent[1:-1])  # Ignore boundary tokens
+        sentence = self.load_tokenizer().tokenizer.convert_tokens_to_string(tokenized_sent[1:-1])  # Ignore boundary tokens
         return sentence.split()
 
     def find_function_words(self, functional_threshold):
@@ -105,7 +269,10 @@ class WordSenseModel:
         which we don't want to disambiguate
         :param functional_threshold:    Fraction of words to remove
         """
-        sorted_vocab = sorted(self.vocab_map.items(), key=lambda kv: len(kv[1]))  # Sort words by frequency
+        # Matrices restricted to target words only keep the instances of those, but store all word counts
+        counts = self.matrix_info.get('word_counts') or {word: len(instances) for word, instances in
+                                                         self.vocab_map.items()}
+        sorted_vocab = sorted(self.vocab_map.items(), key=lambda kv: counts[kv[0]])  # Sort words by frequency
         nbr_functionwords= int(len(sorted_vocab) * functional_threshold)  # Nbr of function words
         if nbr_functionwords > 0:  # Prevent choosing all words if nbr_functionwords is zero
             self.function_words = dict(sorted_vocab[-nbr_functionwords:])  # List most common words
@@ -114,238 +281,452 @@ class WordSenseModel:
         """
         Reads all word instances in file, stores their location
         :param verbose:
-        :param corpus_file:     file to get vocabulary
+        :param corpus_file:     file to get vocabulary (appended to the sentences already read, if any)
         """
+        num_instances = 0
+        num_rows = 0
+        next_row = sum(len(self.sentences[sent_nbr]) for sent_nbr in self.unique_sents)  # After existing rows
         with open(corpus_file, 'r') as fi:
-            instance_nbr = 0
             # Process each sentence in corpus
-            for sent_nbr, sent in tqdm(enumerate(fi)):
+            for sent_nbr, sent in tqdm(enumerate(fi, start=len(self.sentences))):
                 bert_tokens = self.lang_mod.tokenize_sent(sent)
                 words = self.get_words(bert_tokens)
                 self.sentences.append(words)
+                # Repeated sentences give the same embeddings: their instances point to the rows of the first one
+                context = tuple(words)
+                if context not in self.context_rows:
+                    self.context_rows[context] = next_row
+                    self.unique_sents.append(sent_nbr)
+                    next_row += len(words)
+                    num_rows += len(words)
+                first_row = self.context_rows[context]
                 # Store word instances in vocab_map
                 for word_pos, word in enumerate(words):
                     if word not in self.vocab_map:
                         self.vocab_map[word] = []
                     # TODO: Can avoid storing coordinates if not CAPS target word in export_clusters
-                    self.vocab_map[word].append((sent_nbr, word_pos, instance_nbr))  # Register instance location
-                    instance_nbr += 1
+                    self.vocab_map[word].append((sent_nbr, word_pos, first_row + word_pos))  # Instance location
+                num_instances += len(words)
         if verbose:
             print("Vocabulary:")
             print(self.vocab_map)
 
         print(f"Vocabulary size: {len(self.vocab_map)}")
+        self.report_dedupe(num_instances, num_rows)
+
+    def index_contexts(self):
+        """
+        Rebuilds context_rows and unique_sents for sentences and vocab_map loaded from a pickle
+        """
+        first_rows = {}  # First matrix row of each sentence
+        for instances in self.vocab_map.values():
+            for sent_nbr, word_pos, row in instances:
+                first_rows[sent_nbr] = row - word_pos
+        self.context_rows = {}
+        self.unique_sents = []
+        claimed_rows = set()
+        for sent_nbr, words in enumerate(self.sentences):
+            if sent_nbr not in first_rows:  # Sentence without words
+                continue
+            self.context_rows.setdefault(tuple(words), first_rows[sent_nbr])
+            if first_rows[sent_nbr] not in claimed_rows:
+                claimed_rows.add(first_rows[sent_nbr])
+                self.unique_sents.append(sent_nbr)
+
+    @staticmethod
+    def read_targets(targets_file):
+        """
+        Target words in a file: the first field of each line, so a word list or a disamb.pred file
+        """
+        with open(targets_file, 'r') as ft:
+            return list(dict.fromkeys(line.split()[0] for line in ft if line.strip()))
+
+    def select_targets(self):
+        """
+        Restricts the matrix rows to the instances of the target words that disambiguate() will cluster: those
+        in the corpus that are not function words and reach freq_threshold. All words keep their columns (as
+        fillers), but the other words have no instances. Rows are renumbered in sentence order, and instances
+        in repeated sentences still share rows. The word counts of the whole corpus are stored with the matrix,
+        so that find_function_words() gives the same words as without targets.
+        """
+        self.matrix_info['word_counts'] = {word: len(instances) for word, instances in self.vocab_map.items()}
+        self.find_function_words(self.func_frac)
+        skipped = {'not in corpus': [], 'function word': [], 'below threshold': []}
+        selected = []
+        for word in self.targets:
+            if word not in self.vocab_map:
+                skipped['not in corpus'].append(word)
+            elif word in self.function_words:
+                skipped['function word'].append(word)
+            elif len(self.vocab_map[word]) < self.freq_threshold:
+                skipped['below threshold'].append(word)
+            else:
+                selected.append(word)
+        for reason, words in skipped.items():
+            if words:
+                print(f"Skipping {len(words)} targets ({reason}): {' '.join(words[:20])}"
+                      f"{' ...' if len(words) > 20 else ''}")
+        if not selected:
+            print("ERROR: None of the targets can be disambiguated")
+            exit(1)
+
+        # Sentence and position of each row to embed; rows of one sentence are consecutive from its first row
+        row_instances = {row: (sent_nbr, word_pos) for word in selected
+                         for sent_nbr, word_pos, row in self.vocab_map[word]}
+        old_rows = sorted(row_instances)
+        new_rows = {row: new_row for new_row, row in enumerate(old_rows)}
+        self.target_sents = []
+        first_row = None
+        for row in old_rows:
+            sent_nbr, word_pos = row_instances[row]
+            if row - word_pos != first_row:  # Next distinct sentence
+                first_row = row - word_pos
+                self.target_sents.append((self.sentences[sent_nbr], []))
+            self.target_sents[-1][1].append(word_pos)
+        all_rows = sum(len(self.sentences[sent_nbr]) for sent_nbr in self.unique_sents)
+        selected_words = set(selected)
+        for word, instances in self.vocab_map.items():
+            self.vocab_map[word] = ([(sent_nbr, word_pos, new_rows[row]) for sent_nbr, word_pos, row in instances]
+                                    if word in selected_words else [])
+        self.matrix_info['targets'] = selected
+        metrics.info['targets'] = {'requested': len(self.targets), 'selected': len(selected),
+                                   'skipped': {reason: len(words) for reason, words in skipped.items()},
+                                   'rows': len(old_rows), 'all_rows': all_rows}
+        print(f"Targets: {len(selected)} words, {len(old_rows)} matrix rows instead of {all_rows} "
+              f"({len(self.target_sents)} sentences)")
+
+    @staticmethod
+    def report_dedupe(num_instances, num_rows):
+        """
+        Prints and records how many instance embeddings were saved by sharing the rows of repeated sentences
+        """
+        saved = num_instances - num_rows
+        metrics.count('dedupe.instances', num_instances)
+        metrics.count('dedupe.unique_rows', num_rows)
+        metrics.info['context_dedupe'] = {'instances': metrics.counters['dedupe.instances'],
+                                          'unique_rows': metrics.counters['dedupe.unique_rows']}
+        print(f"Unique contexts: {num_rows} rows for {num_instances} word instances "
+              f"({saved} embeddings saved, {saved / max(1, num_instances):.1%})")
 
     def calculate_matrix(self, verbose=False):
         """
-        Calculates embeddings for all word instances in corpus_file
+        Calculates embeddings for all word instances in corpus_file (or those of the target words), and stores
+        them as unit-normalized rows (see embed_instances())
         """
-        instances = {}  # Stores matrix indexes for each instance embedding
-        embeddings_count = 0  # Counts embeddings created (matrix row nbr)
-        # Process each sentence in corpus
-        for words in tqdm(self.sentences):
-            print(f"Processing sentence: {words}")
-            bert_tokens = self.lang_mod.tokenize_sent(" ".join(words))
-            word_starts = [index for index, token in enumerate(bert_tokens) if not token.startswith("##")]
+        self.matrix = []
+        self.matrix_info['row_norms'] = []
+        self.matrix_info['log_space'] = self.log_space
+        if self.sparse_top_k or self.sparse_threshold:
+            self.matrix_info['sparse'] = (self.sparse_top_k, self.sparse_threshold)
+        if self.target_sents is not None:  # Only the instances of target words (see select_targets())
+            sentences, positions = [words for words, _ in self.target_sents], [pos for _, pos in self.target_sents]
+        else:
+            sentences = [self.sentences[sent_nbr] for sent_nbr in self.unique_sents]  # Repeated ones share rows
+            positions = None
+        self.append_rows(self.embed_instances(sentences, list(self.vocab_map), positions), verbose=verbose)
+        self.stack_rows()
 
-            # Replace all words in sentence to get their instance-embeddings
-            for word_pos, word in tqdm(enumerate(words)):
-                print(f"Processing {word} (position {word_pos}) with all vocabulary.")
-                if word not in instances:
-                    instances[word] = []
-                instances[word].append(embeddings_count)
-                embeddings_count += 1
-                embedding = []  # Store one word instance (sentence with blank) embedding
-
-                # Calculate common part of sentence probability steps for all words to fill
-                # Will only be used when replacement word is composed of one token, otherwise, we need to do the
-                # whole calculation
-                left_sent = bert_tokens[:word_starts[word_pos + 1]]
-                right_sent = bert_tokens[word_starts[word_pos + 2]:]
-                common_probs = self.get_common_probs(left_sent, right_sent, verbose=verbose)
-
-                # Calculate sentence's probabilities with different filling words: embedding
-                for repl_word in self.vocab_map.keys():
-                    word_tokens = self.lang_mod.tokenizer.tokenize(repl_word)
-                    if len(word_tokens) > 1:  # Ignore common probs; do whole calculation
-                        replaced_sent = left_sent + word_tokens + right_sent
-                        score = self.lang_mod.get_sentence_prob_directional(replaced_sent, verbose=verbose)
-                        sent_len = len(replaced_sent)
-                    else:
-                        score = self.complete_probs(common_probs, left_sent, right_sent, repl_word)
-                        sent_len = len(left_sent) + len(right_sent) + 1
-
-                    # curr_prob = self.lang_mod.normalize_score(sent_len, score)
-                    # embedding.append(curr_prob)
-                    embedding.append(score)
-
-                # Store this sentence embeddings in the general list
-                self.matrix.append(normalize([embedding])[0])  # Store embedding normalized to unit vector
-
-    def complete_probs(self, common_probs, left_sent, right_sent, word_token, verbose=False):
-        """
-        Given the common probability calculations for a sentence, complete calculations filling blank with word_tokens
-        """
-        preds_blank_left, preds_blank_right, log_sent_prob_forw, log_sent_prob_back = common_probs
-        temp_left = left_sent[:]
-        temp_right = right_sent[:]
-
-        # Get probabilities for word filling the blank: b) and g)
-        log_sent_prob_forw += self.get_log_prob(preds_blank_left, word_token, len(left_sent), verbose=verbose)
-        log_sent_prob_back += self.get_log_prob(preds_blank_right, word_token, len(left_sent), verbose=verbose)
-
-        # Get remaining probs with blank filled: c), d), and h)
-        for i in range(1, len(right_sent)):  # d), c)
-            temp_right[-1 - i] = MASK
-            repl_sent = left_sent + [word_token] + temp_right
-            predictions = self.lang_mod.get_predictions(repl_sent)
-            log_sent_prob_forw += self.get_log_prob(predictions, right_sent[-1 - i], -1 - i, verbose=verbose)
-        for j in range(len(left_sent) - 1):  # h)
-            temp_left[1 + j] = MASK
-            repl_sent = temp_left + [word_token] + right_sent
-            predictions = self.lang_mod.get_predictions(repl_sent)
-            log_sent_prob_back += self.get_log_prob(predictions, left_sent[1 + j], 1 + j, verbose=verbose)
-
-        # Obtain geometric average of forward and backward probs
-        log_geom_mean_sent_prob = 0.5 * (log_sent_prob_forw + log_sent_prob_back)
-        if verbose:
-            print(f"Raw forward sentence probability: {log_sent_prob_forw}")
-            print(f"Raw backward sentence probability: {log_sent_prob_back}\n")
-            print(f"Average normalized sentence prob: {log_geom_mean_sent_prob}\n")
+    def append_rows(self, embeddings, verbose=False):
+        """
+        Appends instance embeddings (see embed_instances()) to the matrix, normalized to unit vectors. Their
+        norms are kept in matrix_info, so that columns can be added to the rows later.
+        Log-space matrices store the log10 probabilities as float32 instead, and are not normalized.
+        Sparse matrices store each normalized row as a 1-row CSR matrix (see sparsify()), until stack_rows().
+        """
+        from scipy import sparse
+
+        row_norms = self.matrix_info.setdefault('row_norms', [])
+        if sparse.issparse(self.matrix):
+            self.matrix = [self.matrix]  # Stacked again with the new rows
+        for embedding in embeddings:
+            if verbose:
+                print(f"Instance embedding: {embedding}")
+            metrics.count('instances_embedded')
+            if self.matrix_info.get('log_space'):
+                self.matrix.append(np.asarray(embedding, dtype=np.float32))
+                continue
+            if self.embedding == 'probs':
+                embedding = np.power(10, embedding)
+            norm = self.row_norm(embedding)
+            if self.matrix_info.get('sparse'):
+                self.matrix.append(self.sparsify(embedding / norm))
+            else:
+                self.matrix.append(embedding / norm)  # Store embedding normalized to unit vector
+            row_norms.append(norm)
+
+    def sparsify(self, embedding):
+        """
+        Keeps the largest entries of a normalized embedding, as a 1-row CSR matrix: those of at least
+        sparse_threshold times its maximum, and at most sparse_top_k of them. The row is not re-normalized,
+        so the dropped entries are missing from its norm, and it keeps the scale of the dense row.
+        """
+        from scipy import sparse
 
-        return np.power(10, log_geom_mean_sent_prob)
+        keep = np.arange(len(embedding))
+        if self.sparse_threshold:
+            keep = np.flatnonzero(embedding >= self.sparse_threshold * embedding.max())
+        if self.sparse_top_k and len(keep) > self.sparse_top_k:
+            keep = np.sort(keep[np.argpartition(-embedding[keep], self.sparse_top_k - 1)[:self.sparse_top_k]])
+        return sparse.csr_matrix((embedding[keep], keep, [0, len(keep)]), shape=(1, len(embedding)))
 
-    def get_log_prob(self, predictions, token, position, verbose=False):
+    def stack_rows(self):
         """
-        Given BERT's predictions, return probability for required token, in required position
+        Stacks the 1-row CSR matrices of a sparse matrix into a single CSR matrix
         """
-        probs_first = self.lang_mod.sm(predictions[0, position])  # Softmax to get probabilities for first (sub)word
-        if verbose:
-            self.lang_mod.print_top_predictions(probs_first)
-        log_prob_first = probs_first[self.lang_mod.tokenizer.convert_tokens_to_ids(token)]
-
-        return np.log10(log_prob_first.detach().cpu().numpy())
-
-    def get_common_probs(self, left_sent, right_sent, verbose=False):
-        """
-        Calculate partial forward and backwards probabilities of sentence probability estimation, for
-        the sections that are common to all iterations of a fill-in-the-blank process.
-        Example sentence: "Not ___ real sentence". We need probabilities:
-        FORWARD:
-        a) P(M1 = Not           |M1 M2 M3 M4)
-        b) P(M2 = ___           |Not M2 M3 M4)
-        c) P(M3 = real          |Not ___ M3 M4)
-        d) P(M4 = sentence      |Not ___ real M4)
-        BACKWARD:
-        e) P(M4 = sentence      |M1 M2 M3 M4)
-        f) P(M3 = real          |M1 M2 M3 sentence)
-        g) P(M2 = ___           |M1 M2 real sentence)
-        h) P(M1 = Not           |M1 ___ real sentence)
-        :param left_sent:   Tokens before the blank
-        :param right_sent:  Tokens after the blank
-        :param verbose:
-        :return:            log10(a)) as log_common_prob_forw,
-                            log10(e) * f)) as log_common_prob_back,
-                            The whole vocabulary prediction array for both b) and g), to be used later by all
-                            words filling the blank.
-        """
-        masks_left = ['[CLS]'] + [MASK] * (len(left_sent) - 1)
-        masks_right = [MASK] * (len(right_sent) - 1) + ['[SEP]']
-        temp_left = left_sent[:]
-        temp_right = right_sent[:]
-        log_common_prob_forw = 0
-        log_common_prob_back = 0
-
-        # Estimate a) and e) if they are not the position of the blank
-        repl_sent = masks_left + [MASK] + masks_right  # Fully masked sentence
-        predictions = self.lang_mod.get_predictions(repl_sent)
-        if len(left_sent) > 1:
-            log_common_prob_forw += self.get_log_prob(predictions, left_sent[1], 1, verbose=verbose)
-        if len(right_sent) > 1:
-            log_common_prob_back += self.get_log_prob(predictions, right_sent[-2], len(repl_sent) - 2, verbose=verbose)
-
-        # Get all predictions for b)
-        repl_sent = left_sent + [MASK] + masks_right
-        preds_blank_left = self.lang_mod.get_predictions(repl_sent)
-
-        # Get all predictions for g)
-        repl_sent = masks_left + [MASK] + right_sent
-        preds_blank_right = self.lang_mod.get_predictions(repl_sent)
-
-        # Estimate common probs for forward sentence probability
-        for i in range(1, len(left_sent) - 1):  # Skip [CLS] token
-            temp_left[-i] = MASK
-            repl_sent = temp_left + [MASK] + masks_right
-            predictions = self.lang_mod.get_predictions(repl_sent)
-            log_common_prob_forw += self.get_log_prob(predictions, left_sent[-i], len(left_sent) - i, verbose=verbose)
-
-        # Estimate common probs for backwards sentence probability (f in the example)
-        for j in range(len(right_sent) - 2):
-            temp_right[j] = MASK
-            repl_sent = masks_left + [MASK] + temp_right
-            predictions = self.lang_mod.get_predictions(repl_sent)
-            log_common_prob_back += self.get_log_prob(predictions, right_sent[j], len(left_sent) + 1 + j,
-                                                      verbose=verbose)
-
-        return preds_blank_left, preds_blank_right, log_common_prob_forw, log_common_prob_back
+        if self.matrix_info.get('sparse') and isinstance(self.matrix, list):
+            from scipy import sparse
+            self.matrix = sparse.vstack(self.matrix, format='csr') if self.matrix else sparse.csr_matrix((0, 0))
 
     @staticmethod
-    def plot_instances(embeddings, labels, word):
+    def row_norm(embedding):
         """
-        Plot word-instance embeddings
-        :param embeddings:
-        :param labels:
-        :param word:
-        :return:
+        L2 norm to divide an embedding by. As in sklearn's normalize(), norms too close to zero are
+        replaced by 1, leaving the embedding unchanged.
         """
-        # PCA processing
-        comps_pca = min(3, len(embeddings))
-        pca = PCA(n_components=comps_pca)
-        pca_result = pca.fit_transform(embeddings)
-        print('Explained variation per principal component: {}'.format(pca.explained_variance_ratio_))
-
-        # t-SNE processing
-        tsne = TSNE(n_components=2, verbose=1, perplexity=40, n_iter=300)
-        tsne_results = tsne.fit_transform(embeddings)
+        norm = np.linalg.norm(embedding)
+        return norm if norm >= 10 * np.finfo(np.asarray(embedding).dtype).eps else 1.0
 
-        # PLOTTING
-        plt.figure()
-        plt.subplot(211)
-        plt.scatter(pca_result[:, 0], pca_result[:, 1], c=labels)
-        plt.title(word)
+    def extend_rows(self, new_columns):
+        """
+        Adds new columns to the first len(new_columns) rows of the matrix, and re-normalizes them
+        """
+        if self.matrix_info.get('log_space'):
+            for row, columns in enumerate(new_columns):
+                self.matrix[row] = np.concatenate([self.matrix[row], columns]).astype(np.float32)
+            return
+
+        row_norms = self.matrix_info['row_norms']
+        if self.matrix_info.get('sparse'):
+            # Entries dropped from the stored rows stay dropped; they were negligible next to the kept ones
+            self.matrix = [self.matrix.getrow(row) for row in range(self.matrix.shape[0])]
+        for row, columns in enumerate(new_columns):
+            old_row = self.matrix[row].toarray()[0] if self.matrix_info.get('sparse') else np.asarray(self.matrix[row])
+            embedding = np.concatenate([old_row * row_norms[row], np.power(10, columns)])
+            row_norms[row] = self.row_norm(embedding)
+            self.matrix[row] = embedding / row_norms[row]
+            if self.matrix_info.get('sparse'):
+                self.matrix[row] = self.sparsify(self.matrix[row])
+
+    def embed_instances(self, sentences, words, positions=None):
+        """
+        Calculates the (not normalized) embeddings of all word instances in sentences.
+        Each instance embedding is the log10 sentence probability obtained when filling the word's position
+        with each of words. The masked predictions needed for one sentence are collected by a QueryPlanner,
+        so that masked sequences shared by different blanks and fillers only run once; long sentences or large
+        vocabularies are planned in chunks of blanks or fillers (see plan_chunks()), to bound memory.
+        If self.pipeline_workers > 0, planning, inference and reduction of the chunks are overlapped
+        by a PipelinedExecutor. With a scoring server, the blanks of each sentence are sent in one request.
+        With hidden-state embeddings, words are not used (see embed_hidden()).
+        :param sentences:   Sentences, as lists of words
+        :param words:       Words to fill the blanks with, one per embedding dimension
+        :param positions:   Word positions to embed in each sentence (None: all of them)
+        :return:            List with the embedding of each instance, in instance order
+        """
+        if positions is None:
+            positions = [range(len(sent_words)) for sent_words in sentences]
+        if self.embedding == 'hidden':
+            return self.embed_hidden(sentences, positions)
+
+        tokenizer = self.lang_mod.tokenizer
+        # Token ids of every filler word
+        fillers = [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(repl_word)) for repl_word in words]
+
+        if getattr(self.lang_mod, 'remote', False):
+            return self.embed_remote(sentences, fillers, positions)
+
+        embeddings = []
+        self.dedupe_counts = [0, 0]  # Masked sentences requested, and unique ones run
+        # (sentence, blanks, first filler, end filler) of each chunk, in instance order
+        chunks = [(words, chunk_positions, start, end) for words, word_positions in zip(sentences, positions)
+                  for chunk_positions, start, end in self.plan_chunks(words, word_positions, len(fillers))]
+        pieces = []  # Embeddings of the current blank over the filler ranges scored so far
+
+        def collect(chunk, blank_embeddings):
+            if chunk[2] == 0:
+                pieces.clear()
+            pieces.append(blank_embeddings)
+            if chunk[3] == len(fillers):  # All fillers of these blanks scored
+                embeddings.extend(np.concatenate(blank_pieces) for blank_pieces in zip(*pieces))
+
+        if self.pipeline_workers > 0:
+            from pipeline import PipelinedExecutor
+
+            progress = tqdm(total=len(chunks))  # Advanced as chunks are reduced, not as builders take them
+
+            def build(chunk):
+                words, chunk_positions, start, end = chunk
+                planner, blank_queries = self.plan_sentence(words, chunk_positions, fillers[start:end])
+                state = (chunk, blank_queries, planner.requested, len(planner.sequences))
+                return state, len(planner.queries), planner.plan_batches(self.batch_size)
+
+            def reduce(chunk_nbr, state, log_probs):  # Only called by the reducer thread
+                chunk, blank_queries, requested, unique = state
+                self.dedupe_counts[0] += requested
+                self.dedupe_counts[1] += unique
+                collect(chunk, self.reduce_sentence(blank_queries, log_probs))
+                progress.update()
+
+            executor = PipelinedExecutor(self.lang_mod, build, reduce, num_workers=self.pipeline_workers,
+                                         queue_size=self.pipeline_queue)
+            try:
+                executor.run(chunks)
+            finally:
+                progress.close()
+        else:
+            # Process each chunk of each sentence in corpus
+            for chunk in tqdm(chunks):
+                words, chunk_positions, start, end = chunk
+                planner, blank_queries = self.plan_sentence(words, chunk_positions, fillers[start:end])
+                self.dedupe_counts[0] += planner.requested
+                self.dedupe_counts[1] += len(planner.sequences)
+                log_probs = planner.run(self.lang_mod, self.batch_size)
+                collect(chunk, self.reduce_sentence(blank_queries, log_probs))
+
+        requested, unique = self.dedupe_counts
+        print(f"Forward passes: {unique} for {requested} masked sentences "
+              f"(dedupe ratio {requested / max(1, unique):.1f}x)")
+        return embeddings
+
+    def embed_hidden(self, sentences, positions):
+        """
+        Calculates embeddings for all word instances from the contextual hidden states of the language model:
+        the concatenation of its last 4 layers, averaged over the word's sub-word tokens.
+        Needs one forward pass per sentence, with up to self.batch_size sentences of similar length per batch.
+        Only the words at the given positions of each sentence are embedded.
+        """
+        tokenizer = self.lang_mod.tokenizer
+        sents_tokens = [self.lang_mod.tokenize_sent(" ".join(words)) for words in sentences]
+        order = np.argsort([len(bert_tokens) for bert_tokens in sents_tokens], kind='stable')  # Less padding
+        sents_embeddings = [None] * len(sentences)
+        for start in tqdm(range(0, len(order), self.batch_size)):
+            batch = order[start:start + self.batch_size]
+            hidden_states = self.lang_mod.get_hidden_embeddings([tokenizer.convert_tokens_to_ids(sents_tokens[i])
+                                                                 for i in batch])
+            for sent_nbr, token_embeddings in zip(batch, hidden_states):
+                bert_tokens = sents_tokens[sent_nbr]
+                word_starts = [index for index, token in enumerate(bert_tokens) if not token.startswith("##")]
+                # Average the sub-word tokens of each word (first and last tokens are boundary tokens)
+                sents_embeddings[sent_nbr] = [token_embeddings[word_starts[pos + 1]:word_starts[pos + 2]].mean(0)
+                                              for pos in positions[sent_nbr]]
+
+        return [embedding for embeddings in sents_embeddings for embedding in embeddings]  # In instance order
+
+    def embed_remote(self, sentences, fillers, positions):
+        """
+        Calculates the instance embeddings with a ScoreClient, which plans and caches the forward passes.
+        Each sentence is sent in chunks of blanks or fillers (see plan_chunks()), so that no request makes the
+        server plan more than about self.max_plan_queries queries.
+        """
+        tokenizer = self.lang_mod.tokenizer
+        embeddings = []
+        for words, word_positions in tqdm(list(zip(sentences, positions))):
+            logger.info("Processing sentence: %s", words)
+            bert_tokens = self.lang_mod.tokenize_sent(" ".join(words))
+            bert_ids = tokenizer.convert_tokens_to_ids(bert_tokens)
+            word_starts = [index for index, token in enumerate(bert_tokens) if not token.startswith("##")]
+            blanks = {word_pos: (bert_ids[:word_starts[word_pos + 1]], bert_ids[word_starts[word_pos + 2]:])
+                      for word_pos in word_positions}
+            pieces = []  # Log-probs of the current blanks over the filler ranges scored so far
+            for chunk_positions, start, end in self.plan_chunks(words, word_positions, len(fillers)):
+                if start == 0:
+                    pieces = []
+                pieces.append(self.lang_mod.fill_blanks([blanks[word_pos] for word_pos in chunk_positions],
+                                                        fillers[start:end]))
+                if end == len(fillers):  # All fillers of these blanks scored
+                    embeddings.extend(np.concatenate(pieces, axis=1))
+        print(f"Scoring server stats: {self.lang_mod.stats()}")
+        return embeddings
+
+    def plan_chunks(self, words, positions, num_fillers):
+        """
+        Splits the (blank, filler) sentences of a sentence into chunks of about self.max_plan_queries queries at
+        most, so that planning memory doesn't grow with blanks x fillers x sentence length: groups of blanks
+        with every filler or, when a single blank needs more queries, one blank with a range of fillers.
+        Queries are estimated as 2 per word, plus the filler (sub-word tokens are not counted).
+        :param words:       Words in the sentence
+        :param positions:   Positions of the words to blank
+        :param num_fillers: Nbr of filler words
+        :return:            List of (positions, first filler, end filler) chunks, in instance order
+        """
+        positions = list(positions)
+        pair_queries = 2 * (len(words) + 1)
+        fillers_per_chunk = max(1, self.max_plan_queries // pair_queries)
+        if fillers_per_chunk < num_fillers:
+            return [([word_pos], start, min(start + fillers_per_chunk, num_fillers))
+                    for word_pos in positions for start in range(0, num_fillers, fillers_per_chunk)]
+        blanks_per_chunk = max(1, self.max_plan_queries // (pair_queries * max(1, num_fillers)))
+        return [(positions[start:start + blanks_per_chunk], 0, num_fillers)
+                for start in range(0, len(positions), blanks_per_chunk)]
+
+    def plan_sentence(self, words, positions, fillers):
+        """
+        Plans the masked predictions needed for the blanks at the given positions of a sentence, filled with
+        every filler.
+        :param words:       Words in the sentence
+        :param positions:   Positions of the words to blank
+        :param fillers:     Token ids of each filler word
+        :return:            QueryPlanner, and the query indexes of each (blank, filler) sentence
+        """
+        logger.info("Processing sentence: %s", words)
+        tokenizer = self.lang_mod.tokenizer
+        bert_tokens = self.lang_mod.tokenize_sent(" ".join(words))
+        bert_ids = tokenizer.convert_tokens_to_ids(bert_tokens)
+        word_starts = [index for index, token in enumerate(bert_tokens) if not token.startswith("##")]
+
+        planner = QueryPlanner(tokenizer.mask_token_id)
+        blank_queries = []
+        for word_pos in positions:
+            logger.debug("Planning %s (position %d) with all fillers.", words[word_pos], word_pos)
+            left_ids = bert_ids[:word_starts[word_pos + 1]]
+            right_ids = bert_ids[word_starts[word_pos + 2]:]
+            blank_queries.append([planner.add_sentence(left_ids + filler + right_ids) for filler in fillers])
+
+        planner.count_metrics()
+        logger.info("Forward passes deduplicated %.1fx for sentence of %d words", planner.dedupe_ratio, len(words))
+        return planner, blank_queries
 
-        plt.subplot(212)
-        plt.scatter(tsne_results[:, 0], tsne_results[:, 1], c=labels)
-        plt.show()
-        print("PLOTTED")
+    @staticmethod
+    def reduce_sentence(blank_queries, log_probs):
+        """
+        Turns the planned log-probabilities of a sentence into one (log10) embedding per blank
+        """
+        # Geometric average of forward and backward probs, for each filler
+        return [np.array([0.5 * np.sum(log_probs[query_ids]) for query_ids in queries]) for queries in blank_queries]
 
     def init_estimator(self, save_to, clust_method='OPTICS', **kwargs):
+        n_jobs = resources.budget.n_jobs  # From the process thread budget
         if clust_method == 'OPTICS':
+            from sklearn.cluster import OPTICS
             min_samples = kwargs.get('min_samples', 1)
             # Init clustering object
-            self.estimator = OPTICS(min_samples=min_samples, metric='cosine', n_jobs=4)
+            self.estimator = OPTICS(min_samples=min_samples, metric=self.density_metric(), n_jobs=n_jobs)
             self.save_dir = save_to + "_OPTICS_minsamp" + str(min_samples)
         elif clust_method == 'KMeans':
+            from sklearn.cluster import KMeans
             k = kwargs.get('k', 5)  # 5 is default value, if no kwargs were passed
             self.freq_threshold = max(self.freq_threshold, k)
-            self.estimator = KMeans(init="k-means++", n_clusters=k, n_jobs=4)
+            self.estimator = KMeans(init="k-means++", n_clusters=k, n_jobs=n_jobs)
             self.save_dir = save_to + "_KMeans_k" + str(k)
         elif clust_method == 'DBSCAN':
+            from sklearn.cluster import DBSCAN
             min_samples = kwargs.get('min_samples', 2)
             eps = kwargs.get('eps', 0.3)
-            self.estimator = DBSCAN(metric='cosine', n_jobs=4, min_samples=min_samples, eps=eps)
+            self.estimator = DBSCAN(metric=self.density_metric(), n_jobs=n_jobs, min_samples=min_samples, eps=eps)
             self.save_dir = save_to + "_DBSCAN_minsamp" + str(min_samples) + '_eps' + str(eps)
         elif clust_method == 'SphericalKMeans':
+            from spherecluster import SphericalKMeans
             k = kwargs.get('k', 5)  # 5 is default value, if no kwargs were passed
             self.freq_threshold = max(self.freq_threshold, k)
-            self.estimator = SphericalKMeans(n_clusters=k, n_jobs=4)
+            self.estimator = SphericalKMeans(n_clusters=k, n_jobs=n_jobs)
             self.save_dir = save_to + "_SphericalKMeans_k" + str(k)
         elif clust_method == 'movMF-soft':
+            from spherecluster import VonMisesFisherMixture
             k = kwargs.get('k', 5)  # 5 is default value, if no kwargs were passed
             self.freq_threshold = max(self.freq_threshold, k)
             self.estimator = VonMisesFisherMixture(n_clusters=k, posterior_type="soft")
             self.save_dir = save_to + "_movMF-soft_k" + str(k)
         elif clust_method == 'movMF-hard':
+            from spherecluster import VonMisesFisherMixture
             k = kwargs.get('k', 5)  # 5 is default value, if no kwargs were passed
             self.freq_threshold = max(self.freq_threshold, k)
             self.estimator = VonMisesFisherMixture(n_clusters=k, posterior_type="hard")
@@ -354,85 +735,282 @@ class WordSenseModel:
             print("Clustering methods implemented are: OPTICS, DBSCAN, KMeans, SphericalKMeans, movMF-soft, movMF-hard")
             exit(1)
 
+    def density_metric(self):
+        """
+        Metric of density-based estimators: cosine distances precomputed by the Gram cache, if enabled
+        """
+        return 'precomputed' if self.gram_cache is not None else 'cosine'
+
     def disambiguate(self, pickle_cent='test_cent.pickle', plot=False):
         """
         Disambiguate word senses through clustering their transformer embeddings.
         Clustering is done using the sklearn algorithm selected in init_estimator()
         :param pickle_cent:
-        :param plot:            Flag to plot 2D projection of word instance embeddings
+        :param plot:            Flag to plot 2D projection of word instance embeddings, rendered in the background
+                                to <save_dir>/plots/<word>.png (see plot_render.py)
         """
         if not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir)
         fl = open(self.save_dir + "/clustering.log", 'w')  # Logging file
         fl.write(f"# WORD\t\tCLUSTERS\n")
+        self.sense_labels = {}
+        self.sense_counts = {}
+        if self.output_format == 'store':
+            from disamb_store import DisambWriter
+            self.store = DisambWriter(self.save_dir + "/disamb.store")
+        plotter = None
+        if plot:
+            from plot_render import PlotRenderer
+            plotter = PlotRenderer(self.save_dir + "/plots", **self.plot_params)
 
         # Loop for each word in vocabulary
         for word, instances in self.vocab_map.items():
             self.cluster_centroids[word] = [0]  # Placeholder for non-ambiguous words
             if word in self.function_words.keys():  # Don't disambiguate if function word
-                print(f"Won't disambiguate word \"{word}\": too frequent (function word)")
+                logger.debug("Won't disambiguate word \"%s\": too frequent (function word)", word)
                 continue
 
-            # Build embeddings list for this word
-            curr_embeddings = [self.matrix[row] for _, _, row in instances]
-            # curr_embeddings = normalize(curr_embeddings)  # Make unit vectors
+            # Matrix rows of this word's instances (repeated sentences share rows)
+            rows = [row for _, _, row in instances]
 
-            if len(curr_embeddings) < self.freq_threshold:  # Don't disambiguate if word is infrequent
-                print(f"Won't disambiguate word \"{word}\": frequency is lower than threshold")
+            if len(rows) < self.freq_threshold:  # Don't disambiguate if word is infrequent
+                logger.debug("Won't disambiguate word \"%s\": frequency is lower than threshold", word)
                 continue
 
-            print(f'Disambiguating word \"{word}\"...')
-            self.estimator.fit(curr_embeddings)  # Disambiguate
-            if plot:
-                self.plot_instances(curr_embeddings, self.estimator.labels_, word)
+            logger.info("Disambiguating word \"%s\"...", word)
+            labels = self.fit_estimator(rows, word)  # Disambiguate
+            metrics.count('words_disambiguated')
+            if plotter is not None:
+                plotter.submit(word, self.instance_embeddings(rows), labels)
 
-            curr_centroids = self.export_clusters(fl, word, self.estimator.labels_)
+            curr_centroids = self.export_clusters(fl, word, labels)
             self.cluster_centroids[word] = curr_centroids
+            self.sense_labels[word] = labels
+            self.sense_counts[word] = np.bincount(labels[labels >= 0], minlength=len(curr_centroids))
 
+        if self.store is not None:
+            self.store.close()  # Waits for the records still queued
+            self.store = None
+            print("Word senses stored in " + self.save_dir + "/disamb.store")
+
+        self.save_centroids(pickle_cent)
+        self.write_predictions(self.save_dir + "/disamb.pred")
+        if plotter is not None:
+            plotter.close()  # Waits for the plots still queued
+            print("Plots written to " + self.save_dir + "/plots")
+
+        fl.write("\n")
+        fl.close()
+
+    @staticmethod
+    def counts_file(pickle_cent):
+        """
+        Sidecar file with the nbr of instances of each sense, next to the centroids
+        """
+        return os.path.splitext(pickle_cent)[0] + '_counts.pickle'
+
+    def save_centroids(self, pickle_cent):
+        """
+        Stores the sense centroids of every word, and the counts of their senses in a sidecar file
+        """
         with open(pickle_cent, 'wb') as h:
             pickle.dump(self.cluster_centroids, h)
+        with open(self.counts_file(pickle_cent), 'wb') as h:
+            pickle.dump(self.sense_counts, h)
 
         print("Cluster centroids stored in " + pickle_cent)
 
-        fl.write("\n")
-        fl.close()
+    def update_senses(self, pickle_cent, drift_threshold=0.05):
+        """
+        Updates the stored sense centroids with the instances added by update_matrix(), without reclustering:
+        each new instance is assigned to the closest centroid (by cosine similarity), and centroids move to the
+        running mean of their instances, as in mini-batch spherical k-means (see minibatch_spherical.py).
+        Words whose centroids drift by more than drift_threshold (1 - cosine to the old centroid), and words
+        that now reach the frequency threshold without having senses (or whose instances were all noise), are
+        flagged for a full refit.
+        Centroids and counts are stored back to pickle_cent; the sense labels of the new instances and the
+        flagged words are written next to it.
+        """
+        from minibatch_spherical import MiniBatchSphericalKMeans, unit_rows
+
+        if self.first_new_sent is None:
+            print("ERROR: Sense centroids can only be updated after update_matrix()")
+            exit(1)
+        try:
+            with open(pickle_cent, 'rb') as h:
+                self.cluster_centroids = pickle.load(h)
+            with open(self.counts_file(pickle_cent), 'rb') as h:
+                self.sense_counts = pickle.load(h)
+        except FileNotFoundError as e:
+            print(f"ERROR: {e.filename} not found; disambiguate once without --update_senses to create it")
+            exit(1)
+
+        if self.embedding == 'probs':  # New vocabulary columns are missing from stored centroids: zeros
+            num_columns = self.matrix.shape[1] if self.matrix_info.get('sparse') else len(self.matrix[0])
+            for word in self.sense_counts:
+                centroids = np.array(self.cluster_centroids[word])
+                if len(centroids) > 0:  # All instances were noise: no centroids
+                    self.cluster_centroids[word] = list(np.pad(centroids,
+                                                               ((0, 0), (0, num_columns - centroids.shape[1]))))
+
+        self.sense_labels = {}
+        report = {}
+        for word, instances in self.vocab_map.items():
+            new = [index for index, (sent_nbr, _, _) in enumerate(instances) if sent_nbr >= self.first_new_sent]
+            if not new:
+                continue
+            centroids = self.cluster_centroids.get(word, [0])
+            if word not in self.sense_counts:  # No senses: flag it if it is now frequent enough to disambiguate
+                if word not in self.function_words and len(instances) >= self.freq_threshold:
+                    report[word] = {'new_instances': len(new), 'refit': True, 'reason': 'no senses'}
+                continue
+            if len(centroids) == 0:  # Clustered, but all its instances were noise
+                report[word] = {'new_instances': len(new), 'refit': True, 'reason': 'only noise'}
+                continue
+
+            # As unit vectors (centroids of tiny probabilities are not normalized by export_clusters)
+            old_centroids = unit_rows(np.array(centroids, dtype=np.float64))
+            senses = MiniBatchSphericalKMeans(n_clusters=len(old_centroids), reassignment_ratio=0)
+            senses.cluster_centers_ = old_centroids.copy()
+            senses.counts_ = np.asarray(self.sense_counts[word], dtype=np.float64)
+            embeddings = self.instance_embeddings([instances[index][2] for index in new])
+            labels = senses.predict(embeddings)
+            senses.partial_fit(embeddings)
+
+            drift = float(np.max(1 - np.sum(old_centroids * senses.cluster_centers_, axis=1)))
+            self.cluster_centroids[word] = list(senses.cluster_centers_)
+            self.sense_counts[word] = senses.counts_.astype(int)
+            self.sense_labels[word] = dict(zip(new, labels))
+            report[word] = {'new_instances': len(new), 'drift': drift, 'refit': drift > drift_threshold}
+            metrics.count('senses_updated')
+
+        self.save_centroids(pickle_cent)
+        base = os.path.splitext(pickle_cent)[0]
+        with open(base + '_update.pred', 'w') as fp:  # <word> <instance nbr> <sense label>, new instances only
+            for word, labels in self.sense_labels.items():
+                for instance_nbr, label in labels.items():
+                    fp.write(f"{word} {instance_nbr} {label}\n")
+        with open(base + '_update.json', 'w') as fr:
+            json.dump(report, fr, indent=2)
+        refit = sorted(word for word, word_report in report.items() if word_report['refit'])
+        metrics.info['sense_update'] = {'words_updated': len(self.sense_labels), 'words_to_refit': len(refit)}
+        print(f"Updated the senses of {len(self.sense_labels)} words with their new instances. "
+              f"{len(refit)} words to refit (see {base}_update.json): {' '.join(refit)}")
+        return refit
+
+    def write_predictions(self, pred_file):
+        """
+        Write the sense label of every instance of the disambiguated words, one instance per line:
+        <word> <instance nbr> <sense label>
+        """
+        with open(pred_file, 'w') as fp:
+            for word, labels in self.sense_labels.items():
+                for instance_nbr, label in enumerate(labels):
+                    fp.write(f"{word} {instance_nbr} {label}\n")
+
+    def fit_estimator(self, rows, word=None):
+        """
+        Clusters the embeddings in the given matrix rows, and returns the label of each.
+        Rows shared by several instances are repeated, as virtual copies of the same embedding. With
+        self.sample_weights, each distinct row is clustered once instead, weighted by its nbr of instances,
+        if the estimator supports sample weights.
+        With precomputed distances, the estimator is fitted on the cached distances of the word's instances.
+        """
+        if self.sample_weights and 'sample_weight' in inspect.signature(self.estimator.fit).parameters:
+            unique_rows, inverse, counts = np.unique(rows, return_inverse=True, return_counts=True)
+            if getattr(self.estimator, 'n_clusters', 0) <= len(unique_rows) < len(rows):
+                key = None if word is None else (word, 'unique')
+                self.estimator.fit(self.estimator_inputs(unique_rows, key), sample_weight=counts)
+                metrics.count('dedupe.weighted_fits')
+                return self.estimator.labels_[inverse]
+
+        self.estimator.fit(self.estimator_inputs(rows, word))
+        return self.estimator.labels_
+
+    def estimator_inputs(self, rows, key):
+        """
+        What the estimator is fitted on: the vectors to cluster, or their cosine distances for estimators with
+        metric='precomputed' (cached under key, or computed each time if key is None)
+        """
+        metric = getattr(self.estimator, 'metric', None)
+        if metric == 'cosine':  # As unit rows, like the precomputed distances: sklearn leaves tiny rows unscaled
+            from minibatch_spherical import unit_rows
+            return unit_rows(self.cluster_inputs(rows), dense=False)
+        if metric != 'precomputed':
+            return self.cluster_inputs(rows)
+        if key is None:
+            from gram_cache import cosine_distances
+            return cosine_distances(self.cluster_inputs(rows), self.gram_cache.block_size)
+        return self.gram_cache.distances(key, lambda: self.cluster_inputs(rows))
+
+    def cluster_inputs(self, rows):
+        """
+        Vectors clustered for the given matrix rows: their embeddings, or their projection if self.reduce is set.
+        The projection is fitted on the whole matrix once, and reused for every word and clustering setting.
+        """
+        if self.reduce in (None, 'none'):
+            return self.instance_embeddings(rows)
+        if self.reduced is None:
+            from reduction import reduce_rows
+            num_rows = self.matrix.shape[0] if self.matrix_info.get('sparse') else len(self.matrix)
+            with metrics.stage('reduce'):
+                self.reduced, metrics.info['reduction'] = reduce_rows(
+                    lambda start, end: self.instance_embeddings(range(start, end)), num_rows, self.reduce,
+                    self.reduce_dims, self.reduce_chunk, self.reduce_cache)
+        return self.reduced[np.asarray(rows)]
+
+    def instance_embeddings(self, rows):
+        """
+        Embeddings to cluster for the given matrix rows. Log-space rows are transformed to unit vectors, and
+        sparse matrices give a CSR matrix with the rows.
+        """
+        if self.matrix_info.get('sparse'):
+            return self.matrix[np.asarray(rows)]
+        embeddings = [self.matrix[row] for row in rows]
+        if self.matrix_info.get('log_space'):
+            from log_space import to_unit_vectors
+            return to_unit_vectors(embeddings, self.transform, self.temperature, self.top_k)
+        return np.array(embeddings)
 
     def export_clusters(self, fl, word, labels):
         """
-        Write clustering results to files
+        Write clustering results to files (one <word>.disamb file, or a record in the disamb store)
         :param fl:              handle for logging file
         :param word:            Current word to disambiguate
         :param labels:          Cluster labels for each word instance
         """
+        from sklearn.preprocessing import normalize
+        from disamb_store import render_disamb
+
         sense_centroids = []  # List with word sense centroids
+        clusters = []  # Members and sample sentences of each cluster
         num_clusters = max(labels) + 1
-        print(f"Num clusters: {num_clusters}")
+        logger.debug("Num clusters: %d", num_clusters)
         fl.write(f"{word}\t\t{num_clusters}\n")
 
-        # Write senses to file, with some sentence examples
-        with open(self.save_dir + '/' + word + ".disamb", "w") as fo:
-            for i in range(-1, num_clusters):  # Also write unclustered words
-                sense_members = [self.vocab_map[word][j] for j, k in enumerate(labels) if k == i]
-                fo.write(f"Cluster #{i}")
-                if len(sense_members) > 0:  # Handle empty clusters
-                    fo.write(": \n[")
-                    np.savetxt(fo, sense_members, fmt="(%s, %s, %s)", newline=", ")
-                    fo.write(']\n')
-                    # Write at most 3 sentence examples for the word sense
-                    sent_samples = rand.sample(sense_members, min(len(sense_members), 3))
-                    fo.write('Samples:\n')
-                    # Write sample sentences to file, with focus word in CAPS for easier reading
-                    for sample, focus_word, _ in sent_samples:
-                        bold_sent = self.sentences[sample]
-                        bold_sent[focus_word] = bold_sent[focus_word].upper()
-                        fo.write(" ".join(bold_sent) + '\n')
-                    # Calculate cluster centroid and save
-                    if i >= 0:  # Don't calculate centroid for unclustered (noise) instances
-                        sense_embeddings = [self.matrix[row] for _, _, row in sense_members]
-                        # Average and normalize centroid
-                        sense_centroids.append(normalize([np.mean(sense_embeddings, 0)])[0])
-                else:
-                    fo.write(" is empty\n\n")
+        for i in range(-1, num_clusters):  # Also write unclustered words
+            sense_members = [self.vocab_map[word][j] for j, k in enumerate(labels) if k == i]
+            samples = []
+            if len(sense_members) > 0:  # Handle empty clusters
+                # Write at most 3 sentence examples for the word sense
+                sent_samples = rand.sample(sense_members, min(len(sense_members), 3))
+                # Write sample sentences to file, with focus word in CAPS for easier reading
+                for sample, focus_word, _ in sent_samples:
+                    bold_sent = self.sentences[sample]
+                    bold_sent[focus_word] = bold_sent[focus_word].upper()
+                    samples.append(" ".join(bold_sent))
+                # Calculate cluster centroid and save
+                if i >= 0:  # Don't calculate centroid for unclustered (noise) instances
+                    sense_embeddings = self.instance_embeddings([row for _, _, row in sense_members])
+                    # Average and normalize centroid
+                    sense_centroids.append(normalize(np.asarray(sense_embeddings.mean(axis=0)).reshape(1, -1))[0])
+            clusters.append((i, sense_members, samples))
+
+        if self.store is not None:
+            self.store.write(word, clusters, sense_centroids)
+        else:
+            with open(self.save_dir + '/' + word + ".disamb", "w") as fo:
+                fo.write(render_disamb(clusters))
 
         return sense_centroids
 
@@ -446,6 +1024,9 @@ if __name__ == '__main__':
     parser.add_argument('--corpus', type=str, required=True, help='Training Corpus')
     parser.add_argument('--threshold', type=int, default=2, help='Min freq of word to be disambiguated')
     parser.add_argument('--func_frac', type=float, default=0.05, help='Top fraction of words considered functional')
+    parser.add_argument('--targets', type=str, default=None, help='File with the words to disambiguate (first field '
+                                                                  'of each line, e.g. a disamb.pred file): only '
+                                                                  'their instances get matrix rows')
     parser.add_argument('--start_k', type=int, default=10, help='First number of clusters to use in KMeans')
     parser.add_argument('--end_k', type=int, default=10, help='Final number of clusters to use in KMeans')
     parser.add_argument('--step_k', type=int, default=1, help='Increase in number of clusters to use')
@@ -455,12 +1036,86 @@ if __name__ == '__main__':
     parser.add_argument('--pickle_cent', type=str, default='test_cent.pickle', help='Pickle file for cluster centroids')
     parser.add_argument('--verbose', action='store_true', help='Print processing details')
     parser.add_argument('--plot', action='store_true', help='Plot word embeddings?')
+    parser.add_argument('--plot_max_points', type=int, default=1000, help='Instances plotted per word, sampled '
+                                                                          'from larger sets')
+    parser.add_argument('--plot_tsne_max', type=int, default=500, help='Max instances for the t-SNE plot; larger '
+                                                                       'sets are only plotted with PCA')
+    parser.add_argument('--plot_queue', type=int, default=32, help='Max plots waiting to be rendered; further '
+                                                                  'plots are dropped')
+    parser.add_argument('--sample_weights', action='store_true', help='Cluster the instances of repeated sentences '
+                                                                      'once, with sample weights (if supported)')
     parser.add_argument('--pickle_emb', type=str, default='test.pickle', help='Pickle file for Embeddings/Save '
                                                                               'Embeddings to file')
+    parser.add_argument('--update', action='store_true', help='Add the --corpus sentences to the matrix in '
+                                                              '--pickle_emb, computing only new rows and columns')
+    parser.add_argument('--update_senses', action='store_true', help='With --update, assign the new instances to '
+                                                                     'the senses in --pickle_cent and update '
+                                                                     'their centroids, instead of reclustering')
+    parser.add_argument('--drift_threshold', type=float, default=0.05, help='Centroid drift (1 - cosine) that '
+                                                                            'flags a word for a full refit')
+    parser.add_argument('--log_space', action='store_true', help='Store embeddings as float32 log10 probabilities, '
+                                                                 'transformed to unit vectors when clustering')
+    parser.add_argument('--transform', type=str, default='softmax', help='Transform of log-space embeddings: '
+                                                                         'softmax, topk')
+    parser.add_argument('--temperature', type=float, default=1.0, help='Softmax temperature of the transform')
+    parser.add_argument('--top_k', type=int, default=None, help='Entries kept per embedding by the topk transform')
+    parser.add_argument('--sparse_top_k', type=int, default=None, help='Store embeddings as a sparse matrix, keeping '
+                                                                       'this many largest entries per instance')
+    parser.add_argument('--sparse_threshold', type=float, default=None, help='Store embeddings as a sparse matrix, '
+                                                                             'keeping entries of at least this '
+                                                                             'fraction of the instance max')
+    parser.add_argument('--reduce', type=str, default='none', help='Project embeddings before clustering: none, '
+                                                                   'pca, random_projection')
+    parser.add_argument('--reduce_dims', type=int, default=100, help='Dimensions kept by --reduce')
+    parser.add_argument('--reduce_cache', type=str, default=None, help='.npz file to reuse the projected matrix '
+                                                                       'from (created if not present)')
+    parser.add_argument('--reduce_chunk', type=int, default=1000, help='Rows per chunk when fitting --reduce')
+    parser.add_argument('--min_samples', type=int, nargs='+', default=None, help='min_samples values to sweep for '
+                                                                                 'OPTICS/DBSCAN')
+    parser.add_argument('--eps', type=float, nargs='+', default=None, help='eps values to sweep for DBSCAN')
+    parser.add_argument('--precompute_distances', action='store_true', help='Compute the cosine distances of each '
+                                                                            'word once, reused by OPTICS/DBSCAN '
+                                                                            'sweeps')
+    parser.add_argument('--gram_cache_mb', type=int, default=1024, help='Memory bound of the cached distances')
+    parser.add_argument('--gram_block', type=int, default=2048, help='Rows per block when computing distances')
+    parser.add_argument('--output_format', type=str, default='files', help='Disambiguation output: files (one '
+                                                                           '.disamb file per word), store (single '
+                                                                           'indexed disamb.store file)')
     parser.add_argument('--norm_file', type=str, default='', help='Sentences file to use for normalization')
     parser.add_argument('--norm_pickle', type=str, default='test.pickle', help='Pickle file to use for normalization')
+    parser.add_argument('--quantize', type=str, default='none', help='Quantize model for CPU inference: none, int8')
+    parser.add_argument('--quantized_path', type=str, default=None, help='File to save/reload the quantized model')
+    parser.add_argument('--bf16', action='store_true', help='Run the language model under bfloat16 autocast')
+    parser.add_argument('--mmap_path', type=str, default=None, help='Memory-map the model weights from this file '
+                                                                    '(created if not present), to share them '
+                                                                    'between processes')
+    parser.add_argument('--embedding', type=str, default='probs', help='Instance embeddings: probs (sentence '
+                                                                       'probs of vocabulary fillers), or hidden '
+                                                                       '(last 4 hidden layers, one pass/sentence)')
+    parser.add_argument('--batch_size', type=int, default=64, help='Max masked sentences per forward pass')
+    parser.add_argument('--max_plan_queries', type=int, default=200000, help='Max masked predictions planned '
+                                                                             'at a time; larger sentences are '
+                                                                             'planned in chunks')
+    parser.add_argument('--pipeline_workers', type=int, default=0, help='Threads building batches while the model '
+                                                                        'runs (0 to compute serially, -1 to '
+                                                                        'derive them from the thread budget)')
+    parser.add_argument('--pipeline_queue', type=int, default=8, help='Max built batches waiting for the model')
+    parser.add_argument('--score_server', type=str, default=None, help='URL of a running score_server.py to use '
+                                                                       'instead of loading the model')
+    parser.add_argument('--norm_batch_size', type=int, default=64, help='Masked sentences per normalization batch')
+    parser.add_argument('--norm_tol', type=float, default=None, help='Stop scoring a normalization sentence length '
+                                                                     'when std error of its log10-prob is below this')
+    parser.add_argument('--norm_max_samples', type=int, default=None, help='Max normalization sentences per length')
+    instrumentation.add_arguments(parser)
+    resources.add_arguments(parser)
 
     args = parser.parse_args()
+    instrumentation.setup(args.log_level, args.log_interval, args.metrics_file, args.profile_dir)
+    pipeline_workers = resources.setup(args.threads, args.pipeline_workers)
+
+    if args.update_senses and not args.update:
+        print("ERROR: --update_senses needs --update")
+        exit(1)
 
     print("Corpus is: " + args.corpus)
 
@@ -471,20 +1126,53 @@ if __name__ == '__main__':
         print("Processing without CUDA!")
 
     WSD = WordSenseModel(pretrained_model=args.pretrained, device_number=args.device, use_cuda=args.use_cuda,
-                         freq_threshold=args.threshold)
+                         freq_threshold=args.threshold, quantize=args.quantize, bf16=args.bf16,
+                         quantized_path=args.quantized_path, batch_size=args.batch_size,
+                         max_plan_queries=args.max_plan_queries,
+                         pipeline_workers=pipeline_workers, pipeline_queue=args.pipeline_queue,
+                         score_server=args.score_server, mmap_path=args.mmap_path, embedding=args.embedding,
+                         sample_weights=args.sample_weights, log_space=args.log_space, transform=args.transform,
+                         temperature=args.temperature, top_k=args.top_k, sparse_top_k=args.sparse_top_k,
+                         sparse_threshold=args.sparse_threshold, reduce=args.reduce, reduce_dims=args.reduce_dims,
+                         reduce_cache=args.reduce_cache, reduce_chunk=args.reduce_chunk,
+                         precompute_distances=args.precompute_distances, gram_cache_mb=args.gram_cache_mb,
+                         gram_block=args.gram_block, output_format=args.output_format,
+                         plot_max_points=args.plot_max_points, plot_tsne_max=args.plot_tsne_max,
+                         plot_queue=args.plot_queue,
+                         targets=WordSenseModel.read_targets(args.targets) if args.targets else None,
+                         func_frac=args.func_frac)
 
     print("Obtaining word embeddings...")
-    WSD.load_matrix(args.pickle_emb, args.corpus, verbose=args.verbose, norm_pickle=args.norm_pickle,
-                    norm_file=args.norm_file)
+    load = WSD.update_matrix if args.update else WSD.load_matrix
+    load(args.pickle_emb, args.corpus, verbose=args.verbose, norm_pickle=args.norm_pickle,
+         norm_file=args.norm_file, norm_batch_size=args.norm_batch_size, norm_tol=args.norm_tol,
+         norm_max_samples=args.norm_max_samples)
 
     # Find most frequent words to not disambiguate them
     print(f"Finding the top {args.func_frac} fraction of words")
     WSD.find_function_words(args.func_frac)
 
+    if args.update_senses:
+        with metrics.stage('update_senses'):
+            WSD.update_senses(args.pickle_cent, args.drift_threshold)
+        print(f"Sense centroids updated in {args.pickle_cent}")
+        exit(0)
+
+    if args.eps and args.clustering != 'DBSCAN':
+        print(f"--eps only applies to DBSCAN; ignored for {args.clustering}")
     print("Start disambiguation...")
+    # Density parameters are only passed if swept, so that each method keeps its defaults otherwise
+    density_params = [{}]
+    if args.min_samples:
+        density_params = [dict(params, min_samples=min_samples) for params in density_params
+                          for min_samples in args.min_samples]
+    if args.eps and args.clustering == 'DBSCAN':  # OPTICS ignores eps: its runs would overwrite each other
+        density_params = [dict(params, eps=eps) for params in density_params for eps in args.eps]
     for nn in range(args.start_k, args.end_k + 1, args.step_k):
-        WSD.init_estimator(args.save_to, clust_method=args.clustering, k=nn)
-        WSD.disambiguate(pickle_cent=args.pickle_cent, plot=args.plot)
+        for params in density_params:
+            WSD.init_estimator(args.save_to, clust_method=args.clustering, k=nn, **params)
+            with metrics.stage('disambiguate'):
+                WSD.disambiguate(pickle_cent=args.pickle_cent, plot=args.plot)
 
     print("\n\n*******************************************************")
     print(f"WSD finished. Output files written in {args.save_to}")